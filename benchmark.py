@@ -0,0 +1,343 @@
+# End-to-end benchmark of the crawl and compile pipeline against the local
+# stand-in server (standin_server.py). Every stage is timed and its
+# throughput, per-call latency histogram and peak memory are written as JSON,
+# so runs on different commits can be compared with --compare.
+#
+#   python benchmark.py --scale 2 --latency-ms 20 --out bench/$(git rev-parse --short HEAD).json
+#   python benchmark.py --compare bench/old.json bench/new.json
+
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import os
+import pathlib
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import requests
+
+import standin_server
+
+ROOT = pathlib.Path(__file__).parent
+HISTOGRAM_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class LatencyRecorder:
+    """Thread-safe collector of per-call latencies, in seconds."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+
+    def add(self, seconds: float) -> None:
+        with self.lock:
+            self.samples.append(seconds)
+
+    def summary(self) -> dict:
+        if not self.samples:
+            return {}
+        samples_ms = np.asarray(self.samples) * 1000
+        counts = np.histogram(samples_ms, bins=[0] + HISTOGRAM_BUCKETS_MS + [np.inf])[0]
+        return {
+            "calls": len(samples_ms),
+            "p50_ms": round(float(np.percentile(samples_ms, 50)), 3),
+            "p90_ms": round(float(np.percentile(samples_ms, 90)), 3),
+            "p99_ms": round(float(np.percentile(samples_ms, 99)), 3),
+            "max_ms": round(float(samples_ms.max()), 3),
+            "histogram_ms": {
+                f"le_{bucket}": int(count)
+                for bucket, count in zip(HISTOGRAM_BUCKETS_MS + ["inf"], counts)
+            },
+        }
+
+
+@contextlib.contextmanager
+def record_http_latency(recorder: LatencyRecorder):
+    """Time every requests call made while the context is active."""
+    original = requests.Session.request
+
+    def timed_request(session, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(session, *args, **kwargs)
+        finally:
+            recorder.add(time.perf_counter() - start)
+
+    requests.Session.request = timed_request
+    try:
+        yield recorder
+    finally:
+        requests.Session.request = original
+
+
+def run_stage(name: str, func, items_func, trace_memory: bool = True) -> tuple:
+    """
+    Run one stage and measure it.
+
+    Args:
+        name (str): Stage name used in the report.
+        func (callable): The stage, called with a LatencyRecorder.
+        items_func (callable): Maps the stage's return value to the number of
+            items processed, used for throughput.
+        trace_memory (bool): Measure the Python heap peak with tracemalloc.
+
+    Returns:
+        tuple: (stage report, the stage's return value).
+    """
+    logging.info(f"Running {name}")
+    recorder = LatencyRecorder()
+    if trace_memory:
+        tracemalloc.start()
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    with record_http_latency(recorder):
+        result = func(recorder)
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    items = items_func(result)
+    report = {
+        "wall_s": round(wall, 4),
+        "cpu_s": round(cpu, 4),
+        "items": items,
+        "items_per_s": round(items / wall, 2) if wall and items else None,
+        "peak_heap_mb": round(peak / 2**20, 2) if peak is not None else None,
+        "max_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2
+        ),
+        "latency": recorder.summary(),
+    }
+    return report, result
+
+
+def timed_calls(recorder: LatencyRecorder, func, items) -> list:
+    results = []
+    for item in items:
+        start = time.perf_counter()
+        results.append(func(item))
+        recorder.add(time.perf_counter() - start)
+    return results
+
+
+def point_modules_at(base_url: str) -> None:
+    """Redirect the endpoint constants of the pipeline modules to base_url."""
+    import data_downloader
+    import downloader
+    import downloader2
+    import immobiliare_api
+
+    listings = base_url + standin_server.LISTINGS_PATH
+    autocomplete = base_url + standin_server.AUTOCOMPLETE_PATH
+    for module in (data_downloader, downloader, downloader2, immobiliare_api):
+        module.LISTINGS_ENDPOINT = listings
+    for module in (downloader2, immobiliare_api):
+        module.AUTOCOMPLETE_ENDPOINT = autocomplete
+    downloader.MACROZONES_ENDPOINT = base_url + standin_server.MACROZONES_PATH
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    import data_converter
+    import data_downloader
+    import data_processor
+    import downloader
+
+    # an in-process server shares the GIL with the pipeline; pass --server-url
+    # to benchmark against `python standin_server.py` running separately
+    server = None
+    if not args.server_url:
+        server = standin_server.StandInServer(
+            corpus=standin_server.RecordedCorpus(scale=args.scale),
+            latency_ms=args.latency_ms,
+            jitter_ms=args.jitter_ms,
+            error_rate=args.error_rate,
+            seed=0,
+        )
+        server.start()
+    point_modules_at(args.server_url or server.base_url)
+    data_downloader.ID_CONTRATTO = args.contract
+    trace = not args.no_tracemalloc
+    stages = {}
+
+    workdir = pathlib.Path(tempfile.mkdtemp(prefix="cercocase-bench-"))
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        neighbourhoods = downloader.get_neighbourhoods_df(downloader.CITY_ID)
+        city_hierarchy = downloader.get_hierarchy(downloader.CITY_ID)
+
+        stages["build_indexes"], indexes = run_stage(
+            "build_indexes",
+            lambda _: data_downloader.build_indexes(neighbourhoods),
+            lambda _: len(neighbourhoods),
+            trace,
+        )
+        stages["build_indexes"]["pages_found"] = len(indexes)
+
+        stages["download_listings"], _ = run_stage(
+            "download_listings",
+            lambda _: data_downloader.download_listings(indexes),
+            lambda _: len(indexes),
+            trace,
+        )
+
+        contract = data_downloader.contract_name(args.contract)
+        json_dir = workdir / "listings" / time.strftime("%y%m%d") / "json" / contract
+        json_files = sorted(json_dir.glob("*.json"))
+        stages["compile_city_tables"], _ = run_stage(
+            "compile_city_tables",
+            lambda _: data_processor.compile_city_tables(contract=contract),
+            lambda _: len(json_files),
+            trace,
+        )
+
+        stages["compile_macrozone_summary_table"], summary = run_stage(
+            "compile_macrozone_summary_table",
+            lambda _: data_processor.compile_macrozone_summary_table(contract=contract),
+            lambda summary: len(summary),
+            trace,
+        )
+
+        # every recorded contract probed and downloaded in a single pass
+        contracts = sorted(standin_server.CONTRACT_DIRS)
+        stages["crawl_all_contracts"], crawled = run_stage(
+            "crawl_all_contracts",
+            lambda _: data_downloader.crawl(
+                neighbourhoods, contracts, root=workdir / "crawl"
+            ),
+            lambda crawled: len(neighbourhoods) * len(contracts) + len(crawled),
+            trace,
+        )
+        stages["crawl_all_contracts"]["pages_found"] = len(crawled)
+
+        # json_to_csv expects the recorded file naming (json_data_<mz>_<nb>_<page>.json)
+        recorded_dir = standin_server.CONTRACT_DIRS[args.contract]
+        recorded = sorted(str(path) for path in recorded_dir.glob("json_data_*.json"))
+        recorded = recorded[: args.max_files] if args.max_files else recorded
+        stages["json_to_csv"], frames = run_stage(
+            "json_to_csv",
+            lambda recorder: timed_calls(
+                recorder,
+                lambda path: data_converter.json_to_csv(path, city_hierarchy),
+                recorded,
+            ),
+            lambda frames: len(frames),
+            trace,
+        )
+
+        stages["tag_data"] = benchmark_tag_data(frames, args.max_docs, trace)
+    finally:
+        os.chdir(cwd)
+        if server is not None:
+            server.shutdown()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "scale": args.scale,
+            "latency_ms": args.latency_ms,
+            "jitter_ms": args.jitter_ms,
+            "error_rate": args.error_rate,
+            "contract": args.contract,
+            "tracemalloc": trace,
+            "server_url": args.server_url,
+        },
+        "server_requests": dict(server.requests_served) if server else None,
+        "stages": stages,
+    }
+
+
+def benchmark_tag_data(frames: list, max_docs: int, trace: bool) -> dict:
+    import pandas as pd
+
+    import nlp_analysis
+
+    try:
+        nlp_analysis.get_nlp()
+    except (ImportError, OSError) as e:
+        return {"skipped": f"spaCy pipeline unavailable: {e}"}
+
+    docs_path = pathlib.Path(tempfile.mkdtemp(prefix="cercocase-bench-")) / "docs.csv"
+    pd.concat(frames).drop_duplicates("id").to_csv(docs_path, index=False)
+    cleaned = nlp_analysis.clean_data(docs_path).head(max_docs)
+    report, _ = run_stage(
+        "tag_data",
+        lambda _: nlp_analysis.tag_data(cleaned),
+        lambda _: len(cleaned),
+        trace,
+    )
+    return report
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(old_path: pathlib.Path, new_path: pathlib.Path) -> None:
+    """Print wall time, throughput and memory of two runs side by side."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(
+        f"{'stage':<34}{'wall old':>10}{'wall new':>10}{'speedup':>9}{'heap old':>10}{'heap new':>10}"
+    )
+    for stage, new_report in new["stages"].items():
+        old_report = old["stages"].get(stage, {})
+        old_wall, new_wall = old_report.get("wall_s"), new_report.get("wall_s")
+        speedup = f"{old_wall / new_wall:.2f}x" if old_wall and new_wall else "-"
+        print(
+            f"{stage:<34}{old_wall or '-':>10}{new_wall or '-':>10}{speedup:>9}"
+            f"{old_report.get('peak_heap_mb') or '-':>10}{new_report.get('peak_heap_mb') or '-':>10}"
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Pipeline benchmark against the stand-in server"
+    )
+    parser.add_argument("--scale", type=int, default=1, help="corpus size multiplier")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--contract", type=int, default=1, choices=[1, 2])
+    parser.add_argument(
+        "--max-files", type=int, default=0, help="cap json_to_csv inputs, 0 for all"
+    )
+    parser.add_argument(
+        "--max-docs", type=int, default=500, help="descriptions tagged by tag_data"
+    )
+    parser.add_argument("--no-tracemalloc", action="store_true")
+    parser.add_argument("--server-url", default=None, help="external stand-in server")
+    parser.add_argument("--out", type=pathlib.Path, default=None)
+    parser.add_argument("--compare", nargs=2, type=pathlib.Path, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        report = run_benchmark(args)
+        output = json.dumps(report, indent=2)
+        if args.out:
+            args.out.parent.mkdir(parents=True, exist_ok=True)
+            args.out.write_text(output)
+        print(output)
@@ -0,0 +1,614 @@
+# Command line driver for the whole pipeline. Each stage is a subcommand:
+#
+#   python cercocase.py index --cities Milano Torino   # neighbourhood index table
+#   python cercocase.py probe --contract sale rent     # list the pages to download
+#   python cercocase.py download --workers 20          # fetch them into the snapshot
+#   python cercocase.py crawl --contract sale rent auction --rate 20
+#   python cercocase.py publish --contract sale rent   # pages -> shared work queue
+#   python cercocase.py work --threads 8               # one per worker process/host
+#   python cercocase.py merge                          # worker shards -> snapshot
+#   python cercocase.py refresh --budget 2000          # refetch the likeliest changes
+#   python cercocase.py compile --contract rent        # JSON pages -> city CSVs
+#                                                      # and <root>/events/ feed
+#   python cercocase.py dedupe                         # near-duplicate clusters
+#   python cercocase.py summarize --dedupe             # macrozone summary table
+#   python cercocase.py cube                           # rollup cube, out/cube.npz
+#   python cercocase.py hedonic                        # quality-adjusted index
+#   python cercocase.py fulltext --contract sale rent  # description search index
+#   python cercocase.py nlp data_sales.csv             # tag listing descriptions
+#   python cercocase.py nlp data_sales.csv --store ./nlp_store/  # only the changes
+#   python cercocase.py nlp data_sales.csv --fast --words-output words.csv
+#
+# --http-cache record saves every response of a run, and --http-cache replay
+# re-runs the pipeline from them without a single network call. --transport
+# http2 multiplexes the requests over a few HTTP/2 connections.
+#
+# Only the standard library is imported up front: pandas, requests, spaCy and
+# plotly are imported by the stages that use them, so --help and the light
+# stages start immediately. Several contracts and categories can be given at
+# once: they are crawled in a single pass over shared connections and a shared
+# rate budget, and every stage writes one partition per contract
+# (./listings/<yymmdd>/json/rent/, csv/rent/, out/rent/).
+
+import argparse
+import json
+import logging
+import pathlib
+import time
+
+import instrumentation
+
+CONTRACTS = {"sale": 1, "rent": 2, "auction": 14}
+CONTRACT_NAMES = {contract_id: name for name, contract_id in CONTRACTS.items()}
+INDEX_TABLE = pathlib.Path("./table_builder/index_table.csv")
+LISTINGS_ROOT = pathlib.Path("./listings/")
+
+
+def contract_id(value: str) -> int:
+    """Accept a contract name (sale, rent, auction) or an idContratto."""
+    if value in CONTRACTS:
+        return CONTRACTS[value]
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"unknown contract {value!r}, use one of {', '.join(CONTRACTS)} or an id"
+        )
+
+
+def contract_names(args: argparse.Namespace) -> list:
+    return [CONTRACT_NAMES.get(contract, str(contract)) for contract in args.contract]
+
+
+def snapshot_path(args: argparse.Namespace) -> pathlib.Path:
+    return args.root / (args.date or time.strftime("%y%m%d"))
+
+
+def load_index_table(args: argparse.Namespace):
+    import hierarchy
+
+    index_table = hierarchy.load(args.index_table).to_frame()
+    if args.cities:
+        cities = {city.lower() for city in args.cities}
+        index_table = index_table[index_table["city_name"].str.lower().isin(cities)]
+        missing = cities - set(index_table["city_name"].str.lower())
+        if missing:
+            logging.warning(f"Not in {args.index_table}: {', '.join(sorted(missing))}")
+    return index_table
+
+
+def run_index(args: argparse.Namespace) -> None:
+    from table_builder import table_builder
+
+    args.index_table.parent.mkdir(parents=True, exist_ok=True)
+    table_builder.build_index_table(args.cities or None, args.index_table)
+
+
+def run_probe(args: argparse.Namespace) -> list:
+    import data_downloader
+
+    indexes = data_downloader.build_indexes(
+        load_index_table(args), args.contract, args.category, args.workers, args.rate
+    )
+    save_path = snapshot_path(args) / "indexes.json"
+    save_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(save_path, "w") as f:
+        # the ids come out of pandas as numpy integers
+        json.dump(indexes, f, default=int)
+    logging.info(f"Saved {len(indexes)} pages to download to {save_path}")
+    return indexes
+
+
+def run_download(args: argparse.Namespace) -> None:
+    import data_downloader
+
+    index_path = snapshot_path(args) / "indexes.json"
+    if index_path.exists() and not args.reprobe:
+        with open(index_path) as f:
+            indexes = json.load(f)
+        logging.info(f"Loaded {len(indexes)} pages to download from {index_path}")
+    else:
+        indexes = run_probe(args)
+    data_downloader.download_listings(
+        indexes, args.workers, args.root, args.rate, snapshot_path(args).name
+    )
+    observe_pages(args)
+
+
+def queue_url(args: argparse.Namespace) -> str:
+    return args.queue or str(snapshot_path(args) / "queue.sqlite")
+
+
+def run_publish(args: argparse.Namespace) -> None:
+    import work_queue
+
+    index_path = snapshot_path(args) / "indexes.json"
+    if index_path.exists() and not args.reprobe:
+        with open(index_path) as f:
+            indexes = json.load(f)
+    else:
+        indexes = run_probe(args)
+    queue = work_queue.open_queue(queue_url(args))
+    added = work_queue.publish_indexes(queue, indexes, snapshot_path(args).name)
+    logging.info(f"Published {added} new pages, queue: {json.dumps(queue.stats())}")
+    queue.close()
+
+
+def run_work(args: argparse.Namespace) -> None:
+    import work_queue
+
+    queue = work_queue.open_queue(queue_url(args))
+    work_queue.run_worker(
+        queue,
+        args.worker,
+        args.root,
+        args.threads,
+        args.rate,
+        args.lease,
+        date=snapshot_path(args).name,
+    )
+    queue.close()
+
+
+def run_merge(args: argparse.Namespace) -> None:
+    import work_queue
+
+    work_queue.merge_shards(args.root, args.date)
+    observe_pages(args)
+
+
+def run_crawl(args: argparse.Namespace) -> None:
+    import data_downloader
+
+    indexes = data_downloader.crawl(
+        load_index_table(args),
+        args.contract,
+        args.category,
+        args.workers,
+        args.root,
+        args.rate,
+        snapshot_path(args).name,
+    )
+    save_path = snapshot_path(args) / "indexes.json"
+    save_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(save_path, "w") as f:
+        json.dump(indexes, f, default=int)
+    logging.info(f"Downloaded {len(indexes)} pages")
+    observe_pages(args)
+
+
+def observe_pages(args: argparse.Namespace) -> None:
+    import page_scheduler
+
+    conn = page_scheduler.connect(args.root / "page_stats.sqlite")
+    page_scheduler.observe_snapshot(conn, snapshot_path(args))
+    conn.close()
+
+
+def run_refresh(args: argparse.Namespace) -> None:
+    import page_scheduler
+
+    conn = page_scheduler.connect(args.root / "page_stats.sqlite")
+    # pages found by the latest probe but never fetched are scheduled first
+    index_paths = sorted(args.root.glob("*/indexes.json"))
+    if index_paths:
+        with open(index_paths[-1]) as f:
+            page_scheduler.register_pages(conn, json.load(f))
+    page_scheduler.refresh(
+        conn,
+        args.budget,
+        args.workers,
+        args.root,
+        args.rate,
+        args.exploration,
+        snapshot_path(args).name,
+    )
+    conn.close()
+
+
+def run_compile(args: argparse.Namespace) -> None:
+    import data_processor
+
+    for contract in contract_names(args):
+        data_processor.compile_city_tables(args.root, args.date, contract)
+        if args.events:
+            import event_log
+
+            event_log.emit_snapshot_events(args.root, args.date, contract)
+
+
+def run_dedupe(args: argparse.Namespace) -> None:
+    import near_duplicates
+
+    for contract in contract_names(args):
+        near_duplicates.snapshot_clusters(
+            args.root, args.date, contract, args.threshold
+        )
+
+
+def run_summarize(args: argparse.Namespace) -> None:
+    import data_processor
+
+    for contract in contract_names(args):
+        summary = data_processor.compile_macrozone_summary_table(
+            args.root, args.date, contract, args.dedupe
+        )
+        logging.info(f"Summarised {len(summary)} {contract} macrozones")
+
+
+def run_cube(args: argparse.Namespace) -> None:
+    import cube
+
+    cube.snapshot_cube(args.root, args.date, args.outlier_quantile)
+
+
+def run_hedonic(args: argparse.Namespace) -> None:
+    import hedonic
+
+    hedonic.update_stats(args.root, args.date, args.full)
+
+
+def run_fulltext(args: argparse.Namespace) -> None:
+    import search_index
+
+    listings = search_index.snapshot_listings(
+        args.root, args.date, contract_names(args)
+    )
+    search_index.SearchIndex(args.index_path).sync(listings)
+
+
+def run_nlp(args: argparse.Namespace) -> None:
+    import pandas as pd
+
+    import nlp_analysis
+
+    listings = nlp_analysis.clean_data(args.input)
+    if args.clusters:
+        import near_duplicates
+
+        listings = near_duplicates.deduplicate(listings, pd.read_csv(args.clusters))
+
+    if args.store:
+        import token_store
+
+        # only the new and changed descriptions are tagged
+        store = token_store.TokenStore(args.store)
+        store.sync(listings)
+        if args.output:
+            store.tokens().to_csv(args.output, index=False, encoding="utf-8")
+        if args.words_output:
+            words = store.most_used_words_by_neighbourhood()
+            words.to_csv(args.words_output, index=False, encoding="utf-8")
+        store.close()
+        return
+
+    if args.fast:
+        import fast_nlp
+
+        analyzer = fast_nlp.FastAnalyzer(fast_nlp.load_lemma_table(args.lemma_table))
+        tagged = analyzer.analyze_frame(listings)
+    else:
+        tagged = nlp_analysis.tag_data(listings)
+    tagged.to_csv(args.output or "data_tagged.csv", index=False, encoding="utf-8")
+    if args.words_output:
+        words = nlp_analysis.most_used_words_by_neighbourhood(tagged)
+        words.to_csv(args.words_output, index=False, encoding="utf-8")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "--root",
+        type=pathlib.Path,
+        default=LISTINGS_ROOT,
+        help="directory holding the daily snapshots (default: %(default)s)",
+    )
+    common.add_argument(
+        "--date", default=None, help="snapshot to work on, yymmdd (default: today)"
+    )
+    common.add_argument("-v", "--verbose", action="store_true")
+    common.add_argument(
+        "--http-cache",
+        choices=("off", "normal", "record", "replay"),
+        default=None,
+        help="HTTP cache mode (default: $CERCOCASE_HTTP_CACHE or off)",
+    )
+    common.add_argument(
+        "--http-cache-path",
+        type=pathlib.Path,
+        default=None,
+        help="SQLite file of the HTTP cache (default: ./.http_cache/responses.sqlite)",
+    )
+    common.add_argument(
+        "--http-cache-ttl",
+        type=float,
+        default=None,
+        help="seconds a cached response is served in normal mode (default: 1 day)",
+    )
+    common.add_argument(
+        "--transport",
+        choices=("requests", "http2", "httpx"),
+        default=None,
+        help="HTTP client: requests (HTTP/1.1), http2 (httpx + h2) or httpx "
+        "(default: $CERCOCASE_TRANSPORT or requests)",
+    )
+    common.add_argument(
+        "--max-connections",
+        type=int,
+        default=None,
+        help="connections per host (default: workers, or 4 for http2)",
+    )
+    common.add_argument(
+        "--keepalive",
+        type=float,
+        default=None,
+        help="seconds an idle httpx connection is kept open (default: 30)",
+    )
+    instrumentation.add_arguments(common)
+
+    contracts = argparse.ArgumentParser(add_help=False)
+    contracts.add_argument(
+        "--contract",
+        type=contract_id,
+        nargs="+",
+        default=[CONTRACTS["sale"]],
+        help="sale, rent, auction or idContratto values (default: sale)",
+    )
+
+    crawl = argparse.ArgumentParser(add_help=False)
+    crawl.add_argument(
+        "--category",
+        type=int,
+        nargs="+",
+        default=[1],
+        help="idCategoria values (default: 1, houses)",
+    )
+    crawl.add_argument(
+        "--rate",
+        type=float,
+        default=None,
+        help="maximum requests per second over all workers (default: no limit)",
+    )
+    crawl.add_argument(
+        "--cities", nargs="+", default=None, help="city names (default: all)"
+    )
+    crawl.add_argument(
+        "--index-table",
+        type=pathlib.Path,
+        default=INDEX_TABLE,
+        help="neighbourhood index table (default: %(default)s)",
+    )
+
+    parser = argparse.ArgumentParser(
+        prog="cercocase", description="Crawl and analyse immobiliare.it listings"
+    )
+    stages = parser.add_subparsers(dest="stage", required=True, metavar="stage")
+
+    stage = stages.add_parser(
+        "index", parents=[common], help="build the neighbourhood index table"
+    )
+    stage.add_argument(
+        "--cities", nargs="+", default=None, help="city names (default: all)"
+    )
+    stage.add_argument("--index-table", type=pathlib.Path, default=INDEX_TABLE)
+    stage.set_defaults(run=run_index)
+
+    stage = stages.add_parser(
+        "probe",
+        parents=[common, contracts, crawl],
+        help="list the pages of every neighbourhood",
+    )
+    stage.add_argument("--workers", type=int, default=None)
+    stage.set_defaults(run=run_probe)
+
+    stage = stages.add_parser(
+        "download", parents=[common, contracts, crawl], help="download the probed pages"
+    )
+    stage.add_argument("--workers", type=int, default=10)
+    stage.add_argument(
+        "--reprobe", action="store_true", help="probe again even if indexes exist"
+    )
+    stage.set_defaults(run=run_download)
+
+    stage = stages.add_parser(
+        "crawl",
+        parents=[common, contracts, crawl],
+        help="probe and download every contract and category in one pass",
+    )
+    stage.add_argument("--workers", type=int, default=10)
+    stage.set_defaults(run=run_crawl)
+
+    queue = argparse.ArgumentParser(add_help=False)
+    queue.add_argument(
+        "--queue",
+        default=None,
+        help="queue file or http://host:port of `work_queue.py serve` "
+        "(default: <root>/<date>/queue.sqlite)",
+    )
+
+    stage = stages.add_parser(
+        "publish",
+        parents=[common, contracts, crawl, queue],
+        help="publish the probed pages to the shared work queue",
+    )
+    stage.add_argument("--workers", type=int, default=None)
+    stage.add_argument(
+        "--reprobe", action="store_true", help="probe again even if indexes exist"
+    )
+    stage.set_defaults(run=run_publish)
+
+    stage = stages.add_parser(
+        "work",
+        parents=[common, queue],
+        help="download pages claimed from the work queue into a shard",
+    )
+    stage.add_argument("--threads", type=int, default=10)
+    stage.add_argument(
+        "--rate",
+        type=float,
+        default=None,
+        help="maximum requests per second of this worker",
+    )
+    stage.add_argument(
+        "--lease", type=float, default=60.0, help="seconds a claimed page is leased"
+    )
+    stage.add_argument("--worker", default=None, help="worker id (default: host-pid)")
+    stage.set_defaults(run=run_work)
+
+    stage = stages.add_parser(
+        "merge", parents=[common], help="merge the worker shards into the snapshot"
+    )
+    stage.set_defaults(run=run_merge)
+
+    stage = stages.add_parser(
+        "refresh",
+        parents=[common],
+        help="refetch the pages most likely to have changed within a budget",
+    )
+    stage.add_argument("--budget", type=int, required=True, help="requests to spend")
+    stage.add_argument("--workers", type=int, default=10)
+    stage.add_argument("--rate", type=float, default=None)
+    stage.add_argument(
+        "--exploration",
+        type=float,
+        default=0.05,
+        help="share of the budget spent on pages outside the top ranks",
+    )
+    stage.set_defaults(run=run_refresh)
+
+    stage = stages.add_parser(
+        "compile", parents=[common, contracts], help="parse the pages into city tables"
+    )
+    stage.add_argument(
+        "--no-events",
+        dest="events",
+        action="store_false",
+        help="do not append the listing changes to <root>/events/",
+    )
+    stage.set_defaults(run=run_compile)
+
+    stage = stages.add_parser(
+        "dedupe",
+        parents=[common, contracts],
+        help="cluster near-duplicate listings (MinHash/LSH on descriptions)",
+    )
+    stage.add_argument(
+        "--threshold",
+        type=float,
+        default=0.7,
+        help="estimated description similarity of duplicates (default: 0.7)",
+    )
+    stage.set_defaults(run=run_dedupe)
+
+    stage = stages.add_parser(
+        "summarize",
+        parents=[common, contracts],
+        help="build the macrozone summary table",
+    )
+    stage.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="count near-duplicate listings once (run the dedupe stage first)",
+    )
+    stage.set_defaults(run=run_summarize)
+
+    stage = stages.add_parser(
+        "cube",
+        parents=[common],
+        help="pre-aggregate the snapshot for rollups (query with cube.py)",
+    )
+    stage.add_argument(
+        "--outlier-quantile",
+        type=float,
+        default=0.99,
+        help="drop listings above this per-city price_per_sqm quantile",
+    )
+    stage.set_defaults(run=run_cube)
+
+    stage = stages.add_parser(
+        "hedonic",
+        parents=[common],
+        help="update the hedonic regression and its neighbourhood price index",
+    )
+    stage.add_argument(
+        "--full",
+        action="store_true",
+        help="refit from this snapshot instead of updating the previous one",
+    )
+    stage.set_defaults(run=run_hedonic)
+
+    stage = stages.add_parser(
+        "fulltext",
+        parents=[common, contracts],
+        help="sync the description search index (query with search_index.py)",
+    )
+    stage.add_argument(
+        "--index-path",
+        type=pathlib.Path,
+        default=pathlib.Path("./search_index/"),
+        help="index directory; listings of contracts not given are dropped",
+    )
+    stage.set_defaults(run=run_fulltext)
+
+    stage = stages.add_parser(
+        "nlp", parents=[common], help="tag listing descriptions with spaCy"
+    )
+    stage.add_argument("input", type=pathlib.Path, help="CSV from data_converter")
+    stage.add_argument(
+        "--output",
+        type=pathlib.Path,
+        default=None,
+        help="tagged tokens CSV (default: data_tagged.csv, none with --store)",
+    )
+    mode = stage.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--store",
+        type=pathlib.Path,
+        default=None,
+        help="token store to update incrementally, e.g. ./nlp_store/",
+    )
+    mode.add_argument(
+        "--fast",
+        action="store_true",
+        help="tokenizer and lemma lookup only, enough for the word reports",
+    )
+    stage.add_argument(
+        "--clusters",
+        type=pathlib.Path,
+        default=None,
+        help="duplicate_clusters.csv from the dedupe stage, tag one listing each",
+    )
+    stage.add_argument(
+        "--lemma-table",
+        type=pathlib.Path,
+        default=pathlib.Path("./nlp_store/lemma_table.csv"),
+        help="lemmas from earlier full runs used by --fast (default: %(default)s)",
+    )
+    stage.add_argument(
+        "--words-output",
+        type=pathlib.Path,
+        default=None,
+        help="also save the most used words by neighbourhood",
+    )
+    stage.set_defaults(run=run_nlp)
+
+    return parser
+
+
+def main(argv: list = None) -> None:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    if args.http_cache or args.http_cache_path or args.http_cache_ttl is not None:
+        import http_cache
+
+        http_cache.configure(args.http_cache, args.http_cache_path, args.http_cache_ttl)
+    if args.transport or args.max_connections or args.keepalive:
+        import transport
+
+        transport.configure(args.transport, args.max_connections, args.keepalive)
+    with instrumentation.from_args(args):
+        args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+# Pre-aggregated price cube. The listings of a snapshot are aggregated once at
+# the finest grain (contract × neighbourhood × typology × rooms bucket, with the
+# neighbourhood's region, province, city and macrozone carried along), and
+# every coarser question is answered by merging cells instead of re-grouping
+# listing tables:
+#
+#   python cube.py build --date 261019              # <root>/261019/out/cube.npz
+#   python cube.py query --date 261019 --by province type rooms \
+#       --where contract=sale --metric price_per_sqm
+#
+#   cube = Cube.load(".../out/cube.npz")
+#   cube.summary(["province", "type", "rooms"], where={"contract": "sale"})
+#
+# Each cell keeps count, sum, sum of squares, min and max of price,
+# price_per_sqm and surface, which add up exactly, and a log-bucketed
+# histogram for quantiles: bucket i holds the values in (γ^(i-1), γ^i], so any
+# quantile of a merged cell is within RELATIVE_ACCURACY of the true one.
+
+import argparse
+import logging
+import pathlib
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix, csr_matrix
+
+import outliers
+import warehouse
+
+LISTINGS_ROOT = pathlib.Path("./listings/")
+CUBE_FILE = "cube.npz"
+
+DIMENSIONS = [
+    "contract",
+    "region_id",
+    "province_id",
+    "city",
+    "macrozone",
+    "neighbourhood",
+    "type",
+    "rooms",
+]
+# shorter names accepted for the dimensions in rollups and filters
+ALIASES = {"region": "region_id", "province": "province_id", "typology": "type"}
+METRICS = ["price", "price_per_sqm", "surface"]
+STATS = ["count", "sum", "sumsq", "min", "max"]
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+# values up to 1 share the first bucket, values above MAX_VALUE the last one
+MAX_VALUE = 1e9
+BUCKETS = int(np.ceil(np.log(MAX_VALUE) / np.log(GAMMA))) + 1
+
+
+def rooms_bucket(rooms: pd.Series) -> pd.Series:
+    """Rooms as "1" to "4" and "5+", empty when unknown."""
+    rooms = pd.to_numeric(rooms, errors="coerce").clip(1, 5)
+    buckets = rooms.map({1: "1", 2: "2", 3: "3", 4: "4", 5: "5+"}, na_action="ignore")
+    return buckets.fillna("")
+
+
+def bucket_index(values: np.ndarray) -> np.ndarray:
+    """Histogram bucket of every (positive) value."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        buckets = np.ceil(np.log(np.maximum(values, 1.0)) / np.log(GAMMA))
+    return np.clip(buckets, 0, BUCKETS - 1).astype(np.int32)
+
+
+def bucket_value(buckets: np.ndarray) -> np.ndarray:
+    """The value a bucket stands for, within RELATIVE_ACCURACY of its members."""
+    return 2 * GAMMA ** buckets.astype(np.float64) / (GAMMA + 1)
+
+
+def _dimension(name: str) -> str:
+    name = ALIASES.get(name, name)
+    if name not in DIMENSIONS:
+        raise ValueError(f"Unknown dimension {name!r}, use one of {DIMENSIONS}")
+    return name
+
+
+class Cube:
+    """
+    Mergeable aggregates of the listing metrics, one row per cell.
+
+    Args:
+        cells (pd.DataFrame): The dimension values of every cell.
+        stats (dict): metric -> {stat: array over the cells} for STATS.
+        histograms (dict): metric -> (cells × BUCKETS) sparse bucket counts.
+    """
+
+    def __init__(self, cells: pd.DataFrame, stats: dict, histograms: dict):
+        self.cells = cells.reset_index(drop=True)
+        self.stats = stats
+        self.histograms = histograms
+
+    def __len__(self) -> int:
+        return len(self.cells)
+
+    @classmethod
+    def build(cls, listings: pd.DataFrame, metrics: list = METRICS) -> "Cube":
+        """
+        Aggregate listings at the finest grain.
+
+        Args:
+            listings (pd.DataFrame): Listings with the DIMENSIONS columns
+                (rooms as a number) and the metric columns, e.g. from
+                warehouse.read_snapshot.
+            metrics (list): Metric columns to aggregate.
+        """
+        keys = listings.reindex(columns=DIMENSIONS).astype(object)
+        keys["rooms"] = rooms_bucket(listings["rooms"]).to_numpy()
+        keys = keys.fillna("").astype(str)
+        codes, cells = pd.factorize(pd.MultiIndex.from_frame(keys), sort=True)
+        cells = cells.to_frame(index=False, name=DIMENSIONS)
+
+        stats, histograms = {}, {}
+        for metric in metrics:
+            values = pd.to_numeric(listings[metric], errors="coerce").to_numpy(
+                np.float64
+            )
+            valid = ~np.isnan(values)
+            cell, value = codes[valid], values[valid]
+            grouped = pd.Series(value).groupby(cell)
+            stats[metric] = {
+                "count": np.bincount(cell, minlength=len(cells)).astype(np.int64),
+                "sum": np.bincount(cell, value, minlength=len(cells)),
+                "sumsq": np.bincount(cell, value * value, minlength=len(cells)),
+                "min": grouped.min().reindex(range(len(cells))).to_numpy(),
+                "max": grouped.max().reindex(range(len(cells))).to_numpy(),
+            }
+            # duplicate (cell, bucket) entries are summed
+            histograms[metric] = coo_matrix(
+                (np.ones(len(cell), np.int64), (cell, bucket_index(value))),
+                shape=(len(cells), BUCKETS),
+            ).tocsr()
+        return cls(cells, stats, histograms)
+
+    def select(self, where: dict) -> np.ndarray:
+        """Mask of the cells matching {dimension: value or list of values}."""
+        mask = np.ones(len(self.cells), dtype=bool)
+        for name, value in (where or {}).items():
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            mask &= self.cells[_dimension(name)].isin([str(v) for v in values])
+        return mask
+
+    def rollup(self, by: list, where: dict = None) -> "Cube":
+        """
+        Merge the cells into coarser ones, without going back to the listings.
+
+        Args:
+            by (list): Dimensions of the merged cells, e.g. ["province", "type"];
+                an empty list merges everything into one cell.
+            where (dict): Only merge the cells matching these dimension values.
+        """
+        by = [_dimension(name) for name in by]
+        selected = np.flatnonzero(self.select(where))
+        if by:
+            groups, merged = pd.factorize(
+                pd.MultiIndex.from_frame(self.cells.loc[selected, by]), sort=True
+            )
+            merged = merged.to_frame(index=False, name=by)
+        else:
+            groups, merged = np.zeros(len(selected), np.int64), pd.DataFrame(index=[0])
+        # (merged cells × cells) indicator, histograms merge by multiplying with it
+        membership = csr_matrix(
+            (np.ones(len(selected), np.int64), (groups, selected)),
+            shape=(len(merged), len(self.cells)),
+        )
+        stats, histograms = {}, {}
+        for metric, metric_stats in self.stats.items():
+            stats[metric] = {
+                stat: np.bincount(groups, metric_stats[stat][selected], len(merged))
+                for stat in ("count", "sum", "sumsq")
+            }
+            stats[metric]["count"] = stats[metric]["count"].astype(np.int64)
+            for stat in ("min", "max"):
+                values = pd.Series(metric_stats[stat][selected]).groupby(groups)
+                values = values.min() if stat == "min" else values.max()
+                stats[metric][stat] = values.reindex(range(len(merged))).to_numpy()
+            histograms[metric] = membership @ self.histograms[metric]
+        return Cube(merged, stats, histograms)
+
+    def quantile(self, metric: str, q: float) -> np.ndarray:
+        """
+        Quantile q of a metric in every cell, NaN for empty cells.
+
+        Like pandas' quantile, the result interpolates between the values at
+        the ranks either side of q * (count - 1). The first and last ranks are
+        the exact min and max, the others the value of their bucket.
+        """
+        histogram = self.histograms[metric]
+        histogram.sort_indices()
+        stats = self.stats[metric]
+        counts = np.asarray(histogram.sum(axis=1)).ravel()
+        cumulative = np.cumsum(histogram.data)
+        # counts of the cells before each cell, to search all cells at once
+        before = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        last = np.maximum(counts - 1, 0)
+
+        def value_at(rank: np.ndarray) -> np.ndarray:
+            position = np.searchsorted(cumulative, before + rank, side="right")
+            position = np.minimum(position, max(len(histogram.indices) - 1, 0))
+            values = bucket_value(histogram.indices[position])
+            values = np.clip(values, stats["min"], stats["max"])
+            values = np.where(rank == 0, stats["min"], values)
+            return np.where(rank == last, stats["max"], values)
+
+        if not len(histogram.indices):
+            return np.full(len(counts), np.nan)
+        rank = q * last
+        low = np.floor(rank)
+        fraction = rank - low
+        values = (
+            value_at(low) * (1 - fraction)
+            + value_at(np.minimum(low + 1, last)) * fraction
+        )
+        return np.where(counts > 0, values, np.nan)
+
+    def summary(
+        self,
+        by: list,
+        where: dict = None,
+        metrics: list = None,
+        quantiles: tuple = (0.5, 0.9),
+    ) -> pd.DataFrame:
+        """
+        Count, mean, std, min, max and quantiles of the metrics by dimensions.
+
+        Returns:
+            pd.DataFrame: The by columns and <metric>_<stat> columns, with
+                quantiles named like the summary tables (price_q50).
+        """
+        cube = self.rollup(by, where)
+        summary = cube.cells.copy()
+        for metric in metrics or list(cube.stats):
+            stats = cube.stats[metric]
+            count = stats["count"].astype(np.float64)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                mean = stats["sum"] / count
+                variance = (stats["sumsq"] - stats["sum"] * mean) / (count - 1)
+            summary[f"{metric}_count"] = stats["count"]
+            summary[f"{metric}_mean"] = mean
+            summary[f"{metric}_std"] = np.sqrt(np.maximum(variance, 0))
+            summary[f"{metric}_min"] = stats["min"]
+            summary[f"{metric}_max"] = stats["max"]
+            for q in quantiles:
+                summary[f"{metric}_q{round(q * 100)}"] = cube.quantile(metric, q)
+        return summary
+
+    def save(self, path: pathlib.Path) -> pathlib.Path:
+        """Save the cube as a compressed .npz, dimensions as dictionary codes."""
+        arrays = {"dimensions": np.asarray(list(self.cells.columns), dtype=str)}
+        for dimension in self.cells.columns:
+            codes, labels = pd.factorize(self.cells[dimension])
+            arrays[f"{dimension}_codes"] = codes.astype(np.int32)
+            arrays[f"{dimension}_labels"] = np.asarray(labels, dtype=str)
+        for metric, stats in self.stats.items():
+            for stat, values in stats.items():
+                arrays[f"{metric}_{stat}"] = values
+            histogram = self.histograms[metric]
+            arrays[f"{metric}_indptr"] = histogram.indptr.astype(np.int64)
+            arrays[f"{metric}_buckets"] = histogram.indices.astype(np.int16)
+            arrays[f"{metric}_counts"] = histogram.data.astype(np.int64)
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(path, metrics=np.asarray(list(self.stats)), **arrays)
+        return path
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> "Cube":
+        with np.load(path) as data:
+            cells = pd.DataFrame(
+                {
+                    dimension: data[f"{dimension}_labels"][data[f"{dimension}_codes"]]
+                    for dimension in data["dimensions"].tolist()
+                }
+            ).astype(object)
+            stats, histograms = {}, {}
+            for metric in data["metrics"].tolist():
+                stats[metric] = {stat: data[f"{metric}_{stat}"] for stat in STATS}
+                histograms[metric] = csr_matrix(
+                    (
+                        data[f"{metric}_counts"],
+                        data[f"{metric}_buckets"].astype(np.int32),
+                        data[f"{metric}_indptr"],
+                    ),
+                    shape=(len(cells), BUCKETS),
+                )
+        return cls(cells, stats, histograms)
+
+
+def snapshot_cube(
+    root: pathlib.Path = LISTINGS_ROOT,
+    date: str = None,
+    outlier_quantile: float = 0.99,
+) -> pathlib.Path:
+    """
+    Build the cube of a snapshot's city tables, every contract at once.
+
+    Args:
+        root (pathlib.Path): Directory holding the daily snapshots.
+        date (str): Snapshot to aggregate (yymmdd), today when not given.
+        outlier_quantile (float): Drop listings at or above this price_per_sqm
+            quantile of their city and contract, None to keep every listing.
+
+    Returns:
+        pathlib.Path: The saved cube, <root>/<yymmdd>/out/cube.npz.
+    """
+    snapshot_dir = pathlib.Path(root) / (date or time.strftime("%y%m%d"))
+    listings = warehouse.read_snapshot(snapshot_dir)
+    listings = listings.dropna(subset=["price", "surface"])
+    if outlier_quantile is not None:
+        listings, _ = outliers.filter_outliers(
+            listings,
+            "price_per_sqm",
+            by=["contract", "city"],
+            method="quantile",
+            upper=outlier_quantile,
+        )
+    cube = Cube.build(listings)
+    path = cube.save(snapshot_dir / "out" / CUBE_FILE)
+    logging.info(
+        f"Aggregated {len(listings)} listings into {len(cube)} cells, "
+        f"{path.stat().st_size / 2**10:.0f} kB"
+    )
+    return path
+
+
+def parse_where(conditions: list) -> dict:
+    """["contract=sale", "rooms=2,3"] -> {"contract": "sale", "rooms": ["2", "3"]}"""
+    where = {}
+    for condition in conditions or []:
+        name, _, value = condition.partition("=")
+        where[name] = value.split(",") if "," in value else value
+    return where
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-aggregated price cube")
+    parser.add_argument("action", choices=["build", "query"])
+    parser.add_argument("--root", type=pathlib.Path, default=LISTINGS_ROOT)
+    parser.add_argument("--date", default=None, help="yymmdd (default: today)")
+    parser.add_argument(
+        "--outlier-quantile",
+        type=float,
+        default=0.99,
+        help="per-city price_per_sqm quantile dropped when building",
+    )
+    parser.add_argument("--by", nargs="*", default=["province", "type", "rooms"])
+    parser.add_argument(
+        "--where", nargs="*", default=[], help="dimension=value[,value...]"
+    )
+    parser.add_argument("--metric", nargs="*", default=None)
+    parser.add_argument("--output", type=pathlib.Path, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.action == "build":
+        snapshot_cube(args.root, args.date, args.outlier_quantile)
+    else:
+        date = args.date or time.strftime("%y%m%d")
+        start = time.perf_counter()
+        cube = Cube.load(pathlib.Path(args.root) / date / "out" / CUBE_FILE)
+        loaded = time.perf_counter()
+        summary = cube.summary(args.by, parse_where(args.where), args.metric)
+        logging.info(
+            f"Loaded {len(cube)} cells in {1000 * (loaded - start):.1f} ms, "
+            f"rolled up to {len(summary)} in "
+            f"{1000 * (time.perf_counter() - loaded):.1f} ms"
+        )
+        if args.output:
+            summary.to_csv(args.output, index=False)
+        else:
+            print(summary.round(2).to_string(index=False))
@@ -4,18 +4,16 @@ from pprint import pprint
 import pandas as pd
 from pathlib import Path
 from tqdm import tqdm
-from downloader import get_neighbourhoods_df, CITY_ID
+from downloader import get_hierarchy, CITY_ID
 
 
-def json_to_csv(file_path, _neighbourhood_data):
+def json_to_csv(file_path, _hierarchy):
     with open(file_path) as f:
         results = json.load(f)['results']
         macrozone_id = file_path.split('_')[-3]
         neighbourhood_id = file_path.split('_')[-2]
-        macrozone_name = _neighbourhood_data.loc[_neighbourhood_data['macrozone_id'] == macrozone_id].iloc[0][
-            'macrozone_name']
-        neighbourhood_name = _neighbourhood_data.loc[_neighbourhood_data['neighbourhood_id'] == neighbourhood_id][
-            'neighbourhood_name'].values[0]
+        macrozone_name = _hierarchy.name('macrozone', macrozone_id)
+        neighbourhood_name = _hierarchy.name('neighbourhood', neighbourhood_id)
         dfs = []
         for result in results:
             data = result['realEstate']
@@ -35,13 +33,14 @@ def json_to_csv(file_path, _neighbourhood_data):
 
 def batch_process_jsons(in_dir):
     print('Getting neighbourhood data...')
-    neighbourhood_data = get_neighbourhoods_df(CITY_ID)
+    city_hierarchy = get_hierarchy(CITY_ID)
     dfs = []
     print('Joining JSON files...')
     for file_path in tqdm(os.listdir(in_dir)):
         input_path = os.path.join(in_dir, file_path)
-        dfs.append(json_to_csv(input_path, neighbourhood_data))
+        dfs.append(json_to_csv(input_path, city_hierarchy))
     return pd.concat(dfs)
 
 
-batch_process_jsons('json_data_sales').drop_duplicates('id').to_csv('data_sales.csv', index=False, encoding='utf-8')
+if __name__ == '__main__':
+    batch_process_jsons('json_data_sales').drop_duplicates('id').to_csv('data_sales.csv', index=False, encoding='utf-8')
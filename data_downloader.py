@@ -1,40 +1,67 @@
 import json
+import os
 import pandas as pd
 import requests
 import pathlib
+import threading
 import time
 import tqdm
 import concurrent.futures
 import logging
+import argparse
+
+import http_cache
+import instrumentation
 
 LISTINGS_ENDPOINT = "https://www.immobiliare.it/api-next/search-list/real-estates/"
-ID_CONTRATTO = 1  # 1 = SALES, 2 = RENTALS
+ID_CONTRATTO = 1  # 1 = SALES, 2 = RENTALS, 14 = AUCTIONS
+ID_CATEGORIA = 1  # 1 = All Houses
+LISTINGS_ROOT = pathlib.Path("./listings/")
+
+# snapshots are partitioned by contract: ./listings/<yymmdd>/json/<contract>/
+CONTRACT_NAMES = {1: "sale", 2: "rent", 14: "auction"}
+
 
+def contract_name(contract_id: int) -> str:
+    return CONTRACT_NAMES.get(int(contract_id), str(contract_id))
 
-def generate_payloads(index: dict) -> dict:
+
+def generate_payloads(
+    index: dict, contract_id: int = None, category_id: int = None
+) -> dict:
     """
     Generate API payloads based on the information contained in a CSV file.
 
     Args:
         row (pd.Series): A pandas series containing the data.
+        contract_id (int): idContratto, used when the index does not carry
+            one. Defaults to ID_CONTRATTO.
+        category_id (int): idCategoria, used when the index does not carry
+            one. Defaults to ID_CATEGORIA.
 
     Returns:
         dict: An API payload.
     """
+    contract_id = index.get("contract_id", contract_id)
+    category_id = index.get("category_id", category_id)
+    contract_id = ID_CONTRATTO if contract_id is None else int(contract_id)
+    category_id = ID_CATEGORIA if category_id is None else int(category_id)
     payload = {
         "fkRegione": index["region_id"],
         "idProvincia": index["province_id"],
         "idComune": int(index["city_id"]),
         "idNazione": "IT",
-        "idContratto": ID_CONTRATTO,
-        "idCategoria": 1,
+        "idContratto": contract_id,
+        "idCategoria": category_id,
         "criterio": "rilevanza",
-        "noAste": 1,
         "__lang": "it",
         "pag": index.get("page_num", 0),
         "paramsCount": 1,
         "path": "%2F",
     }
+    # auctions are only listed when they are not filtered out
+    if contract_id != 14:
+        payload["noAste"] = 1
 
     if index["macrozone_id"] != 0:
         payload.update(
@@ -47,10 +74,90 @@ def generate_payloads(index: dict) -> dict:
     return payload
 
 
-def get_data(row: pd.Series, session: requests.Session) -> list:
-    response = session.get(LISTINGS_ENDPOINT, params=generate_payloads(row))
+class RateLimiter:
+    """
+    Token bucket shared by every thread of a crawl.
+
+    Args:
+        rate (float): Requests per second.
+        burst (int): Requests allowed at once after an idle period.
+    """
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            # the token is reserved now, callers queue up behind each other
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            instrumentation.count("rate_limit_wait_seconds_total", wait)
+            time.sleep(wait)
+
+
+class CrawlSession(http_cache.CachedSession):
+    """
+    Session shared by all the workers of a crawl.
+
+    The connection pool of the configured transport (see transport.py) is
+    sized for the number of workers, and every request that reaches the
+    network draws from the same RateLimiter when a rate is given. Responses
+    served by the HTTP cache are not rate limited.
+    """
+
+    def __init__(
+        self, workers: int = 10, rate: float = None, cache: http_cache.HTTPCache = None
+    ):
+        super().__init__(cache, pool_size=workers)
+        self.rate_limiter = RateLimiter(rate) if rate else None
+
+    def fetch(self, request, **kwargs):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return super().fetch(request, **kwargs)
+
+
+def probe_tasks(
+    macrozone_df: pd.DataFrame, contracts: list = None, categories: list = None
+) -> list:
+    """
+    List one probe per neighbourhood, contract and category.
+
+    The contracts and categories of a neighbourhood are adjacent, so the crawls
+    are interleaved instead of run one after the other.
+    """
+    contracts = contracts or [ID_CONTRATTO]
+    categories = categories or [ID_CATEGORIA]
+    return [
+        (row, contract_id, category_id)
+        for _, row in macrozone_df.iterrows()
+        for contract_id in contracts
+        for category_id in categories
+    ]
+
+
+@instrumentation.hot
+def get_data(
+    row: pd.Series,
+    session: requests.Session,
+    contract_id: int = None,
+    category_id: int = None,
+) -> list:
+    payload = generate_payloads(row, contract_id, category_id)
+    response = session.get(LISTINGS_ENDPOINT, params=payload)
     try:
-        data = response.json()
+        with instrumentation.span("json_decode", stage="index"):
+            data = response.json()
         max_pages = data.get("maxPages", 0)
         indexes = []
         for page in range(1, max_pages + 1):
@@ -61,6 +168,8 @@ def get_data(row: pd.Series, session: requests.Session) -> list:
                     "city_id": row.get("city_id", None),
                     "macrozone_id": row.get("macrozone_id", None),
                     "neighbourhood_id": row.get("neighbourhood_id", None),
+                    "contract_id": payload["idContratto"],
+                    "category_id": payload["idCategoria"],
                     "page_num": page,
                 }
             )
@@ -69,14 +178,37 @@ def get_data(row: pd.Series, session: requests.Session) -> list:
         return (row["city_name"], row["macrozone_name"])
 
 
-def build_indexes(macrozone_df: pd.DataFrame) -> list:
+def build_indexes(
+    macrozone_df: pd.DataFrame,
+    contracts: list = None,
+    categories: list = None,
+    workers: int = None,
+    rate: float = None,
+) -> list:
+    """
+    Probe every neighbourhood and list the pages to download.
+
+    Args:
+        macrozone_df (pd.DataFrame): The index table rows to probe.
+        contracts (list): idContratto values, [ID_CONTRATTO] when not given.
+        categories (list): idCategoria values, [ID_CATEGORIA] when not given.
+        workers (int): Probing threads, the executor default when not given.
+        rate (float): Maximum requests per second, None for no limit.
+
+    Returns:
+        list: One index dict per page, carrying its contract and category.
+    """
     indexes = []
     errors = []
-    with requests.Session() as session:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
+    tasks = probe_tasks(macrozone_df, contracts, categories)
+    with instrumentation.span("build_indexes"), CrawlSession(
+        workers or 32, rate
+    ) as session:
+        instrumentation.instrument_session(session, "index")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
             futures = {
-                executor.submit(get_data, row, session): row
-                for _, row in macrozone_df.iterrows()
+                instrumentation.submit(executor, get_data, row, session, *task): row
+                for row, *task in tasks
             }
             for future in tqdm.tqdm(
                 concurrent.futures.as_completed(futures),
@@ -98,26 +230,72 @@ def build_indexes(macrozone_df: pd.DataFrame) -> list:
     return indexes
 
 
+def page_path(index: dict, save_path: pathlib.Path) -> pathlib.Path:
+    """
+    Where a page is saved: the contract's partition of the snapshot, under
+    <region>_<province>_<city>_<macrozone>_<neighbourhood>_<category>_<page>.json
+    """
+    return (
+        save_path
+        / contract_name(index.get("contract_id", ID_CONTRATTO))
+        / f"{index['region_id']}_{index['province_id']}_{index['city_id']}_{index['macrozone_id']}_{index['neighbourhood_id']}_{index.get('category_id', ID_CATEGORIA)}_{index['page_num']}.json"
+    )
+
+
+@instrumentation.hot
 def download_listings_page(
     index: dict, session: requests.Session, save_path: pathlib.Path
 ) -> None:
     response = session.get(LISTINGS_ENDPOINT, params=generate_payloads(index))
-    with open(
-        save_path
-        / f"{index['region_id']}_{index['province_id']}_{index['city_id']}_{index['macrozone_id']}_{index['neighbourhood_id']}_{index['page_num']}.json",
-        "w",
-    ) as f:
-        json.dump(response.json(), f)
+    with instrumentation.span("json_decode", stage="download"):
+        data = response.json()
+    path = page_path(index, save_path)
+    # a new file replaces the page, so copies of it elsewhere are left intact
+    tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+    with instrumentation.span("disk_write", stage="download"):
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+            instrumentation.count("bytes_written_total", f.tell(), stage="download")
+        os.replace(tmp_path, path)
 
 
-def download_listings(indexes: list) -> None:
-    save_path = pathlib.Path(f"./listings/{time.strftime('%y%m%d')}/json/")
-    save_path.mkdir(parents=True, exist_ok=True)
+def snapshot_json_path(root: pathlib.Path, contracts, date: str = None) -> pathlib.Path:
+    save_path = pathlib.Path(root) / (date or time.strftime("%y%m%d")) / "json"
+    for contract_id in set(contracts):
+        (save_path / contract_name(contract_id)).mkdir(parents=True, exist_ok=True)
+    return save_path
+
+
+def download_listings(
+    indexes: list,
+    workers: int = 10,
+    root: pathlib.Path = LISTINGS_ROOT,
+    rate: float = None,
+    date: str = None,
+) -> None:
+    """
+    Download every indexed page into a snapshot.
 
-    with requests.Session() as session:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+    Args:
+        indexes (list): Pages to download, as returned by build_indexes.
+        workers (int): Download threads.
+        root (pathlib.Path): Directory holding the daily snapshots.
+        rate (float): Maximum requests per second, None for no limit.
+        date (str): Snapshot to download into, yymmdd, today if None.
+    """
+    save_path = snapshot_json_path(
+        root, (index.get("contract_id", ID_CONTRATTO) for index in indexes), date
+    )
+
+    with instrumentation.span("download_listings"), CrawlSession(
+        workers, rate
+    ) as session:
+        instrumentation.instrument_session(session, "download")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
             futures = [
-                executor.submit(download_listings_page, index, session, save_path)
+                instrumentation.submit(
+                    executor, download_listings_page, index, session, save_path
+                )
                 for index in indexes
             ]
             for future in tqdm.tqdm(
@@ -129,8 +307,96 @@ def download_listings(indexes: list) -> None:
                 try:
                     future.result()
                 except Exception as e:
+                    instrumentation.count("errors_total", stage="download")
                     print(f"Exception occurred in worker thread: {e}")
 
 
+def crawl(
+    macrozone_df: pd.DataFrame,
+    contracts: list = None,
+    categories: list = None,
+    workers: int = 10,
+    root: pathlib.Path = LISTINGS_ROOT,
+    rate: float = None,
+    date: str = None,
+) -> list:
+    """
+    Probe and download every contract and category in a single pass.
+
+    All the requests go through one executor, one connection pool and one
+    rate budget, and the pages of a neighbourhood are queued as soon as its
+    probe returns, so the workers never wait for a stage to finish.
+
+    Args:
+        macrozone_df (pd.DataFrame): The index table rows to crawl.
+        contracts (list): idContratto values, [ID_CONTRATTO] when not given.
+        categories (list): idCategoria values, [ID_CATEGORIA] when not given.
+        workers (int): Threads shared by probes and downloads.
+        root (pathlib.Path): Directory holding the daily snapshots.
+        rate (float): Maximum requests per second, None for no limit.
+        date (str): Snapshot to download into, yymmdd, today if None.
+
+    Returns:
+        list: The index dicts of the pages downloaded.
+    """
+    tasks = probe_tasks(macrozone_df, contracts, categories)
+    save_path = snapshot_json_path(
+        root, (contract_id for _, contract_id, _ in tasks), date
+    )
+    indexes = []
+    errors = []
+
+    with instrumentation.span("crawl"), CrawlSession(workers, rate) as session:
+        instrumentation.instrument_session(session, "crawl")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {
+                instrumentation.submit(executor, get_data, row, session, *task): row
+                for row, *task in tasks
+            }
+            progress = tqdm.tqdm(total=len(pending), desc="Crawling", smoothing=0.05)
+            while pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    del pending[future]
+                    progress.update()
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        instrumentation.count("errors_total", stage="crawl")
+                        print(f"Exception occurred in worker thread: {e}")
+                        continue
+                    # probes return the pages to queue, downloads return None
+                    if isinstance(result, tuple):
+                        errors.append(result)
+                    elif result:
+                        indexes.extend(result)
+                        progress.total += len(result)
+                        for index in result:
+                            future = instrumentation.submit(
+                                executor,
+                                download_listings_page,
+                                index,
+                                session,
+                                save_path,
+                            )
+                            pending[future] = None
+            progress.close()
+
+    if errors:
+        logging.info(f"Could not parse {len(errors)} macrozones:")
+        for error in errors:
+            logging.info(f"{error[0]} {error[1]}")
+
+    return indexes
+
+
 if __name__ == "__main__":
-    pass
+    parser = argparse.ArgumentParser(description="Crawl the listings of every city")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumentation.from_args(args):
+        macrodata = pd.read_csv("./table_builder/index_table.csv")
+        crawl(macrodata)
@@ -1,62 +1,223 @@
 #This file may not be useful to the reader. I was playing around with ML and needed a way to format the dataset.
+#
+# Builds training_data.csv from data_sales.csv. Every column is a feature of
+# feature_store, cached between runs, so a run only recomputes the columns whose
+# definition or listings changed, and adding a landmark only asks TravelTime
+# for the travel times to it. The landmarks missing some listings are timed
+# together by traveltime_api_caller.travel_time_matrix:
+#
+#   python data_manipulator.py data_sales.csv
+#   python data_manipulator.py data_sales.csv --landmark castello=45.4705,9.1794
+#   python data_manipulator.py data_sales.csv --category 1 --typology 14 7
+#   TRAVELTIME_URL=http://127.0.0.1:8042/v4/time-filter \
+#       python data_manipulator.py data_sales.csv --rate 5   # standin_server.py
+
+import argparse
+import logging
+import pathlib
 
-import math
-from scipy import stats
-import pandas as pd
 import numpy as np
-from traveltime_api_caller import call_traveltime_api
-
-def chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
-
-
-# Select Rows
-
-df = pd.read_csv('data_sales.csv', low_memory=False)
-
-rows_selection = df.loc[(df['category.id'] == 1) & (df['typology.id'] == 14)]
-
-df_subset = rows_selection.loc[:, ['bathrooms', 'rooms', 'surface', 'floor.abbreviation',
-                                   'location.latitude', 'location.longitude', 'price.value']]
-
-df_subset = df_subset.dropna()
-
-df_subset['surface'] = df_subset['surface'].replace({'m²': ''}, regex=True).fillna(0).map(
-    lambda x: x.replace('.', '') if isinstance(x, str) else x).map(lambda x: int(x))
-df_subset['floor.abbreviation'] = df_subset['floor.abbreviation'].replace({' - ': ',', 'S': '0', 'T': '0', 'R': '0'},
-                                                                          regex=True).map(
-    lambda x: max(int(i) for i in x.split(',')))
-df_subset['bathrooms'] = df_subset['bathrooms'].map(lambda x: x.strip('+')).map(lambda x: int(x))
-df_subset['rooms'] = df_subset['rooms'].map(lambda x: x.strip('+')).map(lambda x: int(x))
-df_subset['price.value'] = df_subset['price.value'].map(lambda x: int(x))
-df_subset = pd.DataFrame(df_subset)
-df_subset = df_subset[(np.abs(stats.zscore(df_subset)) < 2.75).all(axis=1)]
-
-
-def get_coordinates(df):
-    return [{"id": str(index), "coords": {"lat": row['location.latitude'], "lng": row['location.longitude']}} for
-            index, row in df.iterrows()]
-
-
-duomo = {"id": 'arrival', "coords": {"lat": 45.464195, "lng": 9.189481}}
-navigli = {"id": 'arrival', "coords": {"lat": 45.450717, "lng": 9.169698}}
-garibaldi = {"id": 'arrival', "coords": {"lat": 45.483239, "lng": 9.187928}}
-
-landmarks = [duomo, navigli, garibaldi]
-
-departures = get_coordinates(df_subset)
-for landmark in landmarks:
-    for chunk in chunks(departures, 1999):
-        coordinates = chunk
-        coordinates.append(landmark)
-        result = call_traveltime_api(coordinates)
-        traveltime_array = result['results'][0]['locations']
-        for i, traveltime in enumerate(traveltime_array):
-            df_subset.loc[int(traveltime['id']), f'time_to_landmark{i}'] = traveltime['properties'][0]['travel_time']
-        print(f'Done with {landmark["id"]}')
-stats = df_subset.describe()
+import pandas as pd
 
-df_subset.to_csv('training_data.csv', index=False, encoding='utf-8')
-print(df)
+from data_processor import extract_numbers, floor_levels
+from feature_store import STORE_PATH, Feature, FeatureStore
+from outliers import filter_outliers
+
+LANDMARKS = {
+    "duomo": (45.464195, 9.189481),
+    "navigli": (45.450717, 9.169698),
+    "garibaldi": (45.483239, 9.187928),
+}
+CATEGORIES = [1]
+TYPOLOGIES = [14]
+ZSCORE_THRESHOLD = 2.75
+
+
+def listing_features() -> list:
+    """The columns parsed from the listings, named as in data_sales.csv."""
+    return [
+        Feature(
+            "surface",
+            ["surface"],
+            lambda df: extract_numbers(df["surface"], thousands=True),
+        ),
+        Feature(
+            "floor.abbreviation",
+            ["floor.abbreviation"],
+            lambda df: floor_levels(df["floor.abbreviation"]).to_numpy(np.float64),
+        ),
+        Feature(
+            "bathrooms", ["bathrooms"], lambda df: extract_numbers(df["bathrooms"])
+        ),
+        Feature("rooms", ["rooms"], lambda df: extract_numbers(df["rooms"])),
+        Feature(
+            "location.latitude",
+            ["location.latitude"],
+            lambda df: df["location.latitude"].to_numpy(np.float64),
+        ),
+        Feature(
+            "location.longitude",
+            ["location.longitude"],
+            lambda df: df["location.longitude"].to_numpy(np.float64),
+        ),
+        Feature(
+            "price.value",
+            ["price.value"],
+            lambda df: pd.to_numeric(df["price.value"]).to_numpy(np.float64),
+        ),
+    ]
+
+
+def landmark_feature(name: str, coordinates: tuple, times: dict) -> Feature:
+    """
+    Travel time to a landmark, reusing the listings that did not move. The
+    times of the listings to compute are fetched by landmark_times.
+    """
+    latitude, longitude = coordinates
+    return Feature(
+        f"time_to_{name}",
+        ["location.latitude", "location.longitude"],
+        lambda df: times[name][df.index],
+        params={"lat": latitude, "lng": longitude},
+        rowwise=True,
+    )
+
+
+def landmark_times(
+    store: FeatureStore,
+    listings: pd.DataFrame,
+    landmarks: dict,
+    workers: int = 4,
+    rate: float = None,
+) -> pd.DataFrame:
+    """
+    Public transport travel times from the listings to every landmark.
+
+    The listings that any landmark is missing are timed to all such landmarks
+    in one travel_time_matrix, which packs the landmarks in each request.
+
+    Returns:
+        pd.DataFrame: Seconds, a time_to_<landmark> column per landmark,
+            indexed by listing id. NaN for listings with no route.
+    """
+    from traveltime_api_caller import travel_time_matrix
+
+    times = {name: np.full(len(listings), np.nan) for name in landmarks}
+    names = {}
+    for name, coordinates in landmarks.items():
+        feature = landmark_feature(name, coordinates, times)
+        store.register(feature)
+        names[name] = feature.name
+    stale = store.stale(listings, list(names.values()))
+    pending = [name for name in landmarks if len(stale[names[name]])]
+    if pending:
+        rows = np.unique(np.concatenate([stale[names[name]] for name in pending]))
+        coordinates = listings[["location.latitude", "location.longitude"]]
+        matrix = travel_time_matrix(
+            coordinates.to_numpy(np.float64)[rows],
+            [landmarks[name] for name in pending],
+            workers=workers,
+            rate=rate,
+        )
+        for name, row in zip(pending, matrix):
+            times[name][rows] = row
+    return store.build(listings, list(names.values()))
+
+
+def training_data(
+    df: pd.DataFrame,
+    store: FeatureStore,
+    landmarks: dict = LANDMARKS,
+    categories: list = CATEGORIES,
+    typologies: list = TYPOLOGIES,
+    workers: int = 4,
+    rate: float = None,
+) -> pd.DataFrame:
+    """
+    Training rows of the listings of some categories and typologies.
+
+    Listings missing any of the listing features (penthouses have no floor
+    level) and z-score outliers are dropped before asking for travel times.
+
+    Args:
+        df (pd.DataFrame): data_sales.csv.
+        store (FeatureStore): Where the features are cached.
+        landmarks (dict): (latitude, longitude) of each landmark by name.
+        categories (list): category.id values kept.
+        typologies (list): typology.id values kept.
+        workers (int): TravelTime requests in flight at once.
+        rate (float): Maximum TravelTime requests per second.
+
+    Returns:
+        pd.DataFrame: The listing features, then a time_to_<landmark> column
+            per landmark, indexed by listing id.
+    """
+    listings = df[
+        df["category.id"].isin(categories) & df["typology.id"].isin(typologies)
+    ].drop_duplicates("id", keep="last")
+
+    base = listing_features()
+    for feature in base:
+        store.register(feature)
+    data = store.build(listings, [feature.name for feature in base]).dropna()
+    data = data.astype(
+        {"surface": int, "floor.abbreviation": int, "bathrooms": int, "rooms": int}
+    )
+    data["price.value"] = data["price.value"].astype(int)
+    data, _ = filter_outliers(
+        data, list(data.columns), method="zscore", threshold=ZSCORE_THRESHOLD
+    )
+
+    kept = listings.set_index("id").loc[data.index].reset_index()
+    return data.join(landmark_times(store, kept, landmarks, workers, rate))
+
+
+def landmark(value: str) -> tuple:
+    """Parse name=latitude,longitude."""
+    name, _, coordinates = value.partition("=")
+    try:
+        latitude, longitude = (float(part) for part in coordinates.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected name=lat,lng, got {value!r}")
+    return name, (latitude, longitude)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the ML training data")
+    parser.add_argument("csv", nargs="?", default="data_sales.csv")
+    parser.add_argument("--output", default="training_data.csv")
+    parser.add_argument("--store", type=pathlib.Path, default=STORE_PATH)
+    parser.add_argument("--category", type=int, nargs="+", default=CATEGORIES)
+    parser.add_argument("--typology", type=int, nargs="+", default=TYPOLOGIES)
+    parser.add_argument(
+        "--landmark",
+        type=landmark,
+        action="append",
+        default=[],
+        help="name=lat,lng, added to the default landmarks (repeatable)",
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rate", type=float, help="TravelTime requests per second")
+    parser.add_argument(
+        "--no-default-landmarks",
+        action="store_true",
+        help=f"Leave out {', '.join(LANDMARKS)}",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    landmarks = {} if args.no_default_landmarks else dict(LANDMARKS)
+    landmarks.update(args.landmark)
+    store = FeatureStore(args.store)
+    data = training_data(
+        pd.read_csv(args.csv, low_memory=False),
+        store,
+        landmarks,
+        args.category,
+        args.typology,
+        args.workers,
+        args.rate,
+    )
+    print(data.describe())
+    print(store.report)
+    data.to_csv(args.output, index=False, encoding="utf-8")
@@ -1,92 +1,286 @@
 import json
+import numpy as np
 import pandas as pd
 import pathlib
 import time
-import re
 import tqdm
+import argparse
 
+import instrumentation
+import outliers
 
-def parse_result(result: dict) -> dict:
-    real_estate = result.get("realEstate", {})
-    properties = real_estate.get("properties", [{}])[0]
-    location = properties.get("location", {})
-    price = real_estate.get("price", {})
-    floor_info = properties.get("floor", {})
-    typology = properties.get("typology", {})
-
-    id = real_estate.get("id")
-    city = location.get("city")
-    macrozone = location.get("macrozone")
-    neighbourhood = location.get("microzone")
-    price_value = price.get("value")
-    surface_string = properties.get("surface")
-    rooms_string = properties.get("rooms")
-    floor = floor_info.get("abbreviation")
-    type = typology.get("name")
-
-    surface = (
-        int(re.search(r"-?\d+(\.\d+)?", str(surface_string)).group().replace(".", ""))
-        if surface_string
-        else None
+LISTINGS_ROOT = pathlib.Path("./listings/")
+
+# first number of a string, e.g. 85 in "85 m²" or 1.200 in "1.200 m²"
+NUMBER = r"(-?\d+(?:\.\d+)?)"
+# levels of the floor abbreviations that are not numbers: basements (S, S2,
+# ...), ground (T) and raised ground floors (R, the mezzanine) count as 0,
+# the penthouse (A, attico) has no level
+FLOOR_CODES = {"S": 0, "S2": 0, "S3": 0, "S4": 0, "T": 0, "R": 0, "A": None}
+COLUMNS = [
+    "id",
+    "city",
+    "macrozone",
+    "neighbourhood",
+    "latitude",
+    "longitude",
+    "price",
+    "price_per_sqm",
+    "surface",
+    "rooms",
+    "floor",
+    "type",
+]
+
+
+def extract_numbers(values, thousands: bool = False) -> np.ndarray:
+    """
+    First number of every value, parsed once per distinct value.
+
+    Args:
+        values: Strings (or numbers) such as "85 m²", "5+" or "2 - 4".
+        thousands (bool): Read "." as a thousands separator, "1.200" -> 1200.
+
+    Returns:
+        np.ndarray: float64 numbers, NaN for missing or empty values and
+            values without digits.
+    """
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    numbers = (
+        pd.Index(uniques, dtype=object).astype(str).str.extract(NUMBER, expand=False)
     )
-    rooms = (
-        int(re.search(r"-?\d+(\.\d+)?", str(rooms_string)).group())
-        if rooms_string
-        else None
+    if thousands:
+        numbers = numbers.str.replace(".", "", regex=False)
+    # missing values have code -1, which takes the trailing NaN
+    numbers = np.append(pd.to_numeric(numbers).to_numpy(np.float64), np.nan)
+    return numbers[codes]
+
+
+def floor_level(abbreviation: str) -> float:
+    """Level of a floor abbreviation, the highest floor of ranges ("S - 4")."""
+    levels = []
+    for part in str(abbreviation).split(" - "):
+        part = part.strip().rstrip("+")
+        level = FLOOR_CODES.get(part, part)
+        try:
+            levels.append(float(level))
+        except (TypeError, ValueError):
+            continue
+    return max(levels) if levels else np.nan
+
+
+def floor_levels(floors: pd.Series) -> pd.Series:
+    """
+    Turn floor abbreviations into numeric levels with FLOOR_CODES.
+
+    Ranges take their highest floor and "11+" counts as 11. The few distinct
+    abbreviations are looked up once and the levels taken from them.
+    """
+    codes, uniques = pd.factorize(floors)
+    levels = np.array([floor_level(floor) for floor in uniques] + [np.nan])
+    return pd.Series(levels[codes], index=floors.index, dtype=np.float64)
+
+
+def _page_column(
+    numbers: np.ndarray, floats: np.ndarray, pages: np.ndarray
+) -> pd.Series:
+    """
+    The column pandas would build one page at a time and then concatenate.
+
+    A page's column is int64 when all its values are ints, float64 when some
+    are floats or missing and objects when all are missing. Concatenating
+    ignores the all-missing pages when there is a float64 one, otherwise
+    they turn the ints into objects.
+    """
+    missing = np.isnan(numbers)
+    if not missing.any() and not floats.any():
+        return pd.Series(numbers.astype(np.int64))
+    rows = np.bincount(pages)
+    empty_pages = (np.bincount(pages, weights=missing) == rows) & (rows > 0)
+    float_pages = (np.bincount(pages, weights=missing | floats) > 0) & ~empty_pages
+    if float_pages.any() or not empty_pages.any():
+        return pd.Series(numbers)
+    return pd.Series(
+        [None if np.isnan(number) else int(number) for number in numbers.tolist()],
+        dtype=object,
     )
 
-    price_per_sqm = price_value / surface if price_value and surface else None
 
-    return {
-        "id": id,
-        "city": city,
-        "macrozone": macrozone,
-        "neighbourhood": neighbourhood,
-        "price": price_value,
-        "price_per_sqm": price_per_sqm,
-        "surface": surface,
-        "rooms": rooms,
-        "floor": floor,
-        "type": type,
-    }
+def parse_results(results: list, pages: list = None) -> pd.DataFrame:
+    """
+    Parse listing results into a table.
 
+    The fields are collected as raw columns and converted in bulk, so the
+    per-listing work is just reading the JSON.
 
-def parse_listings_page(file_path: pathlib.Path) -> pd.DataFrame:
+    Args:
+        results (list): "results" of one or more listing pages.
+        pages (list): Page of every result, when they come from several
+            pages; the types of the columns follow the concatenation of
+            per-page tables.
+
+    Returns:
+        pd.DataFrame: One row per listing with the COLUMNS columns.
+    """
+    if not results:
+        return pd.DataFrame()
+    raw = {column: [] for column in COLUMNS if column != "price_per_sqm"}
+    for result in results:
+        # recorded pages carry explicit nulls for missing objects, hence the `or {}`
+        real_estate = result.get("realEstate") or {}
+        properties = (real_estate.get("properties") or [{}])[0]
+        location = properties.get("location") or {}
+        raw["id"].append(real_estate.get("id"))
+        raw["city"].append(location.get("city"))
+        raw["macrozone"].append(location.get("macrozone"))
+        raw["neighbourhood"].append(location.get("microzone"))
+        raw["latitude"].append(location.get("latitude"))
+        raw["longitude"].append(location.get("longitude"))
+        raw["price"].append((real_estate.get("price") or {}).get("value"))
+        raw["surface"].append(properties.get("surface"))
+        raw["rooms"].append(properties.get("rooms"))
+        raw["floor"].append((properties.get("floor") or {}).get("abbreviation"))
+        raw["type"].append((properties.get("typology") or {}).get("name"))
+
+    pages = np.zeros(len(results), np.int64) if pages is None else np.asarray(pages)
+    numbers, floats = {}, {}
+    for column in ("id", "latitude", "longitude", "price"):
+        values = pd.Series(raw[column], dtype=object)
+        floats[column] = values.map(type).to_numpy() == float
+        numbers[column] = pd.to_numeric(values, errors="coerce").to_numpy(np.float64)
+    # new developments report the lowest price of the range as a string
+    price = pd.Series(raw["price"], dtype=object)
+    strings = price.map(type).to_numpy() == str
+    if strings.any():
+        digits = price[strings].astype(str).str.isdigit().to_numpy()
+        numbers["price"][np.flatnonzero(strings)[~digits]] = np.nan
+        floats["price"] |= strings
+    numbers["surface"] = extract_numbers(raw["surface"], thousands=True)
+    numbers["rooms"] = extract_numbers(raw["rooms"])
+    price, surface = numbers["price"], numbers["surface"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        price_per_sqm = np.where((price != 0) & (surface != 0), price / surface, np.nan)
+
+    numbers["price_per_sqm"] = price_per_sqm
+    floats["price_per_sqm"] = np.ones(len(results), bool)
+    return pd.DataFrame(
+        {
+            column: (
+                _page_column(
+                    numbers[column],
+                    floats.get(column, np.zeros(len(results), bool)),
+                    pages,
+                )
+                if column in numbers
+                else pd.Series(raw[column], dtype=object)
+            )
+            for column in COLUMNS
+        }
+    )
+
+
+def parse_result(result: dict) -> dict:
+    """Parse a single listing result, see parse_results."""
+    return parse_results([result]).iloc[0].to_dict()
+
+
+def load_results(file_path: pathlib.Path) -> list:
+    """The "results" of a saved listing page, None when it can't be read."""
     with open(file_path, "r") as f:
         try:
-            data = json.load(f)
+            with instrumentation.span("json_decode", stage="compile"):
+                data = json.load(f)
+                instrumentation.count("bytes_read_total", f.tell(), stage="compile")
         except json.decoder.JSONDecodeError:
+            instrumentation.count("errors_total", stage="compile")
             print(f"Could not parse {file_path}")
-            return pd.DataFrame()
+            return None
+    return data.get("results", [])
+
+
+@instrumentation.hot
+def parse_listings_page(file_path: pathlib.Path) -> pd.DataFrame:
+    results = load_results(file_path)
+    with instrumentation.span("parse_results", stage="compile"):
+        return parse_results(results or [])
+
 
-        results = data.get("results", [])
-        parsed_results = [parse_result(result) for result in results]
-        df = pd.DataFrame(parsed_results)
-        return df
+def parse_listings_pages(files: list) -> pd.DataFrame:
+    """
+    Parse several saved listing pages into one table, as concatenating the
+    parse_listings_page tables would, but converting the columns only once.
+    """
+    results, pages = [], []
+    for page, file_path in enumerate(files):
+        page_results = load_results(file_path) or []
+        results.extend(page_results)
+        pages.extend([page] * len(page_results))
+    with instrumentation.span("parse_results", stage="compile"):
+        return parse_results(results, pages)
 
 
-def compile_city_tables() -> None:
-    json_path = pathlib.Path(f"./listings/{time.strftime('%y%m%d')}/json/")
-    json_files = [path for path in json_path.glob("*.json")]
-    indexes = {path.stem[:6] for path in json_files}
-    save_path = pathlib.Path(f"./listings/{time.strftime('%y%m%d')}/csv/")
+def partition(
+    root: pathlib.Path, date: str, dataset: str, contract: str
+) -> pathlib.Path:
+    """Path of ./listings/<yymmdd>/<dataset>/<contract>/, e.g. json/rent/."""
+    return pathlib.Path(root) / (date or time.strftime("%y%m%d")) / dataset / contract
+
+
+@instrumentation.traced()
+def compile_city_tables(
+    root: pathlib.Path = LISTINGS_ROOT, date: str = None, contract: str = "sale"
+) -> None:
+    """
+    Parse a snapshot's JSON pages into one CSV per city.
+
+    Args:
+        root (pathlib.Path): Directory holding the daily snapshots.
+        date (str): Snapshot to compile (yymmdd), today when not given.
+        contract (str): Contract partition to compile (sale, rent, auction).
+    """
+    json_path = partition(root, date, "json", contract)
+    save_path = partition(root, date, "csv", contract)
     save_path.mkdir(parents=True, exist_ok=True)
-    df = pd.DataFrame()
-    for index in tqdm.tqdm(indexes, desc="Compiling city tables"):
-        json_files = [
-            path for path in json_path.glob("*.json") if path.stem[:6] == index
-        ]
+    # group the pages by city, the files are named <region>_<province>_...
+    json_files = {}
+    for path in json_path.glob("*.json"):
+        json_files.setdefault(path.stem[:6], []).append(path)
+    for index, files in tqdm.tqdm(json_files.items(), desc="Compiling city tables"):
+        df = parse_listings_pages(files)
+        if df.empty:
+            continue
+        df = df.dropna(subset=["price", "surface"])
+        with instrumentation.span("disk_write", stage="compile"):
+            df.to_csv(save_path / f"{index}.csv", index=False)
+
 
-        dfs = [parse_listings_page(json_file) for json_file in json_files]
-        df = pd.concat(dfs)
-    df = df.dropna(subset=["price", "surface"])
-    df.to_csv(save_path / f"{index}.csv", index=False)
+@instrumentation.traced()
+def compile_macrozone_summary_table(
+    root: pathlib.Path = LISTINGS_ROOT,
+    date: str = None,
+    contract: str = "sale",
+    dedupe: bool = False,
+) -> pd.DataFrame:
+    """
+    Summarise price, price_per_sqm and surface by macrozone for a snapshot.
 
+    Args:
+        root (pathlib.Path): Directory holding the daily snapshots.
+        date (str): Snapshot to summarise (yymmdd), today when not given.
+        contract (str): Contract partition to summarise (sale, rent, auction).
+        dedupe (bool): Count each cluster of near-duplicate listings once,
+            using the clusters saved by near_duplicates.snapshot_clusters.
 
-def compile_macrozone_summary_table():
-    csv_path = pathlib.Path(f"./listings/{time.strftime('%y%m%d')}/csv/")
-    save_path = pathlib.Path(f"./listings/{time.strftime('%y%m%d')}/out/")
+    Returns:
+        pd.DataFrame: The summary, also saved as out/<contract>/summary_table.csv.
+    """
+    csv_path = partition(root, date, "csv", contract)
+    save_path = partition(root, date, "out", contract)
     save_path.mkdir(parents=True, exist_ok=True)
+    if dedupe:
+        import near_duplicates
+
+        clusters = pd.read_csv(save_path / near_duplicates.CLUSTERS_FILE)
     macrozone_summary = pd.DataFrame(
         columns=[
             "city_name",
@@ -129,8 +323,15 @@ def compile_macrozone_summary_table():
     ):
         city_data = pd.read_csv(csv_file)
         city_data = city_data.dropna(subset=["price", "surface"])
+        if dedupe:
+            city_data = near_duplicates.deduplicate(city_data, clusters)
         city_name = city_data["city"].iloc[0]
 
+        # eliminate outliers
+        city_data, _ = outliers.filter_outliers(
+            city_data, "price_per_sqm", by="city", method="quantile", upper=0.99
+        )
+
         macrozone_data = city_data.groupby("macrozone").agg(
             {
                 "price": ["mean", "median", "std", "min", "max", q50, q90],
@@ -170,13 +371,18 @@ def compile_macrozone_summary_table():
             )
 
     macrozone_summary = macrozone_summary.round(2)
-    macrozone_summary.to_csv(
-        f"./listings/{time.strftime('%y%m%d')}/out/summary_table.csv", index=False
-    )
+    macrozone_summary.to_csv(save_path / "summary_table.csv", index=False)
 
     return macrozone_summary
 
 
 if __name__ == "__main__":
-    compile_city_tables()
-    compile_macrozone_summary_table()
+    parser = argparse.ArgumentParser(description="Compile today's listings tables")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumentation.from_args(args):
+        json_path = LISTINGS_ROOT / time.strftime("%y%m%d") / "json"
+        for contract in sorted(path.name for path in json_path.iterdir()):
+            compile_city_tables(contract=contract)
+            compile_macrozone_summary_table(contract=contract)
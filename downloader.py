@@ -1,15 +1,17 @@
 import json
-import requests
+import os
+import http_cache
+import hierarchy
 import itertools
-import pandas as pd
 from pprint import pprint
 from tqdm import tqdm, trange
 from itertools import product
+from functools import partial
 from concurrent.futures import ThreadPoolExecutor
 
-# TODO: fix hardcoded values for contratto and categoria
-
 CITY_ID = 8042
+MACROZONES_ENDPOINT = 'https://www.immobiliare.it/search/macrozones'
+LISTINGS_ENDPOINT = 'https://www.immobiliare.it/api-next/search-list/real-estates/'
 
 
 # Immobiliare.it does not show us all the listings in a given city just by searching for it: only ~2k listings are shown
@@ -21,34 +23,15 @@ CITY_ID = 8042
 # The API answer with a *.JSON file containing all the 'macrozone' and 'neighbourhoods' in the city,
 # together with their corresponding IDs.
 
-def get_neighbourhoods_df(_city_id):
+def get_hierarchy(_city_id):
     print("Getting neighbourhoods list...")
-    response = requests.get(f'https://www.immobiliare.it/search/macrozones?id={_city_id}&type=3')
-    data = response.json()
-    city_name = data['label']
-    city_id = data['id']
-    province_name = data['parents'][0]['label']
-    province_id = data['parents'][0]['id']
-    region_name = data['parents'][1]['label']
-    region_id = data['parents'][1]['id']
-    rows = []
-    for macrozone in data['macrozones']:
-        macrozone_name = macrozone['label']
-        macrozone_id = macrozone['id']
-        for neighbourhood in macrozone['children']:
-            neighbourhood_name = neighbourhood['label']
-            neighbourhood_id = neighbourhood['id']
-            rows.append({'region_name': region_name,
-                         'region_id': region_id,
-                         'province_name': province_name,
-                         'province_id': province_id,
-                         'city_name': city_name,
-                         'city_id': city_id,
-                         'macrozone_name': macrozone_name,
-                         'macrozone_id': macrozone_id,
-                         'neighbourhood_name': neighbourhood_name,
-                         'neighbourhood_id': neighbourhood_id})
-    return pd.DataFrame(rows)
+    response = http_cache.get(MACROZONES_ENDPOINT, params={'id': _city_id, 'type': 3})
+    return hierarchy.Hierarchy.from_city_info(response.json())
+
+
+# Same rows as index_table.csv, one per neighbourhood
+def get_neighbourhoods_df(_city_id):
+    return get_hierarchy(_city_id).to_frame()
 
 
 # This is the url to call to get the listings:
@@ -74,7 +57,7 @@ def call_API(_region_id, _province_id, _city_id, _macrozone_id, _neighbourhood_i
                'paramsCount': 1,
                'path': '%2F'}
 
-    return requests.get('https://www.immobiliare.it/api-next/search-list/real-estates/', params=payload)
+    return http_cache.get(LISTINGS_ENDPOINT, params=payload)
 
 
 # I will call the API on every neighbourhood and parse the number of pages that neighbourhood gives us.
@@ -105,22 +88,30 @@ def build_indexes(df):
 
 # Now I can use multithreading to send the requests and save responses as *.JSON for further processing
 # Region, province and city IDs are coded as to avoid passing further args to the function, will have to
-# fix sometimes in the future.
-# TODO: fix hardcoded values in downloader.multithread_api_call
+# fix sometimes in the future. Pages are saved in one directory per contract.
+# The single-pass crawl of several contracts lives in data_downloader.crawl.
+
+OUTPUT_DIRS = {1: 'json_data_sales', 2: 'json_data_rentals', 14: 'json_data_auctions'}
 
-def multithread_api_call(index):
-    response = call_API('lom', 'MI', CITY_ID, index[0], index[1], 2, 1, index[2])
-    with open(f'json_data_rentals/json_data_{index[0]}_{index[1]}_{index[2]}.json', 'w') as outfile:
+
+def multithread_api_call(index, _contract_id=2, _category_id=1):
+    response = call_API('lom', 'MI', CITY_ID, index[0], index[1], _contract_id, _category_id, index[2])
+    with open(f'{OUTPUT_DIRS[_contract_id]}/json_data_{index[0]}_{index[1]}_{index[2]}.json', 'w') as outfile:
         json.dump(response.json(), outfile)
     return True
 
 
-def multithread_api_caller():
+def multithread_api_caller(_contract_id=2, _category_id=1):
     neighbourhoods_data = get_neighbourhoods_df(CITY_ID)
-    pages_data = probe_neighbourhoods(neighbourhoods_data, 2, 1)
+    pages_data = probe_neighbourhoods(neighbourhoods_data, _contract_id, _category_id)
     threading_indexes = build_indexes(pages_data)
+    # only json_data_sales and json_data_rentals ship with the repository
+    os.makedirs(OUTPUT_DIRS[_contract_id], exist_ok=True)
     print('Downloading data...')
     with ThreadPoolExecutor() as t:
-        t.map(multithread_api_call, threading_indexes)
+        t.map(partial(multithread_api_call, _contract_id=_contract_id, _category_id=_category_id),
+              threading_indexes)
+
 
-multithread_api_caller()
+if __name__ == '__main__':
+    multithread_api_caller()
@@ -10,6 +10,11 @@ import pprint
 import tqdm
 import concurrent.futures
 import logging 
+import argparse
+
+import http_cache
+import instrumentation
+import outliers
 
 AUTOCOMPLETE_ENDPOINT = "https://www.immobiliare.it/search/autocomplete"
 LISTINGS_ENDPOINT = "https://www.immobiliare.it/api-next/search-list/real-estates/"
@@ -88,10 +93,12 @@ def generate_payloads(index: dict) -> dict:
 ##    return indexes
 
 
+@instrumentation.hot
 def get_data(row: pd.Series, session: requests.Session) -> list:
     response = session.get(LISTINGS_ENDPOINT, params=generate_payloads(row))
     try: 
-        data = response.json()
+        with instrumentation.span("json_decode", stage="index"):
+            data = response.json()
         #print(f"URL: \t{response.url}")
         #pprint.pprint(data)
         max_pages = data.get("maxPages", 0)
@@ -114,9 +121,10 @@ def get_data(row: pd.Series, session: requests.Session) -> list:
 def build_indexes(macrozone_df: pd.DataFrame) -> list:
     indexes = []
     errors = []
-    with requests.Session() as session:
+    with instrumentation.span("build_indexes"), http_cache.CachedSession() as session:
+        instrumentation.instrument_session(session, "index")
         with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = {executor.submit(get_data, row, session): row for _, row in macrozone_df.iterrows()}
+            futures = {instrumentation.submit(executor, get_data, row, session): row for _, row in macrozone_df.iterrows()}
             for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="Building indexes", smoothing=0.05):
                 result = future.result()
                 if isinstance(result, list):
@@ -132,26 +140,33 @@ def build_indexes(macrozone_df: pd.DataFrame) -> list:
     return indexes
 
 
+@instrumentation.hot
 def download_listings_page(
     index: dict, session: requests.Session, save_path: pathlib.Path
 ) -> None:
     response = session.get(LISTINGS_ENDPOINT, params=generate_payloads(index))
-    with open(
+    with instrumentation.span("json_decode", stage="download"):
+        data = response.json()
+    with instrumentation.span("disk_write", stage="download"), open(
         save_path
         / f"{index['region_id']}_{index['province_id']}_{index['city_id']}_{index['macrozone_id']}_{index['neighbourhood_id']}_{index['page_num']}.json",
         "w",
     ) as f:
-        json.dump(response.json(), f)
+        json.dump(data, f)
+        instrumentation.count("bytes_written_total", f.tell(), stage="download")
 
 
 def download_listings(indexes: list) -> None:
     save_path = pathlib.Path(f"./listings/{time.strftime('%y%m%d')}/json/")
     save_path.mkdir(parents=True, exist_ok=True)
 
-    with requests.Session() as session:
+    with instrumentation.span("download_listings"), http_cache.CachedSession() as session:
+        instrumentation.instrument_session(session, "download")
         with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
             futures = [
-                executor.submit(download_listings_page, index, session, save_path)
+                instrumentation.submit(
+                    executor, download_listings_page, index, session, save_path
+                )
                 for index in indexes
             ]
             for future in tqdm.tqdm(
@@ -163,22 +178,29 @@ def download_listings(indexes: list) -> None:
                 try:
                     future.result()
                 except Exception as e:
+                    instrumentation.count("errors_total", stage="download")
                     print(f"Exception occurred in worker thread: {e}")
 
 
 def parse_result(result: dict) -> dict:
-    real_estate = result.get("realEstate", {})
-    properties = real_estate.get("properties", [{}])[0]
-    location = properties.get("location", {})
-    price = real_estate.get("price", {})
-    floor_info = properties.get("floor", {})
-    typology = properties.get("typology", {})
+    # recorded pages carry explicit nulls for missing objects, hence the `or {}`
+    real_estate = result.get("realEstate") or {}
+    properties = (real_estate.get("properties") or [{}])[0]
+    location = properties.get("location") or {}
+    price = real_estate.get("price") or {}
+    floor_info = properties.get("floor") or {}
+    typology = properties.get("typology") or {}
 
     id = real_estate.get("id")
     city = location.get("city")
     macrozone = location.get("macrozone")
     neighbourhood = location.get("microzone")
+    latitude = location.get("latitude")
+    longitude = location.get("longitude")
     price_value = price.get("value")
+    # new developments report the lowest price of the range as a string
+    if isinstance(price_value, str):
+        price_value = float(price_value) if price_value.isdigit() else None
     surface_string = properties.get("surface")
     rooms_string = properties.get("rooms")
     floor = floor_info.get("abbreviation")
@@ -194,6 +216,8 @@ def parse_result(result: dict) -> dict:
         "city": city,
         "macrozone": macrozone,
         "neighbourhood": neighbourhood,
+        "latitude": latitude,
+        "longitude": longitude,
         "price": price_value,
         "price_per_sqm": price_per_sqm,
         "surface": surface,
@@ -203,20 +227,26 @@ def parse_result(result: dict) -> dict:
     }
     
 
+@instrumentation.hot
 def parse_listings_page(file_path: pathlib.Path) -> pd.DataFrame:
     with open(file_path, "r") as f:
         try:
-            data = json.load(f)
+            with instrumentation.span("json_decode", stage="compile"):
+                data = json.load(f)
+                instrumentation.count("bytes_read_total", f.tell(), stage="compile")
         except json.decoder.JSONDecodeError:
+            instrumentation.count("errors_total", stage="compile")
             print(f"Could not parse {file_path}")
             return pd.DataFrame()
             
         results = data.get("results", [])
-        parsed_results = [parse_result(result) for result in results]
-        df = pd.DataFrame(parsed_results)
+        with instrumentation.span("parse_results", stage="compile"):
+            parsed_results = [parse_result(result) for result in results]
+            df = pd.DataFrame(parsed_results)
         return df
     
     
+@instrumentation.traced()
 def compile_city_tables() -> None:
     #build a list of unique region-province combinations
     #indexes = {(index["region_id"], index["province_id"]) for index in indexes}
@@ -236,12 +266,15 @@ def compile_city_tables() -> None:
         ]
 
         dfs = [parse_listings_page(json_file) for json_file in json_files]
-        df = pd.concat(dfs)
+        with instrumentation.span("concat", stage="compile"):
+            df = pd.concat(dfs)
     # drop rows with no price or no surface
     df = df.dropna(subset=["price", "surface"])
-    df.to_csv(save_path / f"{index}.csv", index=False)
+    with instrumentation.span("disk_write", stage="compile"):
+        df.to_csv(save_path / f"{index}.csv", index=False)
 
 
+@instrumentation.traced()
 def compile_macrozone_summary_table():
     csv_path = pathlib.Path(f"./listings/{time.strftime('%y%m%d')}/csv/")
     save_path = pathlib.Path(f"./listings/{time.strftime('%y%m%d')}/out/")
@@ -285,8 +318,12 @@ def compile_macrozone_summary_table():
         city_data = city_data.dropna(subset=["price", "surface"])
         city_name = city_data["city"].iloc[0]
         
-        #eliminate outliers
-        city_data = city_data[city_data["price_per_sqm"] < city_data["price_per_sqm"].quantile(0.99)]
+        #eliminate outliers, with the cutoff of the whole province file; listings
+        #without a price_per_sqm never passed the old "< 99th percentile" test
+        city_data = city_data.dropna(subset=["price_per_sqm"])
+        city_data, _ = outliers.filter_outliers(
+            city_data, "price_per_sqm", method="quantile", upper=0.99
+        )
                 
         macrozone_data = city_data.groupby("macrozone").agg(
             {
@@ -352,11 +389,16 @@ def compile_macrozone_summary_table():
 
 
 if __name__ == "__main__":
-    macrodata = pd.read_csv("./table_builder/index_table.csv")
-    #indexes = build_indexes(macrodata)
-    #download_listings(indexes)
-    #compile_city_tables()
-    compile_macrozone_summary_table()
+    parser = argparse.ArgumentParser(description="Crawl and compile today's listings")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumentation.from_args(args):
+        macrodata = pd.read_csv("./table_builder/index_table.csv")
+        #indexes = build_indexes(macrodata)
+        #download_listings(indexes)
+        #compile_city_tables()
+        compile_macrozone_summary_table()
 
 
 # def get_row_listings(row: pd.Series, s: requests.Session) -> dict:
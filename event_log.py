@@ -0,0 +1,488 @@
+# Append-only feed of listing changes. Every time a snapshot is compiled its
+# listings are compared with the last state seen for the contract, and one
+# event per change is appended to a newline-delimited JSON log:
+#
+#   {"offset": 1041, "type": "price_changed", "id": 103917245, "contract": "sale",
+#    "snapshot": "231019", "timestamp": "2023-10-19T07:12:03Z",
+#    "old": {"price": 349000.0}, "new": {"price": 329000.0}}
+#
+# Event types are listing_added (old is null), price_changed and
+# listing_removed (new is null). Offsets number the events from 0 and never
+# change. The log is split into segments named after their first offset
+# (events/00000000000000000000.ndjson) and a new one is started once the
+# current one reaches SEGMENT_BYTES, so old segments can be archived or
+# deleted without touching the rest.
+#
+#   python event_log.py emit --contract sale          # diff today's snapshot
+#   python event_log.py tail --consumer alerts --follow
+#
+#   subscriber = Subscriber("./listings/events", consumer="alerts")
+#   for event in subscriber.follow():
+#       notify(event)
+#       subscriber.commit()          # resume after this event next time
+#
+# There must be a single writer; any number of subscribers can tail the log
+# while it is written, since they only read complete lines.
+
+import argparse
+import bisect
+import datetime
+import json
+import logging
+import math
+import os
+import pathlib
+import sqlite3
+import time
+
+import pandas as pd
+
+LISTINGS_ROOT = pathlib.Path("./listings/")
+EVENTS_PATH = LISTINGS_ROOT / "events"
+STATE_FILE = "state.sqlite"
+CONSUMERS_DIR = "consumers"
+SEGMENT_SUFFIX = ".ndjson"
+SEGMENT_BYTES = 64 * 2**20
+POLL_INTERVAL_S = 1.0
+
+EVENT_TYPES = ("listing_added", "price_changed", "listing_removed")
+# listing fields carried by listing_added and listing_removed events
+STATE_COLUMNS = [
+    "id",
+    "city",
+    "macrozone",
+    "neighbourhood",
+    "price",
+    "surface",
+    "rooms",
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    contract TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    city TEXT,
+    macrozone TEXT,
+    neighbourhood TEXT,
+    price REAL,
+    surface REAL,
+    rooms REAL,
+    PRIMARY KEY (contract, id)
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    contract TEXT PRIMARY KEY,
+    snapshot TEXT NOT NULL
+);
+"""
+
+
+def segment_name(base_offset: int) -> str:
+    return f"{base_offset:020d}{SEGMENT_SUFFIX}"
+
+
+def list_segments(path: pathlib.Path) -> list:
+    """Base offsets of the segments of a log, oldest first."""
+    return sorted(
+        int(segment.name[: -len(SEGMENT_SUFFIX)])
+        for segment in pathlib.Path(path).glob(f"*{SEGMENT_SUFFIX}")
+    )
+
+
+def _json_value(value):
+    # NaN is not valid JSON, and numpy scalars are not serializable
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return value.item() if hasattr(value, "item") else value
+
+
+class EventLog:
+    """
+    Writer of a segmented NDJSON event log.
+
+    Args:
+        path (pathlib.Path): Directory of the log.
+        segment_bytes (int): Size at which a new segment is started.
+    """
+
+    def __init__(
+        self, path: pathlib.Path = EVENTS_PATH, segment_bytes: int = SEGMENT_BYTES
+    ):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        segments = list_segments(self.path)
+        self.segment = segments[-1] if segments else 0
+        self.next_offset = self._recover()
+
+    def _recover(self) -> int:
+        """
+        Offset of the next event, from the last line of the newest segment.
+
+        A line left incomplete by a crash is truncated away.
+        """
+        segment_path = self.path / segment_name(self.segment)
+        if not segment_path.exists():
+            return self.segment
+        with open(segment_path, "rb+") as f:
+            size = f.seek(0, os.SEEK_END)
+            tail_size = min(size, 1 << 16)
+            while True:
+                f.seek(size - tail_size)
+                tail = f.read(tail_size)
+                end = tail.rfind(b"\n")
+                start = tail.rfind(b"\n", 0, max(end, 0)) + 1
+                if start > 0 or tail_size == size:
+                    break
+                tail_size = min(size, tail_size * 2)
+            complete = size - tail_size + end + 1
+            if complete < size:
+                logging.warning(f"Truncating an incomplete event in {segment_path}")
+                f.truncate(complete)
+            if complete == 0:
+                return self.segment
+            return json.loads(tail[start:end])["offset"] + 1
+
+    def append(self, events: list) -> int:
+        """
+        Append events, assigning their offsets.
+
+        Args:
+            events (list): Event dicts with type, id, contract, old and new.
+
+        Returns:
+            int: The offset of the next event.
+        """
+        segment_path = self.path / segment_name(self.segment)
+        f = open(segment_path, "ab")
+        try:
+            for event in events:
+                if f.tell() >= self.segment_bytes:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    f.close()
+                    self.segment = self.next_offset
+                    f = open(self.path / segment_name(self.segment), "ab")
+                line = json.dumps(
+                    {"offset": self.next_offset, **event}, separators=(",", ":")
+                )
+                f.write(line.encode() + b"\n")
+                self.next_offset += 1
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        return self.next_offset
+
+    def retain(self, segments: int) -> list:
+        """Delete all but the newest segments, returning the deleted bases."""
+        deleted = list_segments(self.path)[:-segments]
+        for base in deleted:
+            (self.path / segment_name(base)).unlink()
+        return deleted
+
+
+class Subscriber:
+    """
+    Reader tailing an event log from an offset.
+
+    Args:
+        path (pathlib.Path): Directory of the log.
+        consumer (str): Name under which commit() saves the offset reached,
+            so a restarted subscriber resumes where it stopped.
+        offset (int): First offset to read, overriding the committed one.
+            Without either, reading starts from the oldest event kept.
+    """
+
+    def __init__(
+        self, path: pathlib.Path = EVENTS_PATH, consumer: str = None, offset: int = None
+    ):
+        self.path = pathlib.Path(path)
+        self.consumer = consumer
+        if offset is None and consumer is not None:
+            offset = self.committed()
+        self.offset = offset or 0
+        self._file = None
+        self._segment = None
+
+    @property
+    def _offset_path(self) -> pathlib.Path:
+        return self.path / CONSUMERS_DIR / f"{self.consumer}.offset"
+
+    def committed(self) -> int:
+        """The offset saved by the last commit(), None if there is none."""
+        if self.consumer is None or not self._offset_path.exists():
+            return None
+        return int(self._offset_path.read_text())
+
+    def commit(self) -> None:
+        """Save the offset of the next event to read."""
+        if self.consumer is None:
+            raise ValueError("Only a named consumer can commit its offset")
+        self._offset_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._offset_path.with_suffix(".tmp")
+        tmp_path.write_text(str(self.offset))
+        os.replace(tmp_path, self._offset_path)
+
+    def _open(self, segments: list) -> None:
+        # the segment holding self.offset, or the oldest one kept
+        index = bisect.bisect_right(segments, self.offset) - 1
+        if index < 0:
+            logging.warning(
+                f"Events before offset {segments[0]} were deleted, resuming from there"
+            )
+            self.offset = segments[0]
+            index = 0
+        self._segment = segments[index]
+        self._file = open(self.path / segment_name(self._segment), "rb")
+
+    def poll(self, max_events: int = 1000) -> list:
+        """The events written since the last poll, at most max_events."""
+        events = []
+        while len(events) < max_events:
+            if self._file is None:
+                segments = list_segments(self.path)
+                if not segments:
+                    break
+                self._open(segments)
+            position = self._file.tell()
+            line = self._file.readline()
+            if not line.endswith(b"\n"):
+                # end of the segment, or an event still being written
+                self._file.seek(position)
+                newer = [
+                    base for base in list_segments(self.path) if base > self._segment
+                ]
+                if line or not newer:
+                    break
+                self._file.close()
+                self._file = None
+                self.offset = max(self.offset, newer[0])
+                continue
+            event = json.loads(line)
+            if event["offset"] < self.offset:
+                continue
+            events.append(event)
+            self.offset = event["offset"] + 1
+        return events
+
+    def follow(self, poll_interval: float = POLL_INTERVAL_S, max_events: int = 1000):
+        """Yield events as they are written, forever."""
+        while True:
+            events = self.poll(max_events)
+            yield from events
+            if not events:
+                time.sleep(poll_interval)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def diff_listings(previous: pd.DataFrame, current: pd.DataFrame) -> list:
+    """
+    Events turning the previous listings of a contract into the current ones.
+
+    Args:
+        previous (pd.DataFrame): Last known listings, with STATE_COLUMNS.
+        current (pd.DataFrame): Listings of the new snapshot.
+
+    Returns:
+        list: Event dicts without offset, contract or timestamps.
+    """
+    fields = STATE_COLUMNS[1:]
+    merged = previous[STATE_COLUMNS].merge(
+        current[STATE_COLUMNS],
+        on="id",
+        how="outer",
+        suffixes=("_old", "_new"),
+        indicator=True,
+    )
+
+    def values(rows: pd.DataFrame, suffix: str) -> list:
+        columns = rows[[f"{field}{suffix}" for field in fields]]
+        return [
+            {field: _json_value(value) for field, value in zip(fields, row)}
+            for row in columns.itertuples(index=False, name=None)
+        ]
+
+    events = []
+    added = merged[merged["_merge"] == "right_only"]
+    for id, new in zip(added["id"], values(added, "_new")):
+        events.append({"type": "listing_added", "id": int(id), "old": None, "new": new})
+    both = merged[merged["_merge"] == "both"]
+    # a price appearing or disappearing is a change too, NaN to NaN is not
+    changed = both[
+        (both["price_old"] != both["price_new"])
+        & ~(both["price_old"].isna() & both["price_new"].isna())
+    ]
+    for id, old, new in zip(changed["id"], changed["price_old"], changed["price_new"]):
+        events.append(
+            {
+                "type": "price_changed",
+                "id": int(id),
+                "old": {"price": _json_value(old)},
+                "new": {"price": _json_value(new)},
+            }
+        )
+    removed = merged[merged["_merge"] == "left_only"]
+    for id, old in zip(removed["id"], values(removed, "_old")):
+        events.append(
+            {"type": "listing_removed", "id": int(id), "old": old, "new": None}
+        )
+    return events
+
+
+def connect_state(path: pathlib.Path = EVENTS_PATH) -> sqlite3.Connection:
+    """Open the last state seen by emit_snapshot_events."""
+    pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(pathlib.Path(path) / STATE_FILE)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def read_partition(root: pathlib.Path, date: str, contract: str) -> pd.DataFrame:
+    """
+    The listings of the compiled city tables of a snapshot.
+
+    Raises:
+        FileNotFoundError: The partition has no city tables, or no listings
+            in them, e.g. the snapshot was not compiled.
+    """
+    import data_processor
+
+    csv_path = data_processor.partition(root, date, "csv", contract)
+    dfs = [
+        pd.read_csv(csv_file, usecols=lambda column: column in STATE_COLUMNS)
+        for csv_file in sorted(csv_path.glob("*.csv"))
+    ]
+    if not dfs:
+        raise FileNotFoundError(f"No compiled city tables in {csv_path}")
+    df = pd.concat(dfs, ignore_index=True).reindex(columns=STATE_COLUMNS)
+    df = df.dropna(subset=["id"]).drop_duplicates("id")
+    if df.empty:
+        raise FileNotFoundError(f"No listings in the city tables of {csv_path}")
+    df["id"] = df["id"].astype("int64")
+    return df
+
+
+def emit_snapshot_events(
+    root: pathlib.Path = LISTINGS_ROOT,
+    date: str = None,
+    contract: str = "sale",
+    path: pathlib.Path = None,
+) -> int:
+    """
+    Append the changes of a compiled snapshot to the event log.
+
+    The first snapshot of a contract reports every listing as added.
+    Snapshots older than the last one diffed are skipped, so re-running a
+    stage, or compiling an old snapshot again, emits nothing. So are
+    snapshots without compiled listings, rather than reporting every known
+    listing as removed.
+
+    Args:
+        root (pathlib.Path): Directory holding the daily snapshots.
+        date (str): Snapshot to diff (yymmdd), today when not given.
+        contract (str): Contract partition (sale, rent, auction).
+        path (pathlib.Path): Directory of the log, <root>/events by default.
+
+    Returns:
+        int: The number of events emitted.
+    """
+    date = date or time.strftime("%y%m%d")
+    path = pathlib.Path(path or pathlib.Path(root) / "events")
+    conn = connect_state(path)
+    last = conn.execute(
+        "SELECT snapshot FROM snapshots WHERE contract = ?", (contract,)
+    ).fetchone()
+    if last and last[0] >= date:
+        logging.info(f"Events of {contract} snapshot {last[0]} already emitted")
+        conn.close()
+        return 0
+
+    try:
+        current = read_partition(root, date, contract)
+    except FileNotFoundError as e:
+        logging.warning(f"Skipping the events of {contract} snapshot {date}: {e}")
+        conn.close()
+        return 0
+    previous = pd.read_sql_query(
+        f"SELECT {', '.join(STATE_COLUMNS)} FROM listings WHERE contract = ?",
+        conn,
+        params=(contract,),
+    ).astype({"id": "int64"})
+    timestamp = datetime.datetime.now(datetime.timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
+    events = [
+        {
+            "type": event["type"],
+            "id": event["id"],
+            "contract": contract,
+            "snapshot": date,
+            "timestamp": timestamp,
+            "old": event["old"],
+            "new": event["new"],
+        }
+        for event in diff_listings(previous, current)
+    ]
+    # the log is written first: a crash before the state is saved emits the
+    # same changes again on the next run rather than losing them
+    EventLog(path).append(events)
+
+    values = current[STATE_COLUMNS].astype(object).where(current[STATE_COLUMNS].notna())
+    with conn:
+        conn.execute("DELETE FROM listings WHERE contract = ?", (contract,))
+        conn.executemany(
+            f"INSERT INTO listings (contract, {', '.join(STATE_COLUMNS)}) "
+            f"VALUES (?, {', '.join('?' for _ in STATE_COLUMNS)})",
+            ((contract, *row) for row in values.itertuples(index=False, name=None)),
+        )
+        conn.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?)", (contract, date))
+    conn.close()
+
+    counts = pd.Series([event["type"] for event in events], dtype=object).value_counts()
+    logging.info(
+        f"Emitted {len(events)} {contract} events: "
+        + ", ".join(f"{counts.get(kind, 0)} {kind}" for kind in EVENT_TYPES)
+    )
+    return len(events)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Listing change event log")
+    actions = parser.add_subparsers(dest="action", required=True)
+    action = actions.add_parser("emit", help="append the changes of a snapshot")
+    action.add_argument("--root", type=pathlib.Path, default=LISTINGS_ROOT)
+    action.add_argument("--date", default=None, help="yymmdd (default: today)")
+    action.add_argument("--contract", nargs="+", default=["sale"])
+    action.add_argument("--events", type=pathlib.Path, default=None)
+    action = actions.add_parser("tail", help="print events as NDJSON")
+    action.add_argument("--events", type=pathlib.Path, default=EVENTS_PATH)
+    action.add_argument("--consumer", default=None, help="commit offsets under it")
+    action.add_argument("--offset", type=int, default=None)
+    action.add_argument("--follow", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.action == "emit":
+        for contract in args.contract:
+            emit_snapshot_events(args.root, args.date, contract, args.events)
+    else:
+        subscriber = Subscriber(args.events, args.consumer, args.offset)
+        try:
+            while True:
+                events = subscriber.poll()
+                for event in events:
+                    print(json.dumps(event), flush=True)
+                if args.consumer:
+                    subscriber.commit()
+                if not events:
+                    if not args.follow:
+                        break
+                    time.sleep(POLL_INTERVAL_S)
+        except KeyboardInterrupt:
+            pass
+        subscriber.close()
@@ -0,0 +1,300 @@
+# Lightweight analysis for the word-frequency reports.
+# most_used_words_by_neighbourhood and keyword_percentage_by_neighbourhood only
+# read the lemma, is_alpha, is_stop and shape of each token, so instead of the
+# full it_core_news_lg parse (tagger, parser, NER) descriptions only go through
+# spaCy's rule-based Italian tokenizer. Lemmas come from a table of the lemmas
+# the full model gave in earlier runs, then from spaCy's lookup lemmatizer
+# (spacy-lookups-data) when installed, and otherwise are the lowercase word.
+#
+#   python fast_nlp.py lemmas --store ./nlp_store/        # table from full runs
+#   python fast_nlp.py agreement data_sales.csv --sample 500
+#
+#   analyzer = FastAnalyzer(load_lemma_table())
+#   tokens = analyzer.analyze_frame(nlp_analysis.clean_data("data_sales.csv"))
+#   nlp_analysis.most_used_words_by_neighbourhood(tokens)
+
+import argparse
+import json
+import logging
+import pathlib
+import time
+
+import numpy as np
+import pandas as pd
+
+import nlp_analysis
+
+LEMMA_TABLE = pathlib.Path("./nlp_store/lemma_table.csv")
+FAST_COLUMNS = ["text", "lemma", "shape", "is_alpha", "is_stop"]
+
+
+def build_lemma_table(tokens: pd.DataFrame) -> pd.Series:
+    """
+    The lemma the full model gave most often to each lowercase word.
+
+    Args:
+        tokens (pd.DataFrame): Tokens from nlp_analysis.tag_data or
+            token_store.TokenStore.tokens().
+
+    Returns:
+        pd.Series: Lemmas indexed by lowercase word.
+    """
+    counts = (
+        tokens.assign(word=tokens["text"].str.lower())
+        .groupby(["word", "lemma"])
+        .size()
+        .rename("count")
+        .reset_index()
+    )
+    best = counts.sort_values("count", ascending=False).drop_duplicates("word")
+    return best.set_index("word")["lemma"].sort_index()
+
+
+def save_lemma_table(table: pd.Series, path: pathlib.Path = LEMMA_TABLE) -> None:
+    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+    table.rename_axis("word").rename("lemma").to_csv(path, encoding="utf-8")
+
+
+def load_lemma_table(path: pathlib.Path = LEMMA_TABLE) -> pd.Series:
+    """The saved lemma table, or None if there is none yet."""
+    if not pathlib.Path(path).exists():
+        return None
+    # "nan" and "null" are words too
+    table = pd.read_csv(path, keep_default_na=False, dtype=str)
+    return table.set_index("word")["lemma"]
+
+
+class FastAnalyzer:
+    """
+    Tokenizer-only analysis returning the columns the word reports need.
+
+    Args:
+        lemma_table (pd.Series): Lemmas indexed by lowercase word, from
+            build_lemma_table. Words missing from it fall back to the lookup
+            lemmatizer, then to themselves.
+    """
+
+    def __init__(self, lemma_table: pd.Series = None):
+        import spacy
+
+        self.nlp = spacy.blank("it")
+        self.lemma_table = lemma_table
+        self.lookup = None
+        try:
+            from spacy.lookups import load_lookups
+
+            self.lookup = load_lookups("it", ["lemma_lookup"]).get_table("lemma_lookup")
+        except (ImportError, ValueError):
+            logging.info("spacy-lookups-data not installed, no lookup lemmatizer")
+
+    def lemmas(self, words: list) -> np.ndarray:
+        """Lemma of each lowercase word."""
+        words = pd.Series(words, dtype=object)
+        if self.lemma_table is not None:
+            lemmas = words.map(self.lemma_table)
+        else:
+            lemmas = pd.Series(None, index=words.index, dtype=object)
+        missing = words[lemmas.isna()]
+        if self.lookup is not None:
+            missing = missing.map(lambda word: self.lookup.get(word, word))
+        return lemmas.fillna(missing).to_numpy(dtype=object)
+
+    def analyze(self, texts: list, batch_size: int = 1000) -> tuple:
+        """
+        Tokenize texts and look up the attributes of every token.
+
+        Attributes are read from each doc as an array of string hashes and
+        resolved once per distinct hash, so the cost per token is a few numpy
+        operations rather than a Python Token object.
+
+        Returns:
+            tuple: A DataFrame with the FAST_COLUMNS of every token, and the
+                number of tokens of each text.
+        """
+        from spacy.attrs import IS_ALPHA, IS_STOP, LOWER, ORTH, SHAPE
+
+        attrs = [ORTH, LOWER, SHAPE, IS_ALPHA, IS_STOP]
+        arrays = []
+        lengths = []
+        for doc in self.nlp.tokenizer.pipe(texts, batch_size=batch_size):
+            arrays.append(doc.to_array(attrs).reshape(-1, len(attrs)))
+            lengths.append(len(doc))
+        array = (
+            np.concatenate(arrays)
+            if arrays
+            else np.empty((0, len(attrs)), dtype="uint64")
+        )
+
+        strings = self.nlp.vocab.strings
+
+        def decode(hashes: np.ndarray) -> tuple:
+            uniques, codes = np.unique(hashes, return_inverse=True)
+            return [strings[int(h)] for h in uniques], codes
+
+        texts_u, text_codes = decode(array[:, 0])
+        lowers_u, lower_codes = decode(array[:, 1])
+        shapes_u, shape_codes = decode(array[:, 2])
+        tokens = pd.DataFrame(
+            {
+                "text": np.array(texts_u, dtype=object)[text_codes],
+                "lemma": self.lemmas(lowers_u)[lower_codes],
+                "shape": np.array(shapes_u, dtype=object)[shape_codes],
+                "is_alpha": array[:, 3].astype(bool),
+                "is_stop": array[:, 4].astype(bool),
+            }
+        )
+        return tokens, np.array(lengths, dtype=int)
+
+    def analyze_frame(self, df: pd.DataFrame, batch_size: int = 1000) -> pd.DataFrame:
+        """Tokens of cleaned listings, laid out like nlp_analysis.tag_data."""
+        tokens, lengths = self.analyze(df["description"].tolist(), batch_size)
+        listing = {
+            "id": df["id"],
+            "macrozone": df["macrozone"],
+            "neighbourhood": df["neighbourhood"],
+            "price": df["price.value"],
+        }
+        for column, values in reversed(listing.items()):
+            tokens.insert(0, column, np.repeat(values.to_numpy(), lengths))
+        return tokens
+
+
+def top_words(tokens: pd.DataFrame, top: int) -> pd.Series:
+    """The top most used lemmas of each neighbourhood, as sets."""
+    words = tokens[tokens["is_alpha"] & ~tokens["is_stop"]]
+    counts = words.groupby(["neighbourhood", "lemma"]).size().rename("count")
+    counts = counts.reset_index().sort_values(
+        ["neighbourhood", "count", "lemma"], ascending=[True, False, True]
+    )
+    return (
+        counts.groupby("neighbourhood")
+        .head(top)
+        .groupby("neighbourhood")["lemma"]
+        .agg(set)
+    )
+
+
+def top_words_overlap(full: pd.DataFrame, fast: pd.DataFrame, top: int) -> float:
+    """Mean share of the top words of each neighbourhood found by both."""
+    full_words = top_words(full, top)
+    fast_words = top_words(fast, top)
+    overlaps = [
+        len(words & fast_words.get(neighbourhood, set())) / len(words)
+        for neighbourhood, words in full_words.items()
+    ]
+    return float(np.mean(overlaps)) if overlaps else float("nan")
+
+
+def agreement_report(
+    df: pd.DataFrame,
+    analyzer: FastAnalyzer,
+    nlp=None,
+    sample: int = 500,
+    top: int = 50,
+    seed: int = 0,
+) -> dict:
+    """
+    Compare the fast analysis with the full pipeline on a sample of listings.
+
+    Token attributes are compared on the descriptions both tokenize the same
+    way; top_words_overlap compares the neighbourhood reports themselves.
+
+    Args:
+        df (pd.DataFrame): Cleaned listings, from nlp_analysis.clean_data.
+        analyzer (FastAnalyzer): The fast analysis to check.
+        nlp: The full spaCy pipeline, nlp_analysis.get_nlp() if None.
+        sample (int): Listings compared.
+        top (int): Words per neighbourhood compared by top_words_overlap.
+        seed (int): Seed of the sample.
+
+    Returns:
+        dict: Throughput of both paths and agreement rates.
+    """
+    nlp = nlp or nlp_analysis.get_nlp()
+    df = df.sample(min(sample, len(df)), random_state=seed)
+    texts = df["description"].tolist()
+
+    start = time.perf_counter()
+    full_docs = [nlp_analysis.token_records(doc) for doc in nlp.pipe(texts)]
+    full_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    fast, lengths = analyzer.analyze(texts)
+    fast_seconds = time.perf_counter() - start
+
+    full = pd.DataFrame(
+        [record for records in full_docs for record in records],
+        columns=nlp_analysis.TOKEN_COLUMNS,
+    )
+    full_doc = np.repeat(np.arange(len(texts)), [len(records) for records in full_docs])
+    fast_doc = np.repeat(np.arange(len(texts)), lengths)
+    full_texts = full.groupby(full_doc)["text"].agg(tuple)
+    fast_texts = fast.groupby(fast_doc)["text"].agg(tuple)
+    same = full_texts.index[full_texts == fast_texts.reindex(full_texts.index)]
+    full_aligned = full[np.isin(full_doc, same)].reset_index(drop=True)
+    fast_aligned = fast[np.isin(fast_doc, same)].reset_index(drop=True)
+
+    listing = df[["id", "macrozone", "neighbourhood", "price.value"]].rename(
+        columns={"price.value": "price"}
+    )
+    report = {
+        "docs": len(texts),
+        "full_docs_per_second": len(texts) / full_seconds,
+        "fast_docs_per_second": len(texts) / fast_seconds,
+        "speedup": full_seconds / fast_seconds,
+        "tokenization_agreement": len(same) / max(1, len(texts)),
+    }
+    for column in ["lemma", "is_alpha", "is_stop", "shape"]:
+        report[f"{column}_agreement"] = float(
+            (full_aligned[column] == fast_aligned[column]).mean()
+        )
+    # agreement on the words the reports actually count
+    words = full_aligned[full_aligned["is_alpha"] & ~full_aligned["is_stop"]]
+    fast_words = fast_aligned.loc[words.index]
+    report["report_lemma_agreement"] = float(
+        (words["lemma"] == fast_words["lemma"]).mean()
+    )
+    report["top_words_overlap"] = top_words_overlap(
+        pd.concat([listing.iloc[full_doc].reset_index(drop=True), full], axis=1),
+        pd.concat([listing.iloc[fast_doc].reset_index(drop=True), fast], axis=1),
+        top,
+    )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tokenizer-only NLP analysis")
+    actions = parser.add_subparsers(dest="action", required=True)
+    action = actions.add_parser(
+        "lemmas", help="build the lemma table from full-pipeline tokens"
+    )
+    source = action.add_mutually_exclusive_group(required=True)
+    source.add_argument("--store", type=pathlib.Path, help="token store directory")
+    source.add_argument("--tagged", type=pathlib.Path, help="CSV from tag_data")
+    action.add_argument("--output", type=pathlib.Path, default=LEMMA_TABLE)
+    action = actions.add_parser(
+        "agreement", help="compare with the full pipeline on a sample"
+    )
+    action.add_argument("input", type=pathlib.Path, help="CSV from data_converter")
+    action.add_argument("--sample", type=int, default=500)
+    action.add_argument("--lemma-table", type=pathlib.Path, default=LEMMA_TABLE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.action == "lemmas":
+        if args.store:
+            import token_store
+
+            store = token_store.TokenStore(args.store)
+            tokens = store.tokens()
+            store.close()
+        else:
+            tokens = pd.read_csv(args.tagged, keep_default_na=False)
+        table = build_lemma_table(tokens)
+        save_lemma_table(table, args.output)
+        logging.info(f"Saved the lemmas of {len(table)} words to {args.output}")
+    else:
+        analyzer = FastAnalyzer(load_lemma_table(args.lemma_table))
+        report = agreement_report(
+            nlp_analysis.clean_data(args.input), analyzer, sample=args.sample
+        )
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,289 @@
+# Versioned feature store for the ML training data. A feature is a named,
+# versioned function of some listing columns (or of other features). Its values
+# are cached a column at a time under a key hashing the listing ids, the
+# feature's version and parameters, and the content of its inputs, so building
+# a training set only recomputes the features whose key has no cached column
+# and joins the others:
+#
+#   store = FeatureStore("./feature_store/")
+#   store.register(Feature("sqm", ["surface"], parse_surface))
+#   store.register(Feature("price_per_sqm", ["price.value", "sqm"], ratio))
+#   store.build(listings, ["sqm", "price_per_sqm"])       # indexed by id
+#
+#   python feature_store.py --path ./feature_store/       # cached columns
+#
+# Row-wise features, whose value for a listing depends on that listing's inputs
+# alone, also take the rows of their latest column with the same definition
+# whose inputs did not change, so a new snapshot only sends the new or moved
+# listings to an external API such as TravelTime.
+#
+# Columns are npz files at <path>/<feature>/<definition>-<key>.npz holding a
+# hash of every listing's id and inputs and the values; the KEEP_COLUMNS most
+# recently used columns of every feature are kept.
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+STORE_PATH = pathlib.Path("./feature_store/")
+ID_COLUMN = "id"
+KEEP_COLUMNS = 4  # cached columns kept per feature
+
+
+def row_hashes(frame: pd.DataFrame) -> np.ndarray:
+    """uint64 hash of every row of frame, whatever its index."""
+    if not len(frame.columns):
+        return np.zeros(len(frame), np.uint64)
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy(np.uint64)
+
+
+def digest(*parts) -> str:
+    """Hex digest of strings and arrays."""
+    hasher = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        hasher.update(
+            part.tobytes() if isinstance(part, np.ndarray) else str(part).encode()
+        )
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+class Feature:
+    """
+    A derived column of the training data.
+
+    Args:
+        name (str): Column name in the training sets.
+        inputs (list): Columns it reads, from the listings when they have
+            them and from the features of that name otherwise.
+        compute (callable): Takes a DataFrame of the inputs, one row per
+            listing indexed by its position in the listings given to build,
+            and returns the values in the same order.
+        version (int): Bump whenever compute changes, so that cached columns
+            are recomputed.
+        params (dict): JSON-serializable settings that change the values, such
+            as the coordinates of a landmark.
+        rowwise (bool): The value of a listing depends only on its own inputs,
+            so unchanged rows of older columns can be reused.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        inputs: list,
+        compute,
+        version: int = 1,
+        params: dict = None,
+        rowwise: bool = False,
+    ):
+        self.name = name
+        self.inputs = list(inputs)
+        self.compute = compute
+        self.version = version
+        self.params = params or {}
+        self.rowwise = rowwise
+
+    def definition(self) -> str:
+        """Short digest of everything but the data that makes the values."""
+        return digest(
+            self.name,
+            self.version,
+            json.dumps(self.params, sort_keys=True),
+            ",".join(self.inputs),
+        )[:12]
+
+    def values(self, inputs: pd.DataFrame) -> np.ndarray:
+        """Run compute and check it gave one number per listing."""
+        values = np.asarray(self.compute(inputs))
+        if values.shape != (len(inputs),) or values.dtype == object:
+            raise ValueError(
+                f"Feature {self.name!r} must give one number per listing, "
+                f"got {values.dtype} values of shape {values.shape}"
+            )
+        return values
+
+
+class FeatureStore:
+    """
+    Cached feature columns on disk.
+
+    Args:
+        path (pathlib.Path): Folder of the cached columns.
+        features (list): Features to register.
+    """
+
+    def __init__(self, path: pathlib.Path = STORE_PATH, features: list = None):
+        self.path = pathlib.Path(path)
+        self.features = {}
+        self.report = {}
+        for feature in features or []:
+            self.register(feature)
+
+    def register(self, feature: Feature) -> None:
+        """Add a feature, replacing any other with the same name."""
+        self.features[feature.name] = feature
+
+    def _columns(self, feature: Feature) -> list:
+        """Cached columns of a feature with its current definition, newest last."""
+        return sorted(
+            (self.path / feature.name).glob(f"{feature.definition()}-*.npz"),
+            key=lambda path: path.stat().st_mtime_ns,
+        )
+
+    def _save(self, path: pathlib.Path, columns: dict) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp.npz")
+        np.savez_compressed(tmp_path, **columns)
+        os.replace(tmp_path, path)
+        for old_path in sorted(
+            path.parent.glob("*.npz"), key=lambda path: path.stat().st_mtime_ns
+        )[:-KEEP_COLUMNS]:
+            old_path.unlink()
+
+    def _inputs(
+        self, listings: pd.DataFrame, feature: Feature, ids: np.ndarray, values: dict
+    ) -> tuple:
+        """Inputs of a feature, the key of every listing and the column's path."""
+        inputs = pd.DataFrame(
+            {
+                column: (
+                    listings[column].to_numpy()
+                    if column in listings.columns
+                    else self._resolve(listings, column, ids, values)
+                )
+                for column in feature.inputs
+            }
+        )
+        # a listing's key changes with its id or any of its inputs
+        keys = row_hashes(pd.DataFrame({"id": ids, "inputs": row_hashes(inputs)}))
+        path = self.path / feature.name / f"{feature.definition()}-{digest(keys)}.npz"
+        return inputs, keys, path
+
+    def _reusable(self, feature: Feature, keys: np.ndarray) -> tuple:
+        """
+        Values of the latest column of a row-wise feature, and where each
+        listing's row is in them, -1 for the listings to compute.
+        """
+        previous = self._columns(feature) if feature.rowwise else []
+        if not previous:
+            return np.empty(0), np.full(len(keys), -1)
+        with np.load(previous[-1]) as data:
+            old_keys, old_values = data["keys"], data["values"]
+        return old_values, pd.Index(old_keys).get_indexer(keys)
+
+    def _resolve(
+        self, listings: pd.DataFrame, name: str, ids: np.ndarray, values: dict
+    ) -> np.ndarray:
+        """Values of a feature for the listings, from the cache when possible."""
+        if name in values:
+            return values[name]
+        if name not in self.features:
+            raise ValueError(f"{name!r} is neither a listing column nor a feature")
+        feature = self.features[name]
+        inputs, keys, path = self._inputs(listings, feature, ids, values)
+        if path.exists():
+            with np.load(path) as data:
+                values[name] = data["values"]
+            os.utime(path)
+            self.report[name] = "cached"
+            return values[name]
+
+        old_values, at = self._reusable(feature, keys)
+        missing = np.flatnonzero(at < 0)
+        if len(missing) < len(ids):
+            result = np.empty(len(ids), old_values.dtype)
+            result[at >= 0] = old_values[at[at >= 0]]
+            if len(missing):
+                computed = feature.values(inputs.iloc[missing])
+                result = result.astype(np.result_type(result, computed))
+                result[missing] = computed
+            self.report[name] = f"computed {len(missing)}/{len(ids)} rows"
+        else:
+            result = feature.values(inputs)
+            self.report[name] = "computed"
+        logging.info(f"Feature {name}: {self.report[name]}")
+        self._save(path, {"keys": keys, "values": result})
+        values[name] = result
+        return result
+
+    def _check(self, listings: pd.DataFrame, names: list) -> np.ndarray:
+        """The listing ids, once the features and ids are checked."""
+        unknown = [name for name in names if name not in self.features]
+        if unknown:
+            raise ValueError(f"Unknown features {unknown}, use {list(self.features)}")
+        ids = listings[ID_COLUMN].to_numpy(np.int64)
+        if len(np.unique(ids)) < len(ids):
+            raise ValueError(f"Listings must have distinct {ID_COLUMN} values")
+        return ids
+
+    def stale(self, listings: pd.DataFrame, names: list = None) -> dict:
+        """
+        Listings build would compute each feature for, so that callers can
+        fetch the values of several features at once beforehand (the features
+        they read are built).
+
+        Returns:
+            dict: Positions in listings of the rows to compute, by feature.
+        """
+        names = list(self.features) if names is None else names
+        ids = self._check(listings, names)
+        values, stale = {}, {}
+        for name in names:
+            feature = self.features[name]
+            _, keys, path = self._inputs(listings, feature, ids, values)
+            if path.exists():
+                stale[name] = np.empty(0, np.int64)
+            else:
+                stale[name] = np.flatnonzero(self._reusable(feature, keys)[1] < 0)
+        return stale
+
+    def build(self, listings: pd.DataFrame, names: list = None) -> pd.DataFrame:
+        """
+        Training columns for the listings.
+
+        Args:
+            listings (pd.DataFrame): One row per listing, with an ID_COLUMN and
+                the inputs of the features.
+            names (list): Features to build, every registered one by default.
+
+        Returns:
+            pd.DataFrame: One column per feature, indexed by listing id. How
+                each was obtained goes to the store's report.
+        """
+        names = list(self.features) if names is None else names
+        ids = self._check(listings, names)
+        values = {}
+        columns = {name: self._resolve(listings, name, ids, values) for name in names}
+        return pd.DataFrame(columns, index=pd.Index(ids, name=ID_COLUMN))
+
+    def summary(self) -> pd.DataFrame:
+        """Cached columns: feature, definition, listings, bytes and age."""
+        rows = []
+        for path in sorted(self.path.glob("*/*.npz")):
+            with np.load(path) as data:
+                listings = len(data["keys"])
+            rows.append(
+                {
+                    "feature": path.parent.name,
+                    "definition": path.stem.split("-")[0],
+                    "listings": listings,
+                    "bytes": path.stat().st_size,
+                    "modified": pd.Timestamp(path.stat().st_mtime, unit="s"),
+                }
+            )
+        return pd.DataFrame(
+            rows, columns=["feature", "definition", "listings", "bytes", "modified"]
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the cached feature columns")
+    parser.add_argument("--path", type=pathlib.Path, default=STORE_PATH)
+    args = parser.parse_args()
+    print(FeatureStore(args.path).summary().to_string(index=False))
@@ -0,0 +1,436 @@
+# Hedonic price index. Log price is regressed on log surface, rooms, floor and
+# typology with one fixed effect per neighbourhood, separately for each
+# contract; the fixed effects price a standard dwelling (the average surface
+# and the most common rooms, floor and typology) in every neighbourhood, so
+# neighbourhoods are compared like for like instead of by raw medians that
+# follow their mix of sizes and typologies:
+#
+#   python hedonic.py update --date 261019       # <root>/261019/out/hedonic_*
+#   python hedonic.py show --date 261019 --contract sale --city Milano
+#
+#   stats = HedonicStats()
+#   stats.add(listings)                          # X'X and X'y of the rows
+#   stats.add(delisted, sign=-1)                 # ... or take them out again
+#   index = stats.index()
+#
+# Only the sufficient statistics X'X, X'y, y'y and n of the sparse design
+# matrix are kept (<root>/<yymmdd>/out/hedonic_stats.npz). Each day they are
+# updated from the listings that appeared, changed or disappeared since the
+# previous snapshot, and the fit absorbs the neighbourhood block, which is
+# diagonal, so solving costs one small dense system whatever the number of
+# neighbourhoods.
+
+import argparse
+import logging
+import pathlib
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix, csr_matrix
+
+import data_processor
+import warehouse
+
+LISTINGS_ROOT = pathlib.Path("./listings/")
+STATS_FILE = "hedonic_stats.npz"
+INDEX_FILE = "hedonic_index.csv"
+
+LOCATION = ["city", "macrozone", "neighbourhood"]
+FACTORS = ["rooms", "floor", "type"]
+# a listing is refitted when any of these change
+FEATURES = ["price", "surface", "rooms", "floor", "type"] + LOCATION
+NUMERIC = ["price", "surface", "rooms"]
+# surfaces outside these bounds are typing errors or whole buildings; fixed
+# bounds rather than quantiles keep the statistics additive across days
+MIN_SURFACE = 10.0
+MAX_SURFACE = 2000.0
+UNKNOWN = "?"
+
+
+ROOMS_LEVELS = {1: "1", 2: "2", 3: "3", 4: "4", 5: "5+"}
+FLOOR_LEVELS = {0: "0", 1: "1", 2: "2", 3: "3", 4: "4", 5: "5", 6: "6+"}
+
+
+def _levels(values: pd.Series, labels: dict = None) -> tuple:
+    """Codes of the distinct values and their labels, UNKNOWN for missing."""
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    if labels is not None:
+        uniques = [labels.get(value, UNKNOWN) for value in uniques]
+    return codes, [UNKNOWN if pd.isna(value) else str(value) for value in uniques]
+
+
+def design_terms(listings: pd.DataFrame) -> tuple:
+    """
+    Response and design terms of the listings that can be fitted.
+
+    Args:
+        listings (pd.DataFrame): Listings with the FEATURES columns.
+
+    Returns:
+        tuple: Log prices, log surfaces and {factor: (codes, names)} giving
+            each row's level of the FACTORS and of the neighbourhood, named
+            like "rooms=3", "floor=1", "type=Appartamento" or
+            "neighbourhood=Milano|Centro|Brera".
+    """
+    price = pd.to_numeric(listings["price"], errors="coerce").to_numpy(np.float64)
+    surface = pd.to_numeric(listings["surface"], errors="coerce").to_numpy(np.float64)
+    valid = (price > 0) & (surface >= MIN_SURFACE) & (surface <= MAX_SURFACE)
+    listings = listings[valid]
+
+    # few distinct values each: factorize, then name the levels only
+    levels = {
+        "rooms": _levels(
+            pd.to_numeric(listings["rooms"], errors="coerce").clip(1, 5), ROOMS_LEVELS
+        ),
+        "floor": _levels(
+            data_processor.floor_levels(listings["floor"]).clip(0, 6), FLOOR_LEVELS
+        ),
+        "type": _levels(listings["type"].astype(object)),
+    }
+    location = listings[LOCATION].astype(object).fillna("").astype(str).to_numpy()
+    codes = np.zeros(len(listings), np.int64)
+    for part in location.T:
+        part_codes, part_uniques = pd.factorize(part)
+        codes = codes * max(len(part_uniques), 1) + part_codes
+    codes, uniques = pd.factorize(codes)
+    # name each neighbourhood after its first row
+    first = np.zeros(len(uniques), np.int64)
+    first[codes[::-1]] = np.arange(len(codes))[::-1]
+    levels["neighbourhood"] = (codes, ["|".join(key) for key in location[first]])
+    terms = {
+        factor: (codes, [f"{factor}={name}" for name in names])
+        for factor, (codes, names) in levels.items()
+    }
+    return np.log(price[valid]), np.log(surface[valid]), terms
+
+
+class HedonicStats:
+    """
+    Sufficient statistics of the hedonic regression of one contract.
+
+    Columns are named ("log_surface", then one indicator per factor level and
+    neighbourhood) and appended as new levels show up, so statistics built on
+    different days can be combined.
+
+    Args:
+        names (list): Column names.
+        xtx (csr_matrix): X'X, columns × columns.
+        xty (np.ndarray): X'y.
+        yty (float): y'y.
+        n (int): Listings added minus listings taken out.
+    """
+
+    def __init__(
+        self,
+        names: list = None,
+        xtx: csr_matrix = None,
+        xty: np.ndarray = None,
+        yty: float = 0.0,
+        n: int = 0,
+    ):
+        self.names = list(names or ["log_surface"])
+        self.columns = {name: i for i, name in enumerate(self.names)}
+        self.xtx = xtx if xtx is not None else csr_matrix((len(self.names),) * 2)
+        self.xty = xty if xty is not None else np.zeros(len(self.names))
+        self.yty = float(yty)
+        self.n = int(n)
+
+    def _column(self, name: str) -> int:
+        if name not in self.columns:
+            self.columns[name] = len(self.names)
+            self.names.append(name)
+        return self.columns[name]
+
+    def add(self, listings: pd.DataFrame, sign: int = 1) -> int:
+        """
+        Add the listings to the statistics, or take them out with sign=-1.
+
+        Returns:
+            int: The number of listings that could be fitted.
+        """
+        y, log_surface, terms = design_terms(listings)
+        if not len(y):
+            return 0
+        columns = [np.zeros(len(y), np.int64)] + [
+            np.array([self._column(name) for name in names])[codes]
+            for codes, names in terms.values()
+        ]
+        rows = np.tile(np.arange(len(y)), len(columns))
+        # one log surface and one indicator per factor and neighbourhood a row
+        x = coo_matrix(
+            (
+                np.concatenate([log_surface, np.ones(len(y) * len(terms))]),
+                (rows, np.concatenate(columns)),
+            ),
+            shape=(len(y), len(self.names)),
+        ).tocsr()
+        self.xtx.resize((len(self.names),) * 2)
+        self.xtx = self.xtx + sign * (x.T @ x).tocsr()
+        self.xtx.eliminate_zeros()
+        self.xty = np.concatenate(
+            [self.xty, np.zeros(len(self.names) - len(self.xty))]
+        ) + sign * (x.T @ y)
+        self.yty += sign * float(y @ y)
+        self.n += sign * len(y)
+        return len(y)
+
+    def fit(self) -> dict:
+        """
+        Solve the normal equations.
+
+        The neighbourhood indicators partition the listings, so their block of
+        X'X is diagonal (the listings of each neighbourhood) and is absorbed
+        into a dense system over the other columns only. The most common level
+        of each factor is the reference and has no column.
+
+        Returns:
+            dict: "coefficients" (pd.Series by column name), "effects"
+                (neighbourhood fixed effects), "listings" (per neighbourhood),
+                "reference" (the standard dwelling) and "sigma" (residual
+                standard deviation).
+        """
+        if self.n <= 0:
+            raise ValueError("No listings to fit")
+        names = np.asarray(self.names)
+        counts = self.xtx.diagonal()
+        # rounding leaves tiny counts of levels whose listings were all removed
+        active = counts > 0.5
+        group = np.array([name.partition("=")[0] for name in self.names])
+        fixed = np.flatnonzero(active & (group == "neighbourhood"))
+        reference = {}
+        covariates = [0]
+        for factor in FACTORS:
+            levels = np.flatnonzero(active & (group == factor))
+            if not len(levels):
+                continue
+            modal = levels[np.argmax(counts[levels])]
+            reference[factor] = names[modal].partition("=")[2]
+            covariates += [level for level in levels if level != modal]
+        covariates = np.asarray(covariates)
+
+        xtx = self.xtx.tocsc()[:, covariates].tocsr()
+        n_g = counts[fixed]
+        b = xtx[fixed].toarray()
+        c = xtx[covariates].toarray()
+        # Schur complement of the diagonal neighbourhood block
+        s = c - b.T @ (b / n_g[:, None])
+        r = self.xty[covariates] - b.T @ (self.xty[fixed] / n_g)
+        beta = np.linalg.lstsq(s, r, rcond=None)[0]
+        alpha = (self.xty[fixed] - b @ beta) / n_g
+
+        # at the solution θ'X'Xθ = θ'X'y
+        sse = self.yty - alpha @ self.xty[fixed] - beta @ self.xty[covariates]
+        dof = max(self.n - len(fixed) - np.linalg.matrix_rank(s), 1)
+        # each row has one neighbourhood, so the log surfaces add up there
+        reference["log_surface"] = float(b[:, 0].sum() / n_g.sum())
+        return {
+            "coefficients": pd.Series(beta, index=names[covariates]),
+            "effects": pd.Series(alpha, index=names[fixed]),
+            "listings": pd.Series(n_g.round().astype(np.int64), index=names[fixed]),
+            "reference": reference,
+            "sigma": float(np.sqrt(max(sse, 0.0) / dof)),
+        }
+
+    def index(self) -> pd.DataFrame:
+        """
+        Quality-adjusted prices of every neighbourhood.
+
+        Returns:
+            pd.DataFrame: city, macrozone, neighbourhood, listings, index (log
+                model price of the standard dwelling), index_per_sqm, relative
+                (to the listing-weighted average neighbourhood) and se (standard
+                error of the log index, ignoring the error of the coefficients).
+        """
+        fit = self.fit()
+        effects, listings = fit["effects"], fit["listings"]
+        log_surface = fit["reference"]["log_surface"]
+        log_index = effects + fit["coefficients"]["log_surface"] * log_surface
+        average = np.average(effects, weights=listings)
+        location = pd.DataFrame(
+            [key.partition("=")[2].split("|") for key in effects.index],
+            columns=LOCATION,
+        )
+        return location.assign(
+            listings=listings.to_numpy(),
+            index=np.exp(log_index.to_numpy()).round(0),
+            index_per_sqm=np.exp(log_index.to_numpy() - log_surface).round(2),
+            relative=np.exp(effects.to_numpy() - average).round(4),
+            se=(fit["sigma"] / np.sqrt(listings.to_numpy())).round(4),
+        )
+
+    def arrays(self, prefix: str) -> dict:
+        xtx = self.xtx.tocsr()
+        return {
+            f"{prefix}_names": np.asarray(self.names, dtype=str),
+            f"{prefix}_data": xtx.data,
+            f"{prefix}_indices": xtx.indices.astype(np.int32),
+            f"{prefix}_indptr": xtx.indptr.astype(np.int64),
+            f"{prefix}_xty": self.xty,
+            f"{prefix}_totals": np.array([self.yty, self.n]),
+        }
+
+    @classmethod
+    def from_arrays(cls, data, prefix: str) -> "HedonicStats":
+        names = data[f"{prefix}_names"].tolist()
+        xtx = csr_matrix(
+            (
+                data[f"{prefix}_data"],
+                data[f"{prefix}_indices"],
+                data[f"{prefix}_indptr"],
+            ),
+            shape=(len(names),) * 2,
+        )
+        yty, n = data[f"{prefix}_totals"]
+        return cls(names, xtx, data[f"{prefix}_xty"], yty, n)
+
+
+def save_stats(stats: dict, path: pathlib.Path) -> pathlib.Path:
+    """Save {contract: HedonicStats} as a compressed .npz."""
+    arrays = {"contracts": np.asarray(list(stats), dtype=str)}
+    for contract, contract_stats in stats.items():
+        arrays.update(contract_stats.arrays(contract))
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(path, **arrays)
+    return path
+
+
+def load_stats(path: pathlib.Path) -> dict:
+    """{contract: HedonicStats} saved by save_stats."""
+    with np.load(path) as data:
+        return {
+            contract: HedonicStats.from_arrays(data, contract)
+            for contract in data["contracts"].tolist()
+        }
+
+
+def changed_listings(previous: pd.DataFrame, current: pd.DataFrame) -> tuple:
+    """
+    Listings to take out of and to add to the previous statistics.
+
+    A listing whose FEATURES changed is taken out with its old values and
+    added back with the new ones.
+
+    Returns:
+        tuple: (removed, added) DataFrames with the FEATURES and contract.
+    """
+    columns = ["contract"] + FEATURES
+
+    def hashed(listings: pd.DataFrame) -> pd.DataFrame:
+        # the same values hash alike whatever dtype a table was read with, and
+        # strings are hashed once per distinct value as categories
+        features = listings[columns].astype(
+            {
+                column: np.float64 if column in NUMERIC else "category"
+                for column in columns
+            }
+        )
+        hashes = pd.util.hash_pandas_object(features, index=False).to_numpy()
+        return pd.DataFrame(
+            {"id": listings["id"], "hash": pd.array(hashes, dtype="UInt64")}
+        )
+
+    # ids are unique across contracts, a listing moving contract is a change
+    merged = hashed(previous).merge(
+        hashed(current), on="id", how="outer", suffixes=("_old", "_new")
+    )
+    changed = merged["hash_old"].ne(merged["hash_new"]).fillna(True)
+    removed = merged.loc[changed & merged["hash_old"].notna(), "id"]
+    added = merged.loc[changed & merged["hash_new"].notna(), "id"]
+    return (
+        previous.loc[previous["id"].isin(removed), columns],
+        current.loc[current["id"].isin(added), columns],
+    )
+
+
+def previous_stats(root: pathlib.Path, date: str) -> pathlib.Path:
+    """The statistics of the latest snapshot before date, None if there are none."""
+    paths = sorted(
+        path
+        for path in pathlib.Path(root).glob(f"*/out/{STATS_FILE}")
+        if path.parent.parent.name < date
+    )
+    return paths[-1] if paths else None
+
+
+def update_stats(
+    root: pathlib.Path = LISTINGS_ROOT, date: str = None, full: bool = False
+) -> dict:
+    """
+    Bring the statistics up to a snapshot and write its index.
+
+    The statistics of the previous snapshot are updated with the listings that
+    changed since; the first snapshot, or full=True, adds every listing.
+
+    Args:
+        root (pathlib.Path): Directory holding the daily snapshots.
+        date (str): Snapshot to fit (yymmdd), today when not given.
+        full (bool): Rebuild the statistics from the snapshot alone.
+
+    Returns:
+        dict: {contract: HedonicStats}, also saved to
+            <root>/<yymmdd>/out/hedonic_stats.npz, with the index in
+            <root>/<yymmdd>/out/hedonic_index.csv.
+    """
+    date = date or time.strftime("%y%m%d")
+    snapshot_dir = pathlib.Path(root) / date
+    start = time.perf_counter()
+    current = warehouse.read_snapshot(snapshot_dir)
+    path = None if full else previous_stats(root, date)
+    if path is None:
+        stats, removed, added = {}, current.iloc[:0], current
+    else:
+        stats = load_stats(path)
+        previous = warehouse.read_snapshot(path.parent.parent)
+        removed, added = changed_listings(previous, current)
+        logging.info(
+            f"Updating the statistics of {path.parent.parent.name}: "
+            f"{len(removed)} listings out, {len(added)} in"
+        )
+    for contract, listings in removed.groupby("contract"):
+        stats.setdefault(contract, HedonicStats()).add(listings, sign=-1)
+    for contract, listings in added.groupby("contract"):
+        stats.setdefault(contract, HedonicStats()).add(listings)
+    save_stats(stats, snapshot_dir / "out" / STATS_FILE)
+
+    indexes = []
+    for contract, contract_stats in sorted(stats.items()):
+        if contract_stats.n > 0:
+            indexes.append(contract_stats.index().assign(contract=contract))
+    index = pd.concat(indexes, ignore_index=True)
+    index = index[["contract"] + [c for c in index.columns if c != "contract"]]
+    index.to_csv(snapshot_dir / "out" / INDEX_FILE, index=False)
+    logging.info(
+        f"Indexed {len(index)} neighbourhoods of "
+        f"{sum(s.n for s in stats.values())} listings in "
+        f"{time.perf_counter() - start:.2f} s"
+    )
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hedonic neighbourhood price index")
+    parser.add_argument("action", choices=["update", "show"])
+    parser.add_argument("--root", type=pathlib.Path, default=LISTINGS_ROOT)
+    parser.add_argument("--date", default=None, help="yymmdd (default: today)")
+    parser.add_argument(
+        "--full", action="store_true", help="rebuild instead of updating"
+    )
+    parser.add_argument("--contract", default="sale")
+    parser.add_argument("--city", default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.action == "update":
+        update_stats(args.root, args.date, args.full)
+    else:
+        date = args.date or time.strftime("%y%m%d")
+        stats = load_stats(pathlib.Path(args.root) / date / "out" / STATS_FILE)
+        fit = stats[args.contract].fit()
+        print(f"Standard dwelling: {fit['reference']}, sigma {fit['sigma']:.3f}")
+        print(fit["coefficients"].round(4).to_string())
+        index = stats[args.contract].index()
+        if args.city:
+            index = index[index["city"] == args.city]
+        print(index.sort_values("index", ascending=False).to_string(index=False))
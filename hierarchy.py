@@ -0,0 +1,350 @@
+# The region -> province -> city -> macrozone -> neighbourhood hierarchy of
+# immobiliare.it, held as plain dictionaries so id <-> name lookups and
+# parent/child traversal are O(1) instead of boolean masks over a DataFrame.
+# It is built from the city info the API returns (or Milano_city_info.json),
+# or loaded once per process from table_builder/index_table.csv.
+#
+#   tree = hierarchy.load()                      # index_table.csv, cached
+#   tree.name("macrozone", 10046)                # "Centro"
+#   tree.parent("neighbourhood", 10240)          # 10046
+#   tree.children("macrozone", 10046)            # [10240, ...]
+#
+# Macrozone centroids, the mean coordinates of the listings in each
+# macrozone, are cached in table_builder/macrozone_centroids.csv so that
+# geographic joins (e.g. the neighbouring macrozones of valuation.py) do not
+# depend on the listings of one day:
+#
+#   python hierarchy.py centroids --date 231019 --contract sale
+
+import argparse
+import json
+import logging
+import pathlib
+
+import pandas as pd
+
+INDEX_TABLE = pathlib.Path("./table_builder/index_table.csv")
+CENTROIDS_FILE = pathlib.Path("./table_builder/macrozone_centroids.csv")
+LISTINGS_ROOT = pathlib.Path("./listings/")
+
+LEVELS = ("region", "province", "city", "macrozone", "neighbourhood")
+# region and province ids are codes ("lom", "MI"), the others are numbers
+NUMERIC_LEVELS = ("city", "macrozone", "neighbourhood")
+FRAME_COLUMNS = [
+    "region_name",
+    "region_id",
+    "province_name",
+    "province_id",
+    "city_name",
+    "city_id",
+    "macrozone_name",
+    "macrozone_keyurl",
+    "macrozone_id",
+    "neighbourhood_name",
+    "neighbourhood_id",
+]
+
+
+def normalize_id(level: str, id) -> object:
+    """The id as stored in the hierarchy: int for numeric levels, else str."""
+    return int(id) if level in NUMERIC_LEVELS else str(id)
+
+
+class Hierarchy:
+    """
+    Dictionary-backed hierarchy of the areas immobiliare.it searches by.
+
+    Nodes are identified by their level and id. Cities without macrozones
+    are stored as leaves, and appear in to_frame() with macrozone and
+    neighbourhood id 0, as in index_table.csv.
+    """
+
+    def __init__(self):
+        self.names = {level: {} for level in LEVELS}
+        self.ids = {level: {} for level in LEVELS}
+        self.parents = {level: {} for level in LEVELS}
+        self._children = {level: {} for level in LEVELS}
+        self.keyurls = {}
+        self.centroids = {level: {} for level in LEVELS}
+
+    def add(self, path: list) -> None:
+        """
+        Add the nodes of a path from a region downwards.
+
+        Args:
+            path (list): (id, name) pairs, one per level starting from the
+                region. Nodes that are already known are left unchanged.
+        """
+        parent_level = parent_id = None
+        for level, (id, name) in zip(LEVELS, path):
+            id = normalize_id(level, id)
+            if id not in self.names[level]:
+                self.names[level][id] = name
+                self.ids[level].setdefault(name, []).append(id)
+                self._children[level][id] = []
+                if parent_level is not None:
+                    self.parents[level][id] = parent_id
+                    self._children[parent_level][parent_id].append(id)
+            parent_level, parent_id = level, id
+
+    @classmethod
+    def from_city_info(cls, city_info: dict, tree: "Hierarchy" = None) -> "Hierarchy":
+        """
+        Hierarchy of a city from the autocomplete or macrozones API response.
+
+        Args:
+            city_info (dict): A city, e.g. the content of Milano_city_info.json.
+            tree (Hierarchy): Hierarchy to add the city to, a new one if None.
+        """
+        tree = tree or cls()
+        province, region = city_info["parents"][0], city_info["parents"][1]
+        city = [
+            (region["id"], region["label"]),
+            (province["id"], province["label"]),
+            (city_info["id"], city_info["label"]),
+        ]
+        tree.add(city)
+        for macrozone in city_info.get("macrozones") or []:
+            tree.keyurls[int(macrozone["id"])] = macrozone.get("keyurl", "")
+            for child in macrozone["children"]:
+                tree.add(
+                    city
+                    + [
+                        (macrozone["id"], macrozone["label"]),
+                        (child["id"], child["label"]),
+                    ]
+                )
+        center = city_info.get("center")
+        if center:
+            tree.centroids["city"][int(city_info["id"])] = (
+                center["lat"],
+                center["lng"],
+            )
+        return tree
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "Hierarchy":
+        """Hierarchy of a table laid out like index_table.csv."""
+        tree = cls()
+        columns = [df[f"{level}_{key}"] for level in LEVELS for key in ("id", "name")]
+        keyurls = (
+            df["macrozone_keyurl"]
+            if "macrozone_keyurl" in df
+            else pd.Series("", index=df.index)
+        )
+        for row, keyurl in zip(zip(*columns), keyurls.fillna("")):
+            path = list(zip(row[::2], row[1::2]))
+            # macrozone id 0 marks a city without macrozones
+            if int(path[3][0]) == 0:
+                path = path[:3]
+            else:
+                tree.keyurls[int(path[3][0])] = keyurl
+            tree.add(path)
+        return tree
+
+    @classmethod
+    def from_index_table(cls, path: pathlib.Path = INDEX_TABLE) -> "Hierarchy":
+        # "" names, not NaN, for the cities without macrozones
+        return cls.from_frame(pd.read_csv(path, dtype=str, keep_default_na=False))
+
+    def name(self, level: str, id) -> str:
+        return self.names[level][normalize_id(level, id)]
+
+    def find(self, level: str, name: str, parent=None) -> object:
+        """
+        The id of the node of a level with this name.
+
+        Args:
+            level (str): One of LEVELS.
+            name (str): Name of the node.
+            parent: Id of the parent node, needed for names used in several
+                places (e.g. the "Centro" macrozone of most cities).
+
+        Raises:
+            KeyError: If no node, or more than one, matches.
+        """
+        ids = self.ids[level].get(name, [])
+        if parent is not None:
+            parent_level = LEVELS[LEVELS.index(level) - 1]
+            parent = normalize_id(parent_level, parent)
+            ids = [id for id in ids if self.parents[level].get(id) == parent]
+        if len(ids) != 1:
+            raise KeyError(f"{len(ids)} {level}s named {name!r}")
+        return ids[0]
+
+    def parent(self, level: str, id) -> object:
+        """Id of the parent node, None for regions."""
+        return self.parents[level].get(normalize_id(level, id))
+
+    def ancestors(self, level: str, id) -> dict:
+        """Ids of the node and of all the nodes above it, by level."""
+        path = {}
+        id = normalize_id(level, id)
+        for current in LEVELS[LEVELS.index(level) :: -1]:
+            path[current] = id
+            id = self.parents[current].get(id)
+        return path
+
+    def children(self, level: str, id) -> list:
+        return list(self._children[level][normalize_id(level, id)])
+
+    def members(self, level: str) -> list:
+        """Ids of every node of a level, in the order they were added."""
+        return list(self.names[level])
+
+    def centroid(self, level: str, id) -> tuple:
+        """(latitude, longitude) of a city or macrozone, None if unknown."""
+        return self.centroids[level].get(normalize_id(level, id))
+
+    def load_centroids(self, path: pathlib.Path = CENTROIDS_FILE) -> None:
+        path = pathlib.Path(path)
+        if not path.exists():
+            return
+        centroids = pd.read_csv(path)
+        self.centroids["macrozone"].update(
+            zip(
+                centroids["macrozone_id"].astype(int),
+                zip(centroids["latitude"], centroids["longitude"]),
+            )
+        )
+
+    def to_frame(self) -> pd.DataFrame:
+        """The hierarchy laid out like index_table.csv, one row per neighbourhood."""
+        rows = []
+        for region_id, region_name in self.names["region"].items():
+            for province_id in self._children["region"][region_id]:
+                for city_id in self._children["province"][province_id]:
+                    city = [
+                        region_name,
+                        region_id,
+                        self.names["province"][province_id],
+                        province_id,
+                        self.names["city"][city_id],
+                        city_id,
+                    ]
+                    macrozones = self._children["city"][city_id]
+                    if not macrozones:
+                        rows.append(city + ["", "", 0, "", 0])
+                    for macrozone_id in macrozones:
+                        macrozone = [
+                            self.names["macrozone"][macrozone_id],
+                            self.keyurls.get(macrozone_id, ""),
+                            macrozone_id,
+                        ]
+                        for neighbourhood_id in self._children["macrozone"][
+                            macrozone_id
+                        ]:
+                            rows.append(
+                                city
+                                + macrozone
+                                + [
+                                    self.names["neighbourhood"][neighbourhood_id],
+                                    neighbourhood_id,
+                                ]
+                            )
+        return pd.DataFrame(rows, columns=FRAME_COLUMNS)
+
+
+_loaded = {}
+
+
+def load(
+    path: pathlib.Path = INDEX_TABLE, centroids: pathlib.Path = CENTROIDS_FILE
+) -> Hierarchy:
+    """
+    The hierarchy of an index table, parsed once per process.
+
+    The table is parsed again only if the file changed since. Cached
+    macrozone centroids are attached when the centroids file exists.
+    """
+    path = pathlib.Path(path)
+    key = (path.resolve(), path.stat().st_mtime_ns)
+    if key not in _loaded:
+        tree = Hierarchy.from_index_table(path)
+        tree.load_centroids(centroids)
+        _loaded.clear()
+        _loaded[key] = tree
+    return _loaded[key]
+
+
+def snapshot_centroids(
+    root: pathlib.Path = LISTINGS_ROOT, date: str = None, contract: str = "sale"
+) -> pd.DataFrame:
+    """
+    Mean coordinates of the listings of each macrozone in a snapshot.
+
+    The macrozone of a page is read from its file name
+    (<region>_<province>_<city>_<macrozone>_...), so listings need no lookup.
+
+    Returns:
+        pd.DataFrame: macrozone_id, latitude, longitude and listings.
+    """
+    import data_processor
+
+    macrozones, latitudes, longitudes = [], [], []
+    for path in data_processor.partition(root, date, "json", contract).glob("*.json"):
+        macrozone_id = int(path.stem.split("_")[3])
+        if macrozone_id == 0:
+            continue
+        with open(path) as f:
+            try:
+                results = json.load(f).get("results") or []
+            except json.decoder.JSONDecodeError:
+                continue
+        for result in results:
+            properties = ((result.get("realEstate") or {}).get("properties") or [{}])[0]
+            location = properties.get("location") or {}
+            if location.get("latitude") is None or location.get("longitude") is None:
+                continue
+            macrozones.append(macrozone_id)
+            latitudes.append(location["latitude"])
+            longitudes.append(location["longitude"])
+    return (
+        pd.DataFrame(
+            {"macrozone_id": macrozones, "latitude": latitudes, "longitude": longitudes}
+        )
+        .groupby("macrozone_id")
+        .agg(
+            latitude=("latitude", "mean"),
+            longitude=("longitude", "mean"),
+            listings=("latitude", "size"),
+        )
+        .reset_index()
+    )
+
+
+def save_centroids(
+    centroids: pd.DataFrame, path: pathlib.Path = CENTROIDS_FILE
+) -> None:
+    """Merge centroids into the cache, replacing the macrozones they cover."""
+    path = pathlib.Path(path)
+    if path.exists():
+        cached = pd.read_csv(path)
+        cached = cached[~cached["macrozone_id"].isin(centroids["macrozone_id"])]
+        centroids = pd.concat([cached, centroids], ignore_index=True)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    centroids.sort_values("macrozone_id").to_csv(path, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Neighbourhood hierarchy")
+    actions = parser.add_subparsers(dest="action", required=True)
+    action = actions.add_parser(
+        "centroids", help="cache the macrozone centroids of a snapshot"
+    )
+    action.add_argument("--root", type=pathlib.Path, default=LISTINGS_ROOT)
+    action.add_argument("--date", default=None, help="yymmdd (default: today)")
+    action.add_argument("--contract", default="sale")
+    action.add_argument("--output", type=pathlib.Path, default=CENTROIDS_FILE)
+    action = actions.add_parser("stats", help="count the nodes of each level")
+    action.add_argument("--index-table", type=pathlib.Path, default=INDEX_TABLE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.action == "centroids":
+        centroids = snapshot_centroids(args.root, args.date, args.contract)
+        save_centroids(centroids, args.output)
+        logging.info(f"Cached the centroids of {len(centroids)} macrozones")
+    else:
+        tree = load(args.index_table)
+        print(json.dumps({level: len(tree.names[level]) for level in LEVELS}))
@@ -0,0 +1,340 @@
+# On-disk HTTP response cache shared by every requests call of the pipeline,
+# so that parsing, summary and NLP work can be iterated on without re-hitting
+# immobiliare.it. Responses are stored zlib-compressed in a single SQLite file
+# and keyed on the method, URL and sorted query parameters, so the same
+# generate_payloads() payload always maps to the same entry whatever the
+# parameter order or value types.
+#
+# Modes:
+#   off      every request goes to the network (the default)
+#   normal   fresh entries are served from the cache, misses are fetched and stored
+#   record   every request goes to the network and its response is stored
+#   replay   only the cache is used, a miss raises CacheMiss
+#
+# The mode can be set with configure() or the CERCOCASE_HTTP_CACHE environment
+# variable, e.g. `CERCOCASE_HTTP_CACHE=replay python cercocase.py compile`.
+
+import argparse
+import atexit
+import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+import urllib.parse
+import zlib
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import instrumentation
+import transport
+
+MODES = ("off", "normal", "record", "replay")
+CACHE_PATH = pathlib.Path(
+    os.environ.get("CERCOCASE_HTTP_CACHE_PATH", "./.http_cache/responses.sqlite")
+)
+DEFAULT_TTL_S = 24 * 3600
+DEFAULT_MAX_BYTES = 2 * 2**30
+COMPRESSION_LEVEL = 6
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    method TEXT NOT NULL,
+    url TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed);
+"""
+
+
+class CacheMiss(requests.exceptions.ConnectionError):
+    """Raised in replay mode for a request that was never recorded."""
+
+
+def cache_key(method: str, url: str) -> str:
+    """
+    Normalised key of a request.
+
+    The query string is decoded and sorted, so {"pag": 1, "idComune": 8042}
+    and {"idComune": "8042", "pag": "1"} share an entry.
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+    canonical = "\n".join(
+        [
+            method.upper(),
+            parts.scheme.lower(),
+            parts.netloc.lower(),
+            parts.path.rstrip("/") or "/",
+            urllib.parse.urlencode(query),
+        ]
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class HTTPCache:
+    """
+    Compressed response store with TTL and size-based eviction.
+
+    Args:
+        path (pathlib.Path): SQLite file holding the responses.
+        mode (str): One of MODES.
+        ttl (float): Seconds an entry is served in normal mode, None for ever.
+        max_bytes (int): Compressed size above which the least recently used
+            entries are evicted.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path = CACHE_PATH,
+        mode: str = "normal",
+        ttl: float = DEFAULT_TTL_S,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        if mode not in MODES:
+            raise ValueError(f"Unknown cache mode {mode!r}, use one of {MODES}")
+        self.path = pathlib.Path(path)
+        self.mode = mode
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._conn = None
+        self._size = 0
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # opened on first use, so mode "off" never touches the disk
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+            self._conn.executescript(SCHEMA)
+            self._size = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+        return self._conn
+
+    def get(self, key: str, request: requests.PreparedRequest) -> requests.Response:
+        """Return the cached response for key, or None on a miss."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status, headers, body, created FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            status, headers, body, created = row
+            # replay serves whatever was recorded, however old
+            if self.mode == "normal" and self.ttl and time.time() - created > self.ttl:
+                return None
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE responses SET accessed = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(json.loads(headers))
+        response._content = zlib.decompress(body)
+        # iter_content and stream=True readers find the body already read
+        response._content_consumed = True
+        response.raw = io.BytesIO(response._content)
+        response.url = request.url
+        response.request = request
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.elapsed = datetime.timedelta(0)
+        response.from_cache = True
+        return response
+
+    def put(self, key: str, response: requests.Response) -> None:
+        body = zlib.compress(response.content, COMPRESSION_LEVEL)
+        # the body is stored decoded, so the transfer headers no longer apply
+        headers = {
+            name: value
+            for name, value in response.headers.items()
+            if name.lower()
+            not in ("content-encoding", "content-length", "transfer-encoding")
+        }
+        now = time.time()
+        with self.lock:
+            previous = self.conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        key,
+                        response.request.method,
+                        response.url,
+                        response.status_code,
+                        json.dumps(headers),
+                        body,
+                        len(body),
+                        now,
+                        now,
+                    ),
+                )
+            self._size += len(body) - (previous[0] if previous else 0)
+            if self.max_bytes and self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        # drop the least recently used entries down to 90% of the limit
+        target = self.max_bytes * 0.9
+        evicted = 0
+        with self.conn:
+            for key, size in self.conn.execute(
+                "SELECT key, size FROM responses ORDER BY accessed"
+            ).fetchall():
+                if self._size <= target:
+                    break
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size -= size
+                evicted += 1
+        logging.info(f"Evicted {evicted} cached responses")
+
+    def expire(self) -> int:
+        """Delete the entries older than the TTL."""
+        if not self.ttl:
+            return 0
+        with self.lock, self.conn:
+            deleted = self.conn.execute(
+                "DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,)
+            ).rowcount
+            self._size = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+        return deleted
+
+    def clear(self) -> None:
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM responses")
+            self._size = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries, size = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {"entries": entries, "compressed_bytes": size, "mode": self.mode}
+
+
+_default_cache = HTTPCache(mode=os.environ.get("CERCOCASE_HTTP_CACHE", "off"))
+
+
+def configure(
+    mode: str = None,
+    path: pathlib.Path = None,
+    ttl: float = None,
+    max_bytes: int = None,
+) -> HTTPCache:
+    """Replace the cache used by sessions that were not given one."""
+    global _default_cache
+    _default_cache = HTTPCache(
+        path or _default_cache.path,
+        mode or _default_cache.mode,
+        _default_cache.ttl if ttl is None else ttl,
+        _default_cache.max_bytes if max_bytes is None else max_bytes,
+    )
+    return _default_cache
+
+
+def default_cache() -> HTTPCache:
+    return _default_cache
+
+
+class CachedSession(requests.Session):
+    """
+    requests.Session that goes through an HTTPCache.
+
+    Only GET requests are cached, and only responses with a status below 400
+    are stored. Cached responses carry `from_cache = True` and do not run the
+    session's response hooks, since no request was made.
+
+    Args:
+        cache (HTTPCache): The cache to use, the configured default if None.
+        pool_size (int): Concurrent requests the session is shared by, which
+            sizes the connection pool of the configured transport.
+    """
+
+    def __init__(self, cache: HTTPCache = None, pool_size: int = None):
+        super().__init__()
+        self.cache = cache
+        transport.mount(self, pool_size=pool_size or transport.DEFAULT_POOL_SIZE)
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        cache = self.cache or _default_cache
+        if cache.mode == "off" or request.method != "GET":
+            return self.fetch(request, **kwargs)
+
+        key = cache_key(request.method, request.url)
+        if cache.mode in ("normal", "replay"):
+            response = cache.get(key, request)
+            if response is not None:
+                instrumentation.count("http_cache_hits_total")
+                return response
+            if cache.mode == "replay":
+                instrumentation.count("http_cache_misses_total")
+                raise CacheMiss(
+                    f"Not in the HTTP cache: {request.url}", request=request
+                )
+
+        instrumentation.count("http_cache_misses_total")
+        response = self.fetch(request, **kwargs)
+        if response.status_code < 400:
+            cache.put(key, response)
+        return response
+
+    def fetch(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        """Send a request over the network, the hook for subclasses."""
+        return super().send(request, **kwargs)
+
+
+# threads of a default ThreadPoolExecutor share the session of get()
+SHARED_POOL_SIZE = 32
+_shared = {"session": None, "lock": threading.Lock()}
+
+
+def shared_session() -> CachedSession:
+    """The session of get(), created on first use and closed at exit."""
+    with _shared["lock"]:
+        if _shared["session"] is None:
+            _shared["session"] = CachedSession(pool_size=SHARED_POOL_SIZE)
+            atexit.register(_shared["session"].close)
+        return _shared["session"]
+
+
+def get(url: str, params: dict = None, **kwargs) -> requests.Response:
+    """Drop-in for requests.get() that goes through the default cache."""
+    return shared_session().get(url, params=params, **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or trim the HTTP cache")
+    parser.add_argument("action", choices=("stats", "expire", "clear"))
+    parser.add_argument("--path", type=pathlib.Path, default=CACHE_PATH)
+    parser.add_argument("--ttl", type=float, default=DEFAULT_TTL_S)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    cache = HTTPCache(args.path, ttl=args.ttl)
+    if args.action == "expire":
+        logging.info(f"Deleted {cache.expire()} expired responses")
+    elif args.action == "clear":
+        cache.clear()
+    print(json.dumps(cache.stats()))
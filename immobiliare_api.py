@@ -2,6 +2,8 @@ import pandas as pd
 import requests
 import glob
 
+import http_cache
+
 AUTOCOMPLETE_ENDPOINT = 'https://www.immobiliare.it/search/autocomplete'
 LISTINGS_ENDPOINT = 'https://www.immobiliare.it/api-next/search-list/real-estates/'
 
@@ -43,7 +45,7 @@ def get_response(payload: dict) -> dict:
         dict: The JSON response from the API.
     """
     try:
-        response = requests.get(AUTOCOMPLETE_ENDPOINT, params=payload)
+        response = http_cache.get(AUTOCOMPLETE_ENDPOINT, params=payload)
         response.raise_for_status()
     except requests.exceptions.RequestException as err:
         print(f"API request failed due to {err}")
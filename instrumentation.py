@@ -0,0 +1,407 @@
+# Lightweight per-stage instrumentation for the crawl and compile pipeline.
+#
+# Spans (timed sections), counters and per-request HTTP statistics are kept in
+# a process-wide registry and can be exported as Prometheus text or as a JSON
+# trace (Chrome trace event format, viewable in chrome://tracing or Perfetto).
+# Everything is a no-op until enable() is called, so the hooks can stay in
+# the hot paths. With profiling on, functions decorated with @hot are run
+# under a per-thread cProfile and the merged stats are written at exit.
+
+import argparse
+import collections
+import contextlib
+import cProfile
+import functools
+import io
+import json
+import logging
+import pathlib
+import pstats
+import threading
+import time
+
+ENABLED = False
+PROFILING = False
+
+# seconds; the buckets of the exported Prometheus histograms
+HISTOGRAM_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Registry:
+    """Thread-safe store of finished spans and counters."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.counters = collections.Counter()
+
+    def add_span(self, name: str, start: float, duration: float, attrs: dict) -> None:
+        with self.lock:
+            self.spans.append(
+                (name, start, duration, threading.get_ident(), attrs or None)
+            )
+
+    def add(self, name: str, value: float = 1, **labels) -> None:
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def reset(self) -> None:
+        with self.lock:
+            self.origin = time.perf_counter()
+            self.spans.clear()
+            self.counters.clear()
+
+
+REGISTRY = Registry()
+_profiles = []
+_profiles_lock = threading.Lock()
+_thread_state = threading.local()
+
+
+def enable(profile: bool = False) -> None:
+    """Start recording spans and counters, and optionally profile @hot functions."""
+    global ENABLED, PROFILING
+    ENABLED = True
+    PROFILING = profile
+    _instrument_connections()
+
+
+def disable() -> None:
+    global ENABLED, PROFILING
+    ENABLED = False
+    PROFILING = False
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs):
+    """Time the enclosed block as a span called name."""
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.add_span(name, start, time.perf_counter() - start, attrs)
+
+
+def count(name: str, value: float = 1, **labels) -> None:
+    """Increase a counter, e.g. count("bytes_in", len(body), stage="download")."""
+    if ENABLED:
+        REGISTRY.add(name, value, **labels)
+
+
+def traced(name: str = None):
+    """Decorator recording every call of a function as a span."""
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def hot(func):
+    """
+    Mark a function for profiling.
+
+    Calls are traced as spans when instrumentation is enabled and run under a
+    per-thread cProfile when profiling is on, so worker threads are covered.
+    """
+    traced_func = traced()(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not PROFILING:
+            return traced_func(*args, **kwargs)
+        profile = getattr(_thread_state, "profile", None)
+        if profile is None:
+            profile = _thread_state.profile = cProfile.Profile()
+            with _profiles_lock:
+                _profiles.append(profile)
+        # nested @hot calls are already covered by the outer one
+        if getattr(_thread_state, "profiling", False):
+            return traced_func(*args, **kwargs)
+        _thread_state.profiling = True
+        profile.enable()
+        try:
+            return traced_func(*args, **kwargs)
+        finally:
+            profile.disable()
+            _thread_state.profiling = False
+
+    return wrapper
+
+
+def submit(executor, func, *args, **kwargs):
+    """
+    executor.submit() that records how long each task waited in the queue.
+    """
+    if not ENABLED:
+        return executor.submit(func, *args, **kwargs)
+    queued = time.perf_counter()
+
+    def run():
+        now = time.perf_counter()
+        REGISTRY.add_span("queue_wait", queued, now - queued, {"task": func.__name__})
+        return func(*args, **kwargs)
+
+    return executor.submit(run)
+
+
+class CountingBody:
+    """Raw body of a streamed response that counts bytes_in_total as it is read."""
+
+    def __init__(self, raw, stage: str):
+        self.raw = raw
+        self.stage = stage
+
+    def stream(self, amt: int = 2**16, *args, **kwargs):
+        if hasattr(self.raw, "stream"):
+            chunks = self.raw.stream(amt, *args, **kwargs)
+        else:
+            chunks = iter(lambda: self.raw.read(amt), b"")
+        for chunk in chunks:
+            REGISTRY.add("bytes_in_total", len(chunk), stage=self.stage)
+            yield chunk
+
+    def read(self, *args, **kwargs) -> bytes:
+        data = self.raw.read(*args, **kwargs)
+        REGISTRY.add("bytes_in_total", len(data), stage=self.stage)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+def instrument_session(session, stage: str):
+    """
+    Record a span, status and byte counts for every response of a requests session.
+
+    The span covers the time to response headers as measured by requests
+    (response.elapsed); connection setup (DNS, TCP and TLS) is recorded
+    separately as "connect" spans.
+    """
+    if not ENABLED:
+        return session
+
+    def on_response(response, *args, **kwargs):
+        elapsed = response.elapsed.total_seconds()
+        REGISTRY.add_span(
+            "http_request",
+            time.perf_counter() - elapsed,
+            elapsed,
+            {"stage": stage, "status": response.status_code},
+        )
+        request = response.request
+        REGISTRY.add("http_requests_total", stage=stage, status=response.status_code)
+        # _content stays False until the body is read
+        if response._content is not False:
+            REGISTRY.add("bytes_in_total", len(response.content), stage=stage)
+        elif "Content-Length" in response.headers:
+            # a stream=True body is left for the caller to read
+            REGISTRY.add(
+                "bytes_in_total", int(response.headers["Content-Length"]), stage=stage
+            )
+        elif response.raw is not None:
+            response.raw = CountingBody(response.raw, stage)
+        REGISTRY.add(
+            "bytes_out_total",
+            len(request.url)
+            + len(request.body or b"")
+            + sum(len(k) + len(v) for k, v in request.headers.items()),
+            stage=stage,
+        )
+        retries = getattr(getattr(response.raw, "retries", None), "history", ())
+        if retries:
+            REGISTRY.add("http_retries_total", len(retries), stage=stage)
+
+    session.hooks["response"].append(on_response)
+    return session
+
+
+def _instrument_connections() -> None:
+    try:
+        from urllib3.connection import HTTPConnection
+    except ImportError:
+        return
+    if getattr(HTTPConnection.connect, "_instrumented", False):
+        return
+    original = HTTPConnection.connect
+
+    def connect(self):
+        if not ENABLED:
+            return original(self)
+        with span("connect", host=self.host):
+            return original(self)
+
+    connect._instrumented = True
+    HTTPConnection.connect = connect
+
+
+def span_summary() -> dict:
+    """Count, total and max duration of the recorded spans, by name."""
+    summary = {}
+    with REGISTRY.lock:
+        spans = list(REGISTRY.spans)
+    for name, _, duration, _, _ in spans:
+        entry = summary.setdefault(name, {"count": 0, "total_s": 0.0, "max_s": 0.0})
+        entry["count"] += 1
+        entry["total_s"] += duration
+        entry["max_s"] = max(entry["max_s"], duration)
+    return summary
+
+
+def export_prometheus(path: pathlib.Path = None) -> str:
+    """Render spans as histograms and counters in the Prometheus text format."""
+    with REGISTRY.lock:
+        spans = list(REGISTRY.spans)
+        counters = dict(REGISTRY.counters)
+
+    lines = [
+        "# HELP cercocase_span_seconds Duration of instrumented pipeline sections.",
+        "# TYPE cercocase_span_seconds histogram",
+    ]
+    by_name = collections.defaultdict(list)
+    for name, _, duration, _, _ in spans:
+        by_name[name].append(duration)
+    for name, durations in sorted(by_name.items()):
+        for bucket in HISTOGRAM_BUCKETS:
+            lines.append(
+                f'cercocase_span_seconds_bucket{{span="{name}",le="{bucket}"}} '
+                f"{sum(d <= bucket for d in durations)}"
+            )
+        lines.append(
+            f'cercocase_span_seconds_bucket{{span="{name}",le="+Inf"}} {len(durations)}'
+        )
+        lines.append(f'cercocase_span_seconds_sum{{span="{name}"}} {sum(durations)}')
+        lines.append(f'cercocase_span_seconds_count{{span="{name}"}} {len(durations)}')
+
+    for metric in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE cercocase_{metric} counter")
+        for (name, labels), value in sorted(counters.items(), key=str):
+            if name == metric:
+                rendered = ",".join(f'{key}="{value_}"' for key, value_ in labels)
+                lines.append(f"cercocase_{name}{{{rendered}}} {value}")
+
+    text = "\n".join(lines) + "\n"
+    if path is not None:
+        pathlib.Path(path).write_text(text)
+    return text
+
+
+def export_trace(path: pathlib.Path) -> None:
+    """Write the spans as a Chrome trace event JSON file."""
+    with REGISTRY.lock:
+        spans = list(REGISTRY.spans)
+        counters = dict(REGISTRY.counters)
+        origin = REGISTRY.origin
+    events = [
+        {
+            "name": name,
+            "ph": "X",
+            "ts": round((start - origin) * 1e6, 1),
+            "dur": round(duration * 1e6, 1),
+            "pid": 0,
+            "tid": thread,
+            "args": attrs or {},
+        }
+        for name, start, duration, thread, attrs in spans
+    ]
+    metadata = {
+        "counters": [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in counters.items()
+        ],
+        "spans": span_summary(),
+    }
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "otherData": metadata}, f)
+
+
+def write_profile(path: pathlib.Path, top: int = 40) -> str:
+    """Merge the per-thread profiles of @hot functions and save them."""
+    with _profiles_lock:
+        profiles = list(_profiles)
+    if not profiles:
+        return ""
+    stats = pstats.Stats(profiles[0])
+    for profile in profiles[1:]:
+        stats.add(profile)
+    stats.dump_stats(path)
+    report = io.StringIO()
+    stats.stream = report
+    stats.sort_stats("cumulative").print_stats(top)
+    return report.getvalue()
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the --metrics, --trace and --profile options to a script's parser."""
+    group = parser.add_argument_group("instrumentation")
+    group.add_argument(
+        "--metrics", type=pathlib.Path, help="write Prometheus text metrics here"
+    )
+    group.add_argument("--trace", type=pathlib.Path, help="write a JSON trace here")
+    group.add_argument(
+        "--profile",
+        nargs="?",
+        const="cprofile",
+        choices=["cprofile", "pyinstrument"],
+        help="profile the hot functions (cProfile) or the main thread (pyinstrument)",
+    )
+    group.add_argument(
+        "--profile-out",
+        type=pathlib.Path,
+        default=pathlib.Path("profile"),
+        help="profile output path, without extension",
+    )
+
+
+@contextlib.contextmanager
+def from_args(args: argparse.Namespace):
+    """Enable what the command line asked for and export it on exit."""
+    profile = getattr(args, "profile", None)
+    if not (args.metrics or args.trace or profile):
+        yield
+        return
+
+    enable(profile=profile == "cprofile")
+    sampler = None
+    if profile == "pyinstrument":
+        try:
+            import pyinstrument
+        except ImportError:
+            logging.warning("pyinstrument is not installed, using cProfile")
+            enable(profile=True)
+        else:
+            sampler = pyinstrument.Profiler()
+            sampler.start()
+    try:
+        with span("run"):
+            yield
+    finally:
+        if sampler is not None:
+            sampler.stop()
+            pathlib.Path(f"{args.profile_out}.html").write_text(sampler.output_html())
+        elif PROFILING:
+            report = write_profile(pathlib.Path(f"{args.profile_out}.prof"))
+            logging.info(f"Hot function profile:\n{report}")
+        if args.metrics:
+            export_prometheus(args.metrics)
+        if args.trace:
+            export_trace(args.trace)
+        for name, entry in sorted(span_summary().items()):
+            logging.info(
+                f"{name}: {entry['count']} spans, {entry['total_s']:.3f}s total, "
+                f"{entry['max_s']:.3f}s max"
+            )
+        disable()
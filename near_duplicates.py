@@ -0,0 +1,285 @@
+# Near-duplicate listings: the same apartment listed by several agencies under
+# different ids, with lightly edited descriptions. Descriptions are reduced to
+# MinHash signatures over word shingles, and locality-sensitive hashing (LSH)
+# buckets signatures that agree on a whole band of rows, so only listings that
+# share a bucket are compared. Listings are also blocked by city and by
+# surface and price band, and one city is processed at a time, so memory is
+# bounded by the largest city rather than the whole corpus.
+#
+#   python near_duplicates.py --contract sale   # out/sale/duplicate_clusters.csv
+#
+#   clusters = pd.read_csv(".../out/sale/duplicate_clusters.csv")
+#   listings = deduplicate(listings, clusters)
+#
+# Every listing gets a cluster_id, the smallest id of its cluster, so single
+# listings keep their own id.
+
+import argparse
+import itertools
+import json
+import logging
+import pathlib
+import re
+import zlib
+
+import numpy as np
+import pandas as pd
+import tqdm
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+import data_processor
+
+LISTINGS_ROOT = pathlib.Path("./listings/")
+CLUSTERS_FILE = "duplicate_clusters.csv"
+
+NUM_PERM = 64
+BANDS = 16  # 4 rows per band: pairs above ~0.5 Jaccard become candidates
+THRESHOLD = 0.7  # estimated Jaccard similarity of a confirmed duplicate
+SHINGLE_WORDS = 3
+BAND_WIDTH = np.log(1.15)  # surface and price bands are 15% wide
+# shingles hashed at once; the hash matrix holds NUM_PERM uint64s per shingle
+HASH_CHUNK = 2**16
+
+WORD = re.compile(r"\w+")
+
+
+def shingle_hashes(descriptions: list) -> tuple:
+    """
+    Hashes of the SHINGLE_WORDS-word shingles of every description.
+
+    Words are hashed once per distinct word, and shingles are combined from
+    the word hashes of the whole batch at once. Descriptions shorter than a
+    shingle count as a single shingle.
+
+    Returns:
+        tuple: Shingle hashes (uint64) and the description of each.
+    """
+    words = [
+        WORD.findall(description.lower()) if isinstance(description, str) else []
+        for description in descriptions
+    ]
+    lengths = np.array([len(w) for w in words], dtype=np.int64)
+    codes, uniques = pd.factorize(
+        pd.Series(list(itertools.chain.from_iterable(words)), dtype=object)
+    )
+    hashes = np.array([zlib.crc32(word.encode()) for word in uniques], dtype=np.uint64)
+    hashes = hashes[codes]
+
+    position = np.arange(len(hashes))
+    doc = np.repeat(np.arange(len(words)), lengths)
+    doc_end = np.repeat(np.cumsum(lengths), lengths)
+    doc_start = doc_end - np.repeat(lengths, lengths)
+    # a shingle starts wherever a full one fits, and at the start of short ones
+    starts = (position + SHINGLE_WORDS <= doc_end) | (position == doc_start)
+    shingles = np.zeros(len(hashes), dtype=np.uint64)
+    for offset in range(SHINGLE_WORDS):
+        shifted = np.zeros(len(hashes), dtype=np.uint64)
+        shifted[: len(hashes) - offset] = hashes[offset:]
+        shifted[position + offset >= doc_end] = 0
+        shingles = shingles * np.uint64(1_000_003) + shifted
+    return shingles[starts], doc[starts]
+
+
+def permutations(num_perm: int = NUM_PERM, seed: int = 0) -> tuple:
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 2**64, num_perm, dtype=np.uint64, endpoint=False) | np.uint64(1)
+    b = rng.integers(0, 2**64, num_perm, dtype=np.uint64, endpoint=False)
+    return a[:, None], b[:, None]
+
+
+def minhash_signatures(
+    descriptions: list, num_perm: int = NUM_PERM, seed: int = 0
+) -> np.ndarray:
+    """
+    MinHash signature of every description.
+
+    Each permutation is a multiply-shift hash, the top 32 bits of
+    (a * x + b) mod 2**64 for a random odd a, which wraps for free in uint64.
+
+    Returns:
+        np.ndarray: (len(descriptions), num_perm) uint32 signatures. Rows of
+            descriptions without words are all 0xFFFFFFFF.
+    """
+    a, b = permutations(num_perm, seed)
+    signatures = np.full((len(descriptions), num_perm), 0xFFFFFFFF, dtype=np.uint32)
+    shingles, docs = shingle_hashes(descriptions)
+    for start in range(0, len(shingles), HASH_CHUNK):
+        chunk = shingles[start : start + HASH_CHUNK]
+        chunk_docs = docs[start : start + HASH_CHUNK]
+        hashed = (a * chunk + b) >> np.uint64(32)
+        # the shingles of a description are contiguous
+        segments = np.flatnonzero(np.diff(chunk_docs, prepend=-1))
+        minimum = np.minimum.reduceat(hashed, segments, axis=1).T
+        rows = chunk_docs[segments]
+        signatures[rows] = np.minimum(signatures[rows], minimum)
+    return signatures
+
+
+def band_index(values: pd.Series, offset: float) -> np.ndarray:
+    """15%-wide logarithmic band of each value, -1 when missing."""
+    values = pd.to_numeric(values, errors="coerce").to_numpy(dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bands = np.floor(np.log(values) / BAND_WIDTH + offset)
+    return np.where(np.isfinite(bands), bands, -1).astype(np.int64)
+
+
+def candidate_pairs(
+    signatures: np.ndarray, blocks: np.ndarray, bands: int = BANDS
+) -> np.ndarray:
+    """
+    Pairs of rows that share a block and an LSH bucket.
+
+    Within a bucket, members are paired with the next one only, so a bucket of
+    n listings costs n - 1 comparisons; duplicates found through any band are
+    joined into clusters afterwards.
+    """
+    rows_per_band = signatures.shape[1] // bands
+    rng = np.random.default_rng(1)
+    pairs = []
+    for band in range(bands):
+        columns = signatures[:, band * rows_per_band : (band + 1) * rows_per_band]
+        coefficients = rng.integers(1, 2**63, rows_per_band, dtype=np.uint64) | 1
+        # uint64 arithmetic wraps, which is fine for a bucket key
+        keys = (columns.astype(np.uint64) * coefficients).sum(axis=1, dtype=np.uint64)
+        order = np.lexsort((keys, blocks))
+        same = (keys[order][1:] == keys[order][:-1]) & (
+            blocks[order][1:] == blocks[order][:-1]
+        )
+        pairs.append(np.column_stack((order[:-1][same], order[1:][same])))
+    return np.unique(np.concatenate(pairs), axis=0) if pairs else np.empty((0, 2), int)
+
+
+def find_clusters(
+    listings: pd.DataFrame,
+    threshold: float = THRESHOLD,
+    num_perm: int = NUM_PERM,
+    bands: int = BANDS,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Cluster the near-duplicate listings of one city (or any block of rows).
+
+    Args:
+        listings (pd.DataFrame): Listings with id, city, surface, price and
+            description columns.
+        threshold (float): Estimated Jaccard similarity of the description
+            shingles above which two listings are duplicates.
+        num_perm (int): MinHash permutations.
+        bands (int): LSH bands, num_perm must be a multiple of it.
+        seed (int): Seed of the MinHash permutations.
+
+    Returns:
+        pd.DataFrame: id and cluster_id of every listing.
+    """
+    listings = listings.drop_duplicates("id").reset_index(drop=True)
+    signatures = minhash_signatures(listings["description"].tolist(), num_perm, seed)
+    has_words = signatures[:, 0] != 0xFFFFFFFF
+
+    # two grids offset by half a band, so listings either side of a band edge
+    # still share a block in one of them
+    pairs = []
+    for offset in (0.0, 0.5):
+        block_key = pd.DataFrame(
+            {
+                "city": listings["city"].fillna(""),
+                "surface": band_index(listings["surface"], offset),
+                "price": band_index(listings["price"], offset),
+            }
+        )
+        blocks = block_key.groupby(list(block_key.columns), sort=False).ngroup()
+        blocks = np.where(has_words, blocks.to_numpy(), -1 - np.arange(len(listings)))
+        pairs.append(candidate_pairs(signatures, blocks, bands))
+    pairs = np.unique(np.concatenate(pairs), axis=0)
+
+    similarity = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1)
+    pairs = pairs[similarity >= threshold]
+    graph = coo_matrix(
+        (np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+        shape=(len(listings), len(listings)),
+    )
+    _, labels = connected_components(graph, directed=False)
+    ids = listings["id"]
+    return pd.DataFrame({"id": ids, "cluster_id": ids.groupby(labels).transform("min")})
+
+
+def page_listings(file_path: pathlib.Path) -> pd.DataFrame:
+    """The listings of a saved page, with their descriptions."""
+    with open(file_path) as f:
+        try:
+            results = json.load(f).get("results") or []
+        except json.decoder.JSONDecodeError:
+            return pd.DataFrame()
+    listings = data_processor.parse_results(results)
+    listings["description"] = [
+        ((result.get("realEstate") or {}).get("properties") or [{}])[0].get(
+            "description"
+        )
+        for result in results
+    ]
+    return listings
+
+
+def snapshot_clusters(
+    root: pathlib.Path = LISTINGS_ROOT,
+    date: str = None,
+    contract: str = "sale",
+    threshold: float = THRESHOLD,
+) -> pd.DataFrame:
+    """
+    Cluster the listings of a snapshot, one city at a time.
+
+    Args:
+        root (pathlib.Path): Directory holding the daily snapshots.
+        date (str): Snapshot to cluster (yymmdd), today when not given.
+        contract (str): Contract partition (sale, rent, auction).
+        threshold (float): See find_clusters.
+
+    Returns:
+        pd.DataFrame: id and cluster_id of every listing, also saved as
+            out/<contract>/duplicate_clusters.csv.
+    """
+    json_path = data_processor.partition(root, date, "json", contract)
+    save_path = data_processor.partition(root, date, "out", contract)
+    save_path.mkdir(parents=True, exist_ok=True)
+    # the files are named <region>_<province>_<city>_..., as in compile_city_tables
+    city_files = {}
+    for path in json_path.glob("*.json"):
+        city_files.setdefault(path.stem.split("_")[2], []).append(path)
+
+    clusters = []
+    for files in tqdm.tqdm(city_files.values(), desc="Finding duplicates"):
+        pages = [page_listings(path) for path in files]
+        pages = [page for page in pages if not page.empty]
+        if pages:
+            clusters.append(find_clusters(pd.concat(pages), threshold))
+    clusters = (
+        pd.concat(clusters, ignore_index=True)
+        if clusters
+        else pd.DataFrame(columns=["id", "cluster_id"])
+    )
+    clusters.to_csv(save_path / CLUSTERS_FILE, index=False)
+
+    duplicates = (clusters["id"] != clusters["cluster_id"]).sum()
+    logging.info(
+        f"{duplicates} of {len(clusters)} {contract} listings are near-duplicates"
+    )
+    return clusters
+
+
+def deduplicate(listings: pd.DataFrame, clusters: pd.DataFrame) -> pd.DataFrame:
+    """Keep the first listing of each cluster; ids without a cluster are kept."""
+    cluster_ids = listings["id"].map(clusters.set_index("id")["cluster_id"])
+    return listings[~cluster_ids.fillna(listings["id"]).duplicated()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find near-duplicate listings")
+    parser.add_argument("--root", type=pathlib.Path, default=LISTINGS_ROOT)
+    parser.add_argument("--date", default=None, help="yymmdd (default: today)")
+    parser.add_argument("--contract", default="sale")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    snapshot_clusters(args.root, args.date, args.contract, args.threshold)
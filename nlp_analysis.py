@@ -1,75 +1,109 @@
 import numpy as np
-import spacy
 import pandas as pd
 from tqdm import tqdm
-from spacy import displacy
-import plotly.express as px
 
+SPACY_MODEL = 'it_core_news_lg'
+_nlp = None
+
+
+# spaCy and its model take seconds to load, so they are only loaded on first use
+def get_nlp():
+    global _nlp
+    if _nlp is None:
+        import spacy
+        _nlp = spacy.load(SPACY_MODEL)
+    return _nlp
+
+
+# characters stripped from both ends of a description
+STRIP_CHARS = '!@#$%^&*()_+-=[]{};\':"|./<>?'
+# clean_data used to pass these to str.replace without regex=..., and since
+# pandas 2.0 that means a literal match: punctuation inside a description is
+# kept and runs of spaces are not collapsed. They stay literal so that cleaned
+# descriptions, and the token store digests, do not change.
+LITERAL_REPLACEMENTS = [('[^\\w\\s]', ' '), (' +', ' ')]
+
+
+def _normalize(value):
+    value = value.lower().replace('\n', ' ').replace('\t', ' ').strip(STRIP_CHARS)
+    for pattern, replacement in LITERAL_REPLACEMENTS:
+        if pattern in value:
+            value = value.replace(pattern, replacement)
+    return value
+
+
+# All the cleaning of a description in one pass. Same output as the chain of
+# pandas .str calls it replaces: lowercase (Python's str.lower, which pyarrow's
+# utf8_lower does not match on final sigmas and dotted capitals), newlines and
+# tabs to spaces, STRIP_CHARS trimmed, and NaN for anything that is not a string.
+def normalize_descriptions(descriptions):
+    values = descriptions.to_numpy(dtype=object)
+    normalized = [_normalize(value) if isinstance(value, str) else np.nan for value in values]
+    return pd.Series(normalized, index=descriptions.index, name=descriptions.name, dtype=object)
 
-nlp = spacy.load('it_core_news_lg')
 
 # Initial data cleanup and filtering
 # TODO: fix hardcoded column names
 
+CLEAN_COLUMNS = ['id', 'contract', 'macrozone', 'neighbourhood', 'price.value', 'description']
+
+
 def clean_data(path):
-    input = pd.read_csv(path)
-    data = input[['id', 'contract', 'macrozone', 'neighbourhood', 'price.value', 'description']]
+    # the tables from data_converter have over a hundred columns, parsing only
+    # these is most of the time saved
+    input = pd.read_csv(path, usecols=CLEAN_COLUMNS)
+    data = input[CLEAN_COLUMNS]
     # remove auction listings from the dataset
-    data = data.loc[data['contract'] == 'sale']
-    # make all descriptions lowercase
-    data.loc[:, 'description'] = data.loc[:, 'description'].str.lower()
-    # remove all numbers, newline, and \tab characters from description column in df
-    data.loc[:, 'description'] = data.loc[:, 'description'].str.replace('\n', ' ')
-    data.loc[:, 'description'] = data.loc[:, 'description'].str.replace('\t', ' ')
-    # strip punctuation from description column in df
-    data.loc[:, 'description'] = data.loc[:, 'description'].str.strip('!@#$%^&*()_+-=[]{};\':"|./<>?')
-    data.loc[:, 'description'] = data.loc[:, 'description'].str.replace('[^\w\s]', ' ')
-    # remove all duplicate spaces in description column in df
-    data.loc[:, 'description'] = data.loc[:, 'description'].str.replace(' +', ' ')
+    data = data.loc[data['contract'] == 'sale'].copy()
+    # lowercase, no newlines or tabs, punctuation stripped from both ends
+    data['description'] = normalize_descriptions(data['description'])
     # remove rows with missing values
     data = data.dropna()
     return data
 
 
+# token attributes kept for every word of a description
+TOKEN_COLUMNS = ['text', 'ent_type', 'lemma', 'pos', 'tag', 'dep', 'shape', 'is_alpha', 'is_stop']
+
+
+def token_records(doc):
+    return [{'text': token.text,
+             'ent_type': token.ent_type_,
+             'lemma': token.lemma_,
+             'pos': token.pos_,
+             'tag': token.tag_,
+             'dep': token.dep_,
+             'shape': token.shape_,
+             'is_alpha': token.is_alpha,
+             'is_stop': token.is_stop} for token in doc]
+
+
 # Create new dataset with text tokens from description column
+# (token_store.TokenStore only tags the listings that changed since the last run)
 def tag_data(df):
+    nlp = get_nlp()
     rows = []
     print('Processing tokens...')
     for i, item in tqdm(df.iterrows(), total=df.shape[0]):
         doc = nlp(item['description'])
-        for token in doc:
+        for record in token_records(doc):
             rows.append({'id': item['id'],
                          'macrozone': item['macrozone'],
                          'neighbourhood': item['neighbourhood'],
                          'price': item['price.value'],
-                         'text': token.text,
-                         'ent_type': token.ent_type_,
-                         'lemma': token.lemma_,
-                         'pos': token.pos_,
-                         'tag': token.tag_,
-                         'dep': token.dep_,
-                         'shape': token.shape_,
-                         'is_alpha': token.is_alpha,
-                         'is_stop': token.is_stop})
+                         **record})
     return pd.DataFrame(rows)
 
 
-# tag_data(clean_data('data_sales.csv')).to_csv('data_tagged.csv', index=False, encoding='utf-8')
-data = pd.read_csv('data_tagged.csv')
-print('Data loaded.')
-
-
-# optimise the following code
+# one column per neighbourhood, lemmas from the most to the least used
+# (filling an empty DataFrame column by column left it empty)
 def most_used_words_by_neighbourhood(data):
-    neighbourhoods = data['neighbourhood'].unique()
-    words_df = pd.DataFrame(columns=list(neighbourhoods))
-    for neighbourhood in neighbourhoods:
-        n_data = data.loc[data['neighbourhood'] == neighbourhood]
-        words = n_data.loc[(data['is_stop'] == False) & (data['is_alpha'] == True)].groupby(
-            ['lemma']).size().reset_index(
-            name='count').sort_values(by='count', ascending=False).dropna().reset_index(drop=True)
-        words_df.loc[:, neighbourhood] = words['lemma']
-    return words_df
+    words = data.loc[(data['is_stop'] == False) & (data['is_alpha'] == True)]
+    columns = {}
+    for neighbourhood in data['neighbourhood'].unique():
+        counts = words.loc[words['neighbourhood'] == neighbourhood].groupby('lemma').size()
+        columns[neighbourhood] = pd.Series(counts.sort_values(ascending=False).index)
+    return pd.DataFrame(columns)
 
 
 def most_used_words_by_price(data):
@@ -96,6 +130,7 @@ def most_used_words_by_price(data):
 
 
 def plot_words_by_price(path):
+    import plotly.express as px
     df = pd.read_csv(path)
     df['frequency_above_mean'] = df['frequency_above_mean'].apply(lambda x: np.log10(x))
     df['frequency_below_mean'] = df['frequency_below_mean'].apply(lambda x: np.log10(x))
@@ -122,8 +157,13 @@ def extract_word_col(path, keyword):
     #df.to_csv('{keyword}_frequency_by_neighbourhood.csv', index=False, encoding='utf-8')
     return df
 
-#x = keyword_percentage_by_neighbourhood(data)
-#x.to_csv('word_percentage_by_neighbourhood.csv', index=True, encoding='utf-8')
-#y = extract_word_col('word_percentage_by_neighbourhood.csv', 'verde')
-x = plot_words_by_price('words_df.csv')
-print(x)
+
+if __name__ == '__main__':
+    # tag_data(clean_data('data_sales.csv')).to_csv('data_tagged.csv', index=False, encoding='utf-8')
+    data = pd.read_csv('data_tagged.csv')
+    print('Data loaded.')
+    #x = keyword_percentage_by_neighbourhood(data)
+    #x.to_csv('word_percentage_by_neighbourhood.csv', index=True, encoding='utf-8')
+    #y = extract_word_col('word_percentage_by_neighbourhood.csv', 'verde')
+    x = plot_words_by_price('words_df.csv')
+    print(x)
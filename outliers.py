@@ -0,0 +1,222 @@
+# Shared outlier filtering. Cutoffs are computed per group (city, macrozone,
+# typology, ...) in a single vectorized pass with groupby.transform, and can be
+# precomputed once and then applied batch by batch to streamed data.
+#
+# Methods:
+#   quantile  keep lower-quantile <= x < upper-quantile (the summary tables'
+#             historical "drop above the 99th percentile" rule)
+#   mad       keep |x - median| <= threshold * 1.4826 * MAD
+#   iqr       keep q1 - threshold * IQR <= x <= q3 + threshold * IQR
+#   zscore    keep |x - mean| < threshold * std (population std, like
+#             scipy.stats.zscore)
+#
+# Missing values are never treated as outliers.
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+MAD_SCALE = 1.4826  # makes the MAD a consistent estimator of the std
+DEFAULT_THRESHOLDS = {"mad": 3.5, "iqr": 1.5, "zscore": 3.0}
+
+
+def _as_list(value) -> list:
+    if value is None:
+        return []
+    return [value] if isinstance(value, str) else list(value)
+
+
+def _group_keys(df: pd.DataFrame, by: list):
+    # a constant key lets the whole frame be treated as one group
+    return [df[column] for column in by] if by else np.zeros(len(df), dtype=np.int8)
+
+
+def group_bounds(
+    df: pd.DataFrame,
+    columns,
+    by=None,
+    method: str = "mad",
+    threshold: float = None,
+    lower: float = None,
+    upper: float = 0.99,
+) -> pd.DataFrame:
+    """
+    Compute per-row lower/upper bounds from statistics of each row's group.
+
+    Args:
+        df (pd.DataFrame): The data.
+        columns (str | list): Columns to compute bounds for.
+        by (str | list): Grouping columns, None for the whole frame.
+        method (str): One of "quantile", "mad", "iqr" or "zscore".
+        threshold (float): Width of the accepted band for mad/iqr/zscore.
+        lower (float): Lower quantile for the quantile method, None for no bound.
+        upper (float): Upper quantile for the quantile method, None for no bound.
+
+    Returns:
+        pd.DataFrame: "<column>_low" and "<column>_high" aligned with df.
+    """
+    columns, by = _as_list(columns), _as_list(by)
+    threshold = DEFAULT_THRESHOLDS.get(method) if threshold is None else threshold
+    values = df[columns].astype("float64")
+    grouped = values.groupby(_group_keys(df, by), dropna=False)
+    infinite = pd.DataFrame(np.inf, index=df.index, columns=columns)
+
+    if method == "quantile":
+        low = grouped.transform("quantile", lower) if lower is not None else -infinite
+        high = grouped.transform("quantile", upper) if upper is not None else infinite
+    elif method == "mad":
+        median = grouped.transform("median")
+        mad = (
+            (values - median)
+            .abs()
+            .groupby(_group_keys(df, by), dropna=False)
+            .transform("median")
+        )
+        low = median - threshold * MAD_SCALE * mad
+        high = median + threshold * MAD_SCALE * mad
+    elif method == "iqr":
+        q1 = grouped.transform("quantile", 0.25)
+        q3 = grouped.transform("quantile", 0.75)
+        low = q1 - threshold * (q3 - q1)
+        high = q3 + threshold * (q3 - q1)
+    elif method == "zscore":
+        mean = grouped.transform("mean")
+        std = grouped.transform("std", ddof=0)
+        low = mean - threshold * std
+        high = mean + threshold * std
+    else:
+        raise ValueError(f"Unknown outlier method: {method}")
+
+    return pd.concat([low.add_suffix("_low"), high.add_suffix("_high")], axis=1)
+
+
+def keep_mask(
+    df: pd.DataFrame, bounds: pd.DataFrame, columns, method: str
+) -> pd.Series:
+    """Rows whose values all fall inside their bounds (NaN always passes)."""
+    keep = pd.Series(True, index=df.index)
+    for column in _as_list(columns):
+        values = df[column].astype("float64")
+        low, high = bounds[f"{column}_low"], bounds[f"{column}_high"]
+        if method == "quantile":
+            inside = (values >= low) & (values < high)
+        elif method == "zscore":
+            inside = (values > low) & (values < high)
+        else:
+            inside = (values >= low) & (values <= high)
+        # groups without cutoffs (unseen in a streamed batch) are kept
+        inside |= values.isna() | (low.isna() & high.isna())
+        keep &= inside
+    return keep
+
+
+def removal_counts(df: pd.DataFrame, keep: pd.Series, by=None) -> pd.DataFrame:
+    """Count the rows and removed rows of each group."""
+    by = _as_list(by)
+    counts = (
+        pd.DataFrame({"rows": 1, "removed": ~keep}, index=df.index)
+        .groupby(_group_keys(df, by), dropna=False)
+        .sum()
+        .astype(int)
+    )
+    if by:
+        counts = counts.rename_axis(by).reset_index()
+    else:
+        counts = counts.reset_index(drop=True)
+    return counts
+
+
+def filter_outliers(
+    df: pd.DataFrame,
+    columns,
+    by=None,
+    method: str = "mad",
+    threshold: float = None,
+    lower: float = None,
+    upper: float = 0.99,
+) -> tuple:
+    """
+    Drop outliers using robust statistics computed per group.
+
+    See group_bounds for the arguments.
+
+    Returns:
+        tuple: (the filtered DataFrame, removal counts per group).
+    """
+    bounds = group_bounds(df, columns, by, method, threshold, lower, upper)
+    keep = keep_mask(df, bounds, columns, method)
+    counts = removal_counts(df, keep, by)
+    logging.info(
+        f"Removed {int(counts['removed'].sum())}/{len(df)} outliers "
+        f"({method} on {', '.join(_as_list(columns))})"
+    )
+    return df[keep], counts
+
+
+def compute_cutoffs(
+    df: pd.DataFrame,
+    columns,
+    by=None,
+    method: str = "mad",
+    threshold: float = None,
+    lower: float = None,
+    upper: float = 0.99,
+) -> pd.DataFrame:
+    """
+    Precompute one row of bounds per group, to be reused on later batches.
+
+    Returns:
+        pd.DataFrame: The grouping columns plus "<column>_low"/"<column>_high".
+    """
+    by = _as_list(by)
+    bounds = group_bounds(df, columns, by, method, threshold, lower, upper)
+    if by:
+        cutoffs = pd.concat([df[by], bounds], axis=1).drop_duplicates(by)
+    else:
+        cutoffs = bounds.iloc[[0]]
+    cutoffs = cutoffs.reset_index(drop=True)
+    cutoffs.attrs["method"] = method
+    return cutoffs
+
+
+class StreamingFilter:
+    """
+    Apply precomputed cutoffs to batches and keep running removal counts.
+
+    Rows of groups that have no cutoffs are kept.
+    """
+
+    def __init__(self, cutoffs: pd.DataFrame, columns, by=None, method: str = None):
+        self.cutoffs = cutoffs
+        self.columns = _as_list(columns)
+        self.by = _as_list(by)
+        self.method = method or cutoffs.attrs.get("method", "mad")
+        self.counts = []
+
+    def filter(self, batch: pd.DataFrame) -> pd.DataFrame:
+        if self.by:
+            bounds = batch[self.by].merge(self.cutoffs, on=self.by, how="left")
+            bounds.index = batch.index
+        else:
+            bounds = pd.DataFrame(
+                np.repeat(self.cutoffs.to_numpy(), len(batch), axis=0),
+                index=batch.index,
+                columns=self.cutoffs.columns,
+            )
+        keep = keep_mask(batch, bounds, self.columns, self.method)
+        self.counts.append(removal_counts(batch, keep, self.by))
+        return batch[keep]
+
+    def filter_batches(self, batches):
+        for batch in batches:
+            yield self.filter(batch)
+
+    def report(self) -> pd.DataFrame:
+        """Removal counts per group over every batch seen so far."""
+        if not self.counts:
+            return pd.DataFrame(columns=self.by + ["rows", "removed"])
+        counts = pd.concat(self.counts)
+        if self.by:
+            return counts.groupby(self.by, dropna=False).sum().reset_index()
+        return counts.sum().to_frame().T
@@ -0,0 +1,522 @@
+# Change-rate driven refresh scheduling. Every crawl leaves a fingerprint of
+# each (contract, category, macrozone, neighbourhood, page) it fetched; from
+# successive fingerprints the scheduler estimates how often each page changes
+# (a Poisson rate) and, given a fixed request budget, refetches the pages most
+# likely to have changed since they were last seen. Pages that are not
+# refetched are carried forward from the previous snapshot, so every snapshot
+# stays complete.
+#
+#   python page_scheduler.py observe            # backfill from ./listings/
+#   python page_scheduler.py plan --budget 500  # expected freshness per request
+#   python page_scheduler.py simulate           # scheduler vs oldest-first
+
+import argparse
+import hashlib
+import json
+import logging
+import pathlib
+import shutil
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+LISTINGS_ROOT = pathlib.Path("./listings/")
+STATS_PATH = LISTINGS_ROOT / "page_stats.sqlite"
+
+CONTRACT_IDS = {"sale": 1, "rent": 2, "auction": 14}
+
+PAGE_KEY = [
+    "contract",
+    "category_id",
+    "city_id",
+    "macrozone_id",
+    "neighbourhood_id",
+    "page_num",
+]
+STATS_COLUMNS = PAGE_KEY + [
+    "region_id",
+    "province_id",
+    "last_checked",
+    "last_hash",
+    "last_path",
+    "checks",
+    "changes",
+    "observed_seconds",
+]
+
+PRIOR_WEIGHT = 2.0  # pseudo-checks borrowed from pages with the same page number
+PAGE_GROUPS = 10  # pages past the 10th share their statistics
+DEFAULT_CHANGE_FRACTION = 0.5
+DEFAULT_INTERVAL_S = 86_400.0
+EXPLORATION = 0.05  # share of the budget spent on pages outside the top ranks
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    contract TEXT NOT NULL,
+    category_id INTEGER NOT NULL,
+    city_id INTEGER NOT NULL,
+    macrozone_id INTEGER NOT NULL,
+    neighbourhood_id INTEGER NOT NULL,
+    page_num INTEGER NOT NULL,
+    region_id TEXT,
+    province_id TEXT,
+    last_checked REAL,
+    last_hash TEXT,
+    last_path TEXT,
+    checks INTEGER NOT NULL DEFAULT 0,
+    changes INTEGER NOT NULL DEFAULT 0,
+    observed_seconds REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (contract, category_id, city_id, macrozone_id, neighbourhood_id, page_num)
+) WITHOUT ROWID;
+"""
+
+
+def connect(db_path: pathlib.Path = STATS_PATH) -> sqlite3.Connection:
+    """Open the page statistics database, creating it if needed."""
+    db_path = pathlib.Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def load_stats(conn: sqlite3.Connection) -> pd.DataFrame:
+    return pd.read_sql_query(f"SELECT {', '.join(STATS_COLUMNS)} FROM pages", conn)
+
+
+def save_stats(conn: sqlite3.Connection, stats: pd.DataFrame) -> None:
+    values = stats[STATS_COLUMNS].astype(object).where(stats[STATS_COLUMNS].notna())
+    with conn:
+        conn.executemany(
+            f"INSERT OR REPLACE INTO pages ({', '.join(STATS_COLUMNS)}) "
+            f"VALUES ({', '.join('?' for _ in STATS_COLUMNS)})",
+            values.itertuples(index=False, name=None),
+        )
+
+
+def page_fingerprint(data: dict) -> str:
+    """
+    Hash of the listings a page shows, in order, with their prices.
+
+    Only what the compiled tables depend on is hashed, so changes to ad slots
+    or page metadata do not count as changes.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for result in data.get("results") or []:
+        real_estate = result.get("realEstate") or {}
+        price = (real_estate.get("price") or {}).get("value")
+        digest.update(f"{real_estate.get('id')}:{price};".encode())
+    return digest.hexdigest()
+
+
+def parse_page_name(path: pathlib.Path) -> dict:
+    """
+    Recover the page key from a saved page.
+
+    Pages live under json/<contract>/ and are named
+    <region>_<province>_<city>_<macrozone>_<neighbourhood>_<category>_<page>.json;
+    pages saved before contracts and categories were recorded sit directly
+    under json/ and lack the category.
+    """
+    path = pathlib.Path(path)
+    fields = path.stem.split("_")
+    if len(fields) == 6:
+        fields.insert(5, "1")
+    region_id, province_id, city_id, macrozone_id, neighbourhood_id = fields[:5]
+    return {
+        "contract": "sale" if path.parent.name == "json" else path.parent.name,
+        "category_id": int(fields[5]),
+        "city_id": int(city_id),
+        "macrozone_id": int(macrozone_id),
+        "neighbourhood_id": int(neighbourhood_id),
+        "page_num": int(fields[6]),
+        "region_id": region_id,
+        "province_id": province_id,
+    }
+
+
+def update_stats(stats: pd.DataFrame, observations: pd.DataFrame) -> pd.DataFrame:
+    """
+    Fold a batch of fetches into the page statistics.
+
+    Args:
+        stats (pd.DataFrame): Current statistics, STATS_COLUMNS.
+        observations (pd.DataFrame): PAGE_KEY, region_id, province_id,
+            checked_at (epoch seconds), hash and path of each fetch.
+
+    Returns:
+        pd.DataFrame: The updated statistics. Fetches older than the last
+            check of their page are ignored.
+    """
+    observations = observations.sort_values("checked_at").drop_duplicates(
+        PAGE_KEY, keep="last"
+    )
+    stats = stats.set_index(PAGE_KEY)
+    observations = observations.set_index(PAGE_KEY)
+    new_pages = observations.index.difference(stats.index)
+    if len(new_pages):
+        added = pd.DataFrame(index=new_pages, columns=stats.columns)
+        added[["checks", "changes", "observed_seconds"]] = 0
+        stats = pd.concat([stats, added]) if len(stats) else added
+    stats = stats.astype(
+        {"checks": "int64", "changes": "int64", "observed_seconds": "float64"}
+    )
+    stats["last_checked"] = stats["last_checked"].astype("float64")
+
+    previous = stats.loc[observations.index]
+    seen_before = previous["last_checked"].notna()
+    fresh = ~seen_before | (observations["checked_at"] > previous["last_checked"])
+    interval = seen_before & fresh
+    changed = interval & (observations["hash"] != previous["last_hash"])
+
+    rows = observations.index[fresh]
+    stats.loc[rows, "checks"] += interval[fresh].astype("int64")
+    stats.loc[rows, "changes"] += changed[fresh].astype("int64")
+    stats.loc[rows, "observed_seconds"] += (
+        observations["checked_at"] - previous["last_checked"]
+    )[fresh].fillna(0.0)
+    stats.loc[rows, "last_checked"] = observations.loc[rows, "checked_at"]
+    stats.loc[rows, "last_hash"] = observations.loc[rows, "hash"]
+    stats.loc[rows, "last_path"] = observations.loc[rows, "path"]
+    stats.loc[rows, "region_id"] = observations.loc[rows, "region_id"]
+    stats.loc[rows, "province_id"] = observations.loc[rows, "province_id"]
+    return stats.reset_index()[STATS_COLUMNS]
+
+
+def observe_snapshot(conn: sqlite3.Connection, snapshot_dir: pathlib.Path) -> int:
+    """
+    Record the pages of a snapshot, using each file's mtime as its fetch time.
+
+    Pages carried forward from an earlier snapshot keep their original mtime
+    and are not counted again.
+
+    Returns:
+        int: The number of pages read.
+    """
+    rows = []
+    json_path = pathlib.Path(snapshot_dir) / "json"
+    for path in sorted(json_path.glob("*.json")) + sorted(json_path.glob("*/*.json")):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except json.decoder.JSONDecodeError:
+            logging.info(f"Could not parse {path}")
+            continue
+        row = parse_page_name(path)
+        row.update(
+            checked_at=path.stat().st_mtime,
+            hash=page_fingerprint(data),
+            path=str(path),
+        )
+        rows.append(row)
+    if rows:
+        save_stats(conn, update_stats(load_stats(conn), pd.DataFrame(rows)))
+    return len(rows)
+
+
+def register_pages(conn: sqlite3.Connection, indexes: list) -> None:
+    """Add probed pages that were never fetched, so they are scheduled first."""
+    names = {contract_id: name for name, contract_id in CONTRACT_IDS.items()}
+    with conn:
+        conn.executemany(
+            f"INSERT OR IGNORE INTO pages ({', '.join(PAGE_KEY)}, region_id, province_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    names.get(
+                        int(index.get("contract_id", 1)), str(index.get("contract_id"))
+                    ),
+                    int(index.get("category_id", 1)),
+                    int(index["city_id"]),
+                    int(index["macrozone_id"]),
+                    int(index["neighbourhood_id"]),
+                    int(index["page_num"]),
+                    index["region_id"],
+                    index["province_id"],
+                )
+                for index in indexes
+            ),
+        )
+
+
+def change_rates(stats: pd.DataFrame) -> np.ndarray:
+    """
+    Estimate each page's Poisson change rate, in changes per second.
+
+    A page seen to change X times over n checks spanning T seconds gets the
+    estimator of Cho & Garcia-Molina for checks that only tell whether the
+    page changed:
+
+        rate = -ln((n - X + 0.5) / (n + 0.5)) / (T / n)
+
+    The counts are first shrunk towards those of the pages of the same
+    contract and page number (PRIOR_WEIGHT pseudo-checks), so new and rarely
+    checked pages borrow the behaviour of similar ones.
+    """
+    counts = stats[["checks", "changes", "observed_seconds"]].astype("float64")
+    groups = [stats["contract"], stats["page_num"].astype(int).clip(upper=PAGE_GROUPS)]
+    pooled = counts.groupby(groups).transform("sum")
+    total = counts.sum()
+
+    # smoothed, so a group that has not changed yet keeps a small rate
+    fraction = (pooled["changes"] + DEFAULT_CHANGE_FRACTION) / (pooled["checks"] + 1)
+    interval = (pooled["observed_seconds"] / pooled["checks"]).fillna(
+        total["observed_seconds"] / total["checks"] if total["checks"] else np.nan
+    )
+    interval = interval.fillna(DEFAULT_INTERVAL_S)
+
+    n = counts["checks"] + PRIOR_WEIGHT
+    x = counts["changes"] + PRIOR_WEIGHT * fraction
+    t = counts["observed_seconds"] + PRIOR_WEIGHT * interval
+    return (-np.log((n - x + 0.5) / (n + 0.5)) / (t / n)).to_numpy()
+
+
+def change_probabilities(stats: pd.DataFrame, now: float = None) -> np.ndarray:
+    """Probability that each page changed since it was last fetched."""
+    now = time.time() if now is None else now
+    age = now - stats["last_checked"].astype("float64").to_numpy()
+    probability = 1 - np.exp(-change_rates(stats) * np.maximum(age, 0))
+    # pages never fetched are certain to be new
+    return np.where(np.isnan(age), 1.0, probability)
+
+
+def plan(
+    stats: pd.DataFrame,
+    budget: int,
+    now: float = None,
+    exploration: float = EXPLORATION,
+    seed: int = None,
+) -> pd.DataFrame:
+    """
+    Choose the pages to refetch within a request budget.
+
+    Pages are ranked by the probability that they changed since their last
+    fetch, which maximises the expected number of changes caught per request.
+    A small share of the budget samples the remaining pages, oldest first in
+    expectation, so slow pages keep getting checked and their rates stay
+    current.
+
+    Args:
+        stats (pd.DataFrame): Page statistics.
+        budget (int): Requests available.
+        now (float): Epoch seconds, the current time when not given.
+        exploration (float): Share of the budget sampled outside the ranking.
+        seed (int): Seed of the exploration sample.
+
+    Returns:
+        pd.DataFrame: The chosen pages with their change probability, most
+            likely changed first.
+    """
+    now = time.time() if now is None else now
+    probability = change_probabilities(stats, now)
+    order = np.argsort(-probability, kind="stable")
+    explore = int(budget * exploration) if len(stats) > budget else 0
+    chosen = order[: budget - explore]
+    rest = order[budget - explore :]
+    if explore:
+        age = now - stats["last_checked"].astype("float64").to_numpy()[rest]
+        weights = np.nan_to_num(np.maximum(age, 0), nan=1.0) + 1.0
+        sample = np.random.default_rng(seed).choice(
+            rest, size=explore, replace=False, p=weights / weights.sum()
+        )
+        chosen = np.concatenate([chosen, sample])
+    return stats.iloc[chosen].assign(change_probability=probability[chosen])
+
+
+def freshness_report(stats: pd.DataFrame, budget: int, now: float = None) -> dict:
+    """Expected changes caught per request by plan() and by oldest-first."""
+    now = time.time() if now is None else now
+    probability = change_probabilities(stats, now)
+    planned = plan(stats, budget, now, exploration=0)
+    oldest = np.argsort(stats["last_checked"].astype("float64").fillna(-np.inf))
+    return {
+        "pages": len(stats),
+        "budget": min(budget, len(stats)),
+        "expected_changes": round(float(planned["change_probability"].sum()), 2),
+        "changes_per_request": round(float(planned["change_probability"].mean()), 4),
+        "oldest_first_changes_per_request": round(
+            float(probability[oldest[:budget]].mean()), 4
+        ),
+    }
+
+
+def carry_forward(unchanged: pd.DataFrame, save_path: pathlib.Path) -> int:
+    """
+    Copy the last fetched copy of the pages that were not refetched into
+    today's snapshot, keeping their original mtime (the fetch time). Pages
+    are copied, not linked, so rewriting today's page cannot change an
+    earlier snapshot.
+    """
+    import data_downloader
+
+    carried = 0
+    for page in unchanged.dropna(subset=["last_path"]).itertuples(index=False):
+        source = pathlib.Path(page.last_path)
+        target = data_downloader.page_path(page_index(page._asdict()), save_path)
+        if target.exists() or not source.exists():
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(source, target)
+        carried += 1
+    return carried
+
+
+def page_index(page: dict) -> dict:
+    """Turn a statistics row into a data_downloader page index."""
+    return {
+        "region_id": page["region_id"],
+        "province_id": page["province_id"],
+        "city_id": int(page["city_id"]),
+        "macrozone_id": int(page["macrozone_id"]),
+        "neighbourhood_id": int(page["neighbourhood_id"]),
+        "contract_id": CONTRACT_IDS.get(page["contract"], page["contract"]),
+        "category_id": int(page["category_id"]),
+        "page_num": int(page["page_num"]),
+    }
+
+
+def refresh(
+    conn: sqlite3.Connection,
+    budget: int,
+    workers: int = 10,
+    root: pathlib.Path = LISTINGS_ROOT,
+    rate: float = None,
+    exploration: float = EXPLORATION,
+    date: str = None,
+) -> pd.DataFrame:
+    """
+    Refetch the pages most likely to have changed and complete a snapshot
+    with the last copy of the others.
+
+    Args:
+        conn (sqlite3.Connection): Page statistics database.
+        budget (int): Requests available.
+        workers (int): Download threads.
+        root (pathlib.Path): Directory holding the daily snapshots.
+        rate (float): Maximum requests per second, None for no limit.
+        exploration (float): Share of the budget sampled outside the ranking.
+        date (str): Snapshot to complete, yymmdd, today if None.
+
+    Returns:
+        pd.DataFrame: The pages refetched.
+    """
+    import data_downloader
+
+    stats = load_stats(conn)
+    chosen = plan(stats, budget, exploration=exploration)
+    logging.info(
+        f"Refreshing {len(chosen)}/{len(stats)} pages, "
+        f"{chosen['change_probability'].sum():.1f} changes expected"
+    )
+    indexes = [page_index(page) for page in chosen.to_dict("records")]
+    date = date or time.strftime("%y%m%d")
+    data_downloader.download_listings(indexes, workers, root, rate, date)
+
+    snapshot = pathlib.Path(root) / date
+    carried = carry_forward(stats.drop(chosen.index), snapshot / "json")
+    logging.info(f"Carried {carried} unchanged pages forward")
+    observe_snapshot(conn, snapshot)
+    return chosen
+
+
+def simulate(
+    rates: np.ndarray,
+    budget: int,
+    rounds: int = 30,
+    interval_s: float = 3600.0,
+    seed: int = 0,
+) -> dict:
+    """
+    Replay refreshes of pages with known change rates.
+
+    Each round every page changes a Poisson number of times and budget pages
+    are refetched, either by plan() or oldest-first. Reports the share of
+    fetches that found a change and the mean share of pages whose copy is
+    current at the end of a round.
+
+    Args:
+        rates (np.ndarray): True change rate of each page, per second.
+        budget (int): Requests per round.
+        rounds (int): Refresh rounds.
+        interval_s (float): Seconds between rounds.
+        seed (int): Random seed.
+
+    Returns:
+        dict: Changes found per request and mean freshness for both policies.
+    """
+    report = {}
+    for policy in ("scheduler", "oldest_first"):
+        rng = np.random.default_rng(seed)
+        n = len(rates)
+        versions = np.zeros(n, dtype=np.int64)
+        seen = np.zeros(n, dtype=np.int64)
+        stats = pd.DataFrame(
+            {
+                "contract": "sale",
+                "category_id": 1,
+                "city_id": 0,
+                "macrozone_id": np.arange(n) // 100,
+                "neighbourhood_id": np.arange(n),
+                "page_num": 1,
+                "region_id": "",
+                "province_id": "",
+                "last_checked": 0.0,
+                "last_hash": "0",
+                "last_path": None,
+                "checks": 0,
+                "changes": 0,
+                "observed_seconds": 0.0,
+            }
+        )
+        found, fetched, freshness = 0, 0, []
+        for round_ in range(1, rounds + 1):
+            now = round_ * interval_s
+            versions += rng.poisson(rates * interval_s)
+            if policy == "scheduler":
+                chosen = plan(stats, budget, now, seed=round_).index.to_numpy()
+            else:
+                chosen = np.argsort(stats["last_checked"].to_numpy(), kind="stable")[
+                    :budget
+                ]
+            found += int((versions[chosen] != seen[chosen]).sum())
+            fetched += len(chosen)
+            seen[chosen] = versions[chosen]
+            observations = stats.iloc[chosen][PAGE_KEY + ["region_id", "province_id"]]
+            observations = observations.assign(
+                checked_at=now, hash=versions[chosen].astype(str), path=None
+            )
+            stats = update_stats(stats, observations)
+            freshness.append(float((versions == seen).mean()))
+        report[policy] = {
+            "changes_per_request": round(found / fetched, 4),
+            "mean_freshness": round(float(np.mean(freshness)), 4),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Change-rate driven page scheduling")
+    parser.add_argument("command", choices=["observe", "plan", "simulate"])
+    parser.add_argument("--root", type=pathlib.Path, default=LISTINGS_ROOT)
+    parser.add_argument("--stats", type=pathlib.Path, default=STATS_PATH)
+    parser.add_argument("--budget", type=int, default=500)
+    args = parser.parse_args()
+
+    if args.command == "simulate":
+        # a few busy pages among many quiet ones, like page 1 of central zones
+        rng = np.random.default_rng(0)
+        rates = np.where(rng.random(5000) < 0.1, 1 / 3600, 1 / (7 * 86_400))
+        print(simulate(rates * rng.lognormal(0, 0.5, len(rates)), args.budget))
+    else:
+        import warehouse
+
+        conn = connect(args.stats)
+        if args.command == "observe":
+            for snapshot in warehouse.list_snapshots(args.root):
+                logging.info(f"{snapshot}: {observe_snapshot(conn, snapshot)} pages")
+        print(freshness_report(load_stats(conn), args.budget))
+        conn.close()
@@ -0,0 +1,513 @@
+# Read-only HTTP/JSON service over the latest snapshot, so consumers look up
+# a macrozone or page through a neighbourhood's listings without loading whole
+# CSV files. The city tables are loaded into memory once and indexed by
+# contract, city, macrozone and neighbourhood; aggregate answers are kept in an
+# LRU cache; and a new dated directory under the root is picked up without a
+# restart.
+#
+#   python query_service.py serve --root ./listings/ --port 8766
+#
+#   GET /health
+#   GET /listings?contract=sale&city=Milano&macrozone=Navigli&page=2&per_page=50
+#       &min_price=100000&max_price=300000&rooms=2&sort=-price_per_sqm
+#   GET /summary?contract=sale&city=Milano            # rows of summary_table.csv
+#   GET /aggregate?contract=rent&city=Milano&by=neighbourhood&metric=price
+#
+#   python query_service.py loadtest --rate 1000 --duration 10
+
+import argparse
+import collections
+import http.client
+import json
+import logging
+import math
+import pathlib
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+import warehouse
+
+LISTINGS_ROOT = pathlib.Path("./listings/")
+QUERY_PORT = 8766
+# indexed location levels, each narrowing the one before
+LEVELS = ["contract", "city", "macrozone", "neighbourhood"]
+METRICS = ["price", "price_per_sqm", "surface"]
+PER_PAGE = 50
+MAX_PER_PAGE = 500
+CACHE_SIZE = 1024
+RELOAD_INTERVAL_S = 30.0
+
+
+def latest_snapshot_dir(root: pathlib.Path = LISTINGS_ROOT) -> pathlib.Path:
+    """The newest dated directory of root that has city tables, or None."""
+    for snapshot_dir in reversed(warehouse.list_snapshots(root)):
+        if next((snapshot_dir / "csv").glob("**/*.csv"), None):
+            return snapshot_dir
+    return None
+
+
+def tables_signature(snapshot_dir: pathlib.Path) -> tuple:
+    """Names and modification times of the tables a Snapshot is loaded from."""
+    paths = list(snapshot_dir.glob("csv/**/*.csv"))
+    paths += list(snapshot_dir.glob("out/*/summary_table.csv"))
+    return tuple(sorted((str(path), path.stat().st_mtime_ns) for path in paths))
+
+
+class LRUCache:
+    """Thread-safe mapping that forgets the least recently used entries."""
+
+    def __init__(self, size: int = CACHE_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value) -> None:
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+def aggregate(grouped) -> pd.DataFrame:
+    """Count, mean, median, q90, min and max of a grouped metric."""
+    return pd.DataFrame(
+        {
+            "count": grouped.count(),
+            "mean": grouped.mean(),
+            "median": grouped.median(),
+            "q90": grouped.quantile(0.9),
+            "min": grouped.min(),
+            "max": grouped.max(),
+        }
+    ).round(2)
+
+
+class Snapshot:
+    """
+    The city tables and summary tables of one snapshot, indexed by location.
+
+    Args:
+        snapshot_dir (pathlib.Path): A ./listings/<yymmdd>/ directory.
+    """
+
+    def __init__(self, snapshot_dir: pathlib.Path):
+        self.path = pathlib.Path(snapshot_dir)
+        self.date = self.path.name
+        self.signature = tables_signature(self.path)
+        listings = warehouse.read_snapshot(self.path)
+        self.listings = listings.reset_index(drop=True)
+        # every listing rendered once, pages are joined from them
+        self.records = np.array(
+            self.listings.to_json(orient="records", lines=True).splitlines(),
+            dtype=object,
+        )
+        # row positions of every contract, contract/city, ... prefix of LEVELS
+        self.index = {
+            depth: self.listings.groupby(LEVELS[:depth], sort=False).indices
+            for depth in range(1, len(LEVELS) + 1)
+        }
+        # the aggregates of every level by location above it, also rendered
+        # for every location so that most aggregate queries are a lookup
+        self.aggregates, self.rendered = {}, {}
+        for depth in range(1, len(LEVELS) + 1):
+            grouped = self.listings.groupby(LEVELS[:depth])
+            parents = list(range(depth - 1))
+            for metric in METRICS:
+                table = aggregate(grouped[metric])
+                self.aggregates[LEVELS[depth - 1], metric] = table
+                if not parents:
+                    self.rendered[LEVELS[0], metric, ()] = table.reset_index().to_json(
+                        orient="records"
+                    )
+                    continue
+                # a one-level list would make groupby yield 1-tuples, with a warning
+                level = parents if len(parents) > 1 else parents[0]
+                for parent, rows in table.groupby(level=level):
+                    parent = parent if isinstance(parent, tuple) else (parent,)
+                    self.rendered[LEVELS[depth - 1], metric, parent] = (
+                        rows.droplevel(parents).reset_index().to_json(orient="records")
+                    )
+        self.summaries = {}
+        for path in self.path.glob("out/*/summary_table.csv"):
+            self.summaries[path.parent.name] = pd.read_csv(path)
+
+    def rows(self, filters: dict) -> np.ndarray:
+        """Row positions of the listings in a location, see LEVELS."""
+        depth = 0
+        while depth < len(LEVELS) and filters.get(LEVELS[depth]) is not None:
+            depth += 1
+        if depth == 0:
+            positions = np.arange(len(self.listings))
+        else:
+            key = tuple(filters[level] for level in LEVELS[:depth])
+            positions = self.index[depth].get(key[0] if depth == 1 else key)
+            if positions is None:
+                return np.empty(0, dtype=np.int64)
+        # levels given below a missing one are filtered instead of looked up
+        for level in LEVELS[depth:]:
+            if filters.get(level) is not None:
+                values = self.listings[level].to_numpy()[positions]
+                positions = positions[values == filters[level]]
+        return positions
+
+
+class QueryService:
+    """
+    Answers the queries of QueryHandler from the latest snapshot under root.
+
+    Args:
+        root (pathlib.Path): Directory holding the daily snapshots.
+        cache_size (int): Aggregate answers kept in the LRU cache.
+    """
+
+    def __init__(
+        self, root: pathlib.Path = LISTINGS_ROOT, cache_size: int = CACHE_SIZE
+    ):
+        self.root = pathlib.Path(root)
+        self.cache = LRUCache(cache_size)
+        self.snapshot = None
+        self.reload()
+
+    def reload(self) -> bool:
+        """
+        Load the latest snapshot if it is not the one served, or its tables
+        changed since (e.g. it was still being compiled). True if it was.
+        """
+        snapshot_dir = latest_snapshot_dir(self.root)
+        if snapshot_dir is None or (
+            self.snapshot is not None
+            and snapshot_dir == self.snapshot.path
+            and tables_signature(snapshot_dir) == self.snapshot.signature
+        ):
+            return False
+        start = time.perf_counter()
+        snapshot = Snapshot(snapshot_dir)
+        # queries in flight finish on the snapshot they started with
+        self.snapshot = snapshot
+        self.cache.clear()
+        logging.info(
+            f"Serving snapshot {snapshot.date}, {len(snapshot.listings)} listings "
+            f"loaded in {time.perf_counter() - start:.1f}s"
+        )
+        return True
+
+    def watch(self, interval_s: float = RELOAD_INTERVAL_S) -> threading.Thread:
+        """Check for a new snapshot every interval_s seconds in the background."""
+
+        def run():
+            while True:
+                time.sleep(interval_s)
+                try:
+                    self.reload()
+                except Exception as e:
+                    logging.warning(f"Reload failed: {e}")
+
+        thread = threading.Thread(target=run, name="snapshot-watcher", daemon=True)
+        thread.start()
+        return thread
+
+    def health(self, query: dict) -> dict:
+        snapshot = self.snapshot
+        return {
+            "snapshot": snapshot.date if snapshot else None,
+            "listings": len(snapshot.listings) if snapshot else 0,
+            "cache": {
+                "entries": len(self.cache.entries),
+                "hits": self.cache.hits,
+                "misses": self.cache.misses,
+            },
+        }
+
+    def listings(self, query: dict) -> str:
+        """One page of the listings of a location, with optional filters."""
+        snapshot = self.snapshot
+        positions = snapshot.rows(query)
+        table = snapshot.listings
+        for column in ("price", "surface"):
+            for bound, compare in (("min", np.greater_equal), ("max", np.less_equal)):
+                if query.get(f"{bound}_{column}") is not None:
+                    values = table[column].to_numpy()[positions]
+                    limit = float(query[f"{bound}_{column}"])
+                    positions = positions[compare(values, limit)]
+        if query.get("rooms") is not None:
+            positions = positions[
+                table["rooms"].to_numpy()[positions] == float(query["rooms"])
+            ]
+        if query.get("sort"):
+            column = query["sort"].lstrip("-")
+            if column not in METRICS + ["rooms", "id"]:
+                raise ValueError(f"Cannot sort by {column}")
+            values = table[column].to_numpy(np.float64)[positions]
+            # argsort puts NaN last, so descending sorts negate instead of reversing
+            if query["sort"][0] == "-":
+                values = -values
+            positions = positions[np.argsort(values, kind="stable")]
+
+        per_page = min(int(query.get("per_page") or PER_PAGE), MAX_PER_PAGE)
+        page = max(int(query.get("page") or 1), 1)
+        rows = positions[(page - 1) * per_page : page * per_page]
+        results = "[" + ",".join(snapshot.records[rows]) + "]"
+        return (
+            f'{{"snapshot": "{snapshot.date}", "total": {len(positions)}, '
+            f'"pages": {math.ceil(len(positions) / per_page)}, "page": {page}, '
+            f'"per_page": {per_page}, "results": {results}}}'
+        )
+
+    def summary(self, query: dict) -> str:
+        """Rows of a contract's summary_table.csv, by city and macrozone."""
+        snapshot = self.snapshot
+        key = (
+            "summary",
+            snapshot.date,
+            query.get("contract") or "sale",
+            query.get("city"),
+            query.get("macrozone"),
+        )
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        table = snapshot.summaries.get(key[2])
+        if table is None:
+            raise LookupError(f"No summary table for {key[2]} in {snapshot.date}")
+        for column, value in (("city_name", key[3]), ("macrozone_name", key[4])):
+            if value is not None:
+                table = table[table[column] == value]
+        body = table.to_json(orient="records")
+        self.cache.put(key, body)
+        return body
+
+    def aggregate(self, query: dict) -> str:
+        """
+        Count, mean, median, q90, min and max of a metric by a level, within
+        the locations given by the levels above it.
+        """
+        snapshot = self.snapshot
+        by = query.get("by") or "macrozone"
+        metric = query.get("metric") or "price_per_sqm"
+        if by not in LEVELS or metric not in METRICS:
+            raise ValueError(f"Aggregate one of {METRICS} by one of {LEVELS}")
+        levels = LEVELS[: LEVELS.index(by) + 1]
+        if any(query.get(level) is not None for level in LEVELS[len(levels) :]):
+            raise ValueError(f"Only the levels above {by} can be filtered")
+        location = tuple(query.get(level) for level in levels[:-1])
+        if None not in location:
+            return snapshot.rendered.get((by, metric, location), "[]")
+        key = ("aggregate", snapshot.date, by, metric) + location
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        table = snapshot.aggregates[by, metric]
+        given = [level for level in levels[:-1] if query.get(level) is not None]
+        if given:
+            values = tuple(query[level] for level in given)
+            try:
+                table = table.xs(values, level=given, drop_level=True)
+            except KeyError:
+                table = table.iloc[:0].droplevel(given)
+        body = table.reset_index().to_json(orient="records")
+        self.cache.put(key, body)
+        return body
+
+
+class QueryServer(ThreadingHTTPServer):
+    """Serves a QueryService, one GET endpoint per method."""
+
+    daemon_threads = True
+    methods = ("health", "listings", "summary", "aggregate")
+
+    def __init__(self, service: QueryService, address: tuple = ("0.0.0.0", QUERY_PORT)):
+        super().__init__(address, QueryHandler)
+        self.service = service
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, which Nagle's algorithm would
+    # hold back until the client's delayed ACK, ~40 ms per request
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        method = url.path.strip("/")
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if method not in self.server.methods:
+            return self._send(404, json.dumps({"error": f"unknown endpoint {method}"}))
+        if self.server.service.snapshot is None and method != "health":
+            return self._send(503, json.dumps({"error": "no snapshot loaded"}))
+        try:
+            result = getattr(self.server.service, method)(query)
+        except LookupError as e:
+            return self._send(404, json.dumps({"error": str(e)}))
+        except (TypeError, ValueError) as e:
+            return self._send(400, json.dumps({"error": str(e)}))
+        self._send(200, result if isinstance(result, str) else json.dumps(result))
+
+    def _send(self, status: int, body: str) -> None:
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _serve(root: pathlib.Path, port: int, ready) -> None:
+    server = QueryServer(QueryService(root), ("127.0.0.1", port))
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def load_test(
+    root: pathlib.Path = LISTINGS_ROOT,
+    rate: float = 1000.0,
+    duration_s: float = 10.0,
+    connections: int = 8,
+    url: str = None,
+) -> dict:
+    """
+    Send a mix of listing, summary and aggregate queries at a fixed rate.
+
+    Requests are sent on a schedule, rate per second, whether or not the
+    earlier ones were answered, and each latency is measured from the time
+    the request was due, so a server falling behind shows up in the tail
+    instead of slowing the test down.
+
+    Args:
+        root (pathlib.Path): Snapshots to serve and to draw the queries from.
+        rate (float): Requests per second.
+        duration_s (float): Length of the test.
+        connections (int): Keep-alive connections sending the requests.
+        url (str): A running service, e.g. http://host:8766; by default one is
+            started on root in its own process.
+
+    Returns:
+        dict: Achieved rate, errors and latency percentiles.
+    """
+    import itertools
+    import multiprocessing
+
+    import benchmark
+
+    process = None
+    if url is None:
+        context = multiprocessing.get_context("spawn")
+        ready = context.Queue()
+        process = context.Process(target=_serve, args=(root, 0, ready), daemon=True)
+        process.start()
+        url = f"http://127.0.0.1:{ready.get(timeout=300)}"
+    address = urllib.parse.urlsplit(url)
+
+    # the queries: every neighbourhood, its macrozone and city
+    snapshot = Snapshot(latest_snapshot_dir(root))
+    locations = snapshot.listings[LEVELS].dropna().drop_duplicates().to_dict("records")
+    rng = np.random.default_rng(0)
+    paths = []
+    for location in rng.choice(locations, 2000):
+        kind = rng.random()
+        if kind < 0.6:
+            query = {**location, "page": int(rng.integers(1, 4))}
+            paths.append("/listings?" + urllib.parse.urlencode(query))
+        elif kind < 0.8:
+            query = {key: location[key] for key in ("contract", "city", "macrozone")}
+            paths.append(
+                "/aggregate?" + urllib.parse.urlencode({**query, "by": "neighbourhood"})
+            )
+        else:
+            query = {"contract": location["contract"], "city": location["city"]}
+            paths.append("/summary?" + urllib.parse.urlencode(query))
+
+    recorder = benchmark.LatencyRecorder()
+    statuses = collections.Counter()
+    counter = itertools.count()
+    total = int(rate * duration_s)
+    start = time.perf_counter() + 0.1
+
+    def send() -> None:
+        connection = http.client.HTTPConnection(address.hostname, address.port)
+        for i in iter(counter.__next__, None):
+            if i >= total:
+                break
+            due = start + i / rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            connection.request("GET", paths[i % len(paths)])
+            response = connection.getresponse()
+            response.read()
+            recorder.add(time.perf_counter() - due)
+            statuses[response.status] += 1
+        connection.close()
+
+    threads = [threading.Thread(target=send) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if process is not None:
+        process.terminate()
+
+    latency = recorder.summary()
+    latency.pop("histogram_ms", None)
+    return {
+        "target_rate": rate,
+        "achieved_rate": round(total / elapsed, 1),
+        "requests": total,
+        "statuses": dict(statuses),
+        **latency,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query service over the snapshots")
+    actions = parser.add_subparsers(dest="action", required=True)
+    action = actions.add_parser("serve", help="serve the latest snapshot")
+    action.add_argument("--root", type=pathlib.Path, default=LISTINGS_ROOT)
+    action.add_argument("--host", default="0.0.0.0")
+    action.add_argument("--port", type=int, default=QUERY_PORT)
+    action.add_argument("--cache-size", type=int, default=CACHE_SIZE)
+    action.add_argument("--reload-interval", type=float, default=RELOAD_INTERVAL_S)
+    action = actions.add_parser("loadtest", help="latency at a fixed request rate")
+    action.add_argument("--root", type=pathlib.Path, default=LISTINGS_ROOT)
+    action.add_argument("--rate", type=float, default=1000.0)
+    action.add_argument("--duration", type=float, default=10.0)
+    action.add_argument("--connections", type=int, default=8)
+    action.add_argument("--url", default=None, help="a running service")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.action == "serve":
+        service = QueryService(args.root, args.cache_size)
+        service.watch(args.reload_interval)
+        server = QueryServer(service, (args.host, args.port))
+        logging.info(f"Serving {args.root} on port {args.port}")
+        server.serve_forever()
+    else:
+        result = load_test(
+            args.root, args.rate, args.duration, args.connections, args.url
+        )
+        print(json.dumps(result, indent=2))
@@ -0,0 +1,911 @@
+# Inverted index over listing descriptions. Descriptions are cut into words and
+# lemmatized (with fast_nlp's lemma table, or straight from the lemmas of the
+# tagging output), and every lemma maps to the listings using it, with the
+# positions it appears at, so keyword lookups don't scan the tagged CSV:
+#
+#   python search_index.py sync --date 261019 --contract sale rent
+#   python search_index.py sync --csv data_sales.csv     # nlp_analysis.clean_data
+#   python search_index.py sync --tokens ./nlp_store/    # the token store's lemmas
+#   python search_index.py search 'terrazzo (box OR "posto auto") -asta' \
+#       --contract sale --city Milano --neighbourhood Brera
+#
+#   index = SearchIndex("./search_index/")
+#   index.sync(listings)                    # id, contract, location, description
+#   index.search('giardino NOT "piano terra"', neighbourhood="Isola", limit=20)
+#
+# Queries are words (all of them must appear), "quoted phrases", OR, NOT or a
+# leading "-", and parentheses; matches are ranked with BM25.
+#
+# Postings live in immutable segments. Each keeps, per lemma, the listings as
+# delta-coded varints interleaved with the lemma's count in each, and the
+# positions delta-coded within each listing, and decodes them with a few numpy
+# operations. A sync writes segments with the new and changed listings and
+# flags the replaced ones as deleted in the document table; segments are merged,
+# and deleted listings dropped, once there are too many of either.
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+import nlp_analysis
+
+INDEX_PATH = pathlib.Path("./search_index/")
+LISTINGS_ROOT = pathlib.Path("./listings/")
+MANIFEST = "manifest.json"
+DOCS_FILE = "docs.npz"
+
+FILTERS = ["contract", "city", "macrozone", "neighbourhood"]
+SEGMENT_DOCS = 100_000  # listings analyzed and written per segment
+MAX_SEGMENTS = 8
+MAX_DELETED = 0.25  # share of deleted listings that triggers a merge
+MERGE_OCCURRENCES = 2**23  # words decoded at once while merging
+K1 = 1.2
+B = 0.75
+
+WORD = re.compile(r"\w+")
+QUERY_TOKEN = re.compile(r'\(|\)|-?"[^"]*"?|[^\s()]+')
+
+
+def varint_lengths(values: np.ndarray) -> np.ndarray:
+    """Bytes taken by each value as a varint, 7 bits a byte."""
+    lengths = np.ones(len(values), np.int64)
+    values = np.asarray(values, np.uint64) >> np.uint64(7)
+    while values.any():
+        lengths += values > 0
+        values = values >> np.uint64(7)
+    return lengths
+
+
+def encode_varints(values: np.ndarray) -> np.ndarray:
+    """
+    Non-negative integers as varints: 7 bits a byte, lowest first, the high
+    bit set on every byte but the last of each value.
+    """
+    values = np.asarray(values, np.uint64)
+    lengths = varint_lengths(values)
+    owner = np.repeat(np.arange(len(values)), lengths)
+    ends = np.cumsum(lengths)
+    byte = np.arange(len(owner)) - np.repeat(ends - lengths, lengths)
+    data = (values[owner] >> (7 * byte).astype(np.uint64)) & np.uint64(127)
+    data = data.astype(np.uint8)
+    data[byte < lengths[owner] - 1] |= 128
+    return data
+
+
+def decode_varints(data: np.ndarray) -> np.ndarray:
+    """The integers of encode_varints."""
+    data = np.asarray(data, np.uint8)
+    single = data < 128
+    # the postings of frequent words are mostly single bytes
+    if single.all():
+        return data.astype(np.int64)
+    ends = np.flatnonzero(single)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    values = (data[starts] & 127).astype(np.int64)
+    # add the k-th byte of the values that have one, a few bytes at most
+    longer = np.flatnonzero(ends > starts)
+    shift = 7
+    while len(longer):
+        at = starts[longer] + shift // 7
+        values[longer] |= (data[at] & 127).astype(np.int64) << shift
+        longer = longer[ends[longer] > at]
+        shift += 7
+    return values
+
+
+def grouped_cumsum(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """Running sums of non-negative values, restarting where starts is True."""
+    totals = np.cumsum(values)
+    return totals - np.maximum.accumulate(np.where(starts, totals - values, 0))
+
+
+def intersect_sorted(a: np.ndarray, b: np.ndarray, size: int) -> np.ndarray:
+    """Values in both sorted arrays of distinct values below size."""
+    if len(a) > len(b):
+        a, b = b, a
+    present = np.zeros(size, bool)
+    present[b] = True
+    return a[present[a]]
+
+
+def group_starts(lengths: np.ndarray) -> np.ndarray:
+    """Mask of the first element of each group of the given lengths."""
+    starts = np.zeros(int(lengths.sum()), bool)
+    starts[(np.cumsum(lengths) - lengths)[lengths > 0]] = True
+    return starts
+
+
+class Segment:
+    """
+    Compressed postings of a batch of listings.
+
+    Args:
+        terms (np.ndarray): The lemmas, sorted.
+        df (np.ndarray): Listings using each lemma.
+        posting_offsets (np.ndarray): Where each lemma's postings start in
+            postings, one more for the end.
+        position_offsets (np.ndarray): The same in positions.
+        postings (np.ndarray): Per lemma, the varints of the listing number
+            (delta from the previous one) and the lemma's count in it.
+        positions (np.ndarray): Per posting, the varints of the positions of
+            the lemma in the listing, delta from the previous one.
+    """
+
+    def __init__(
+        self,
+        terms: np.ndarray,
+        df: np.ndarray,
+        posting_offsets: np.ndarray,
+        position_offsets: np.ndarray,
+        postings: np.ndarray,
+        positions: np.ndarray,
+    ):
+        self.terms = terms
+        self.df = df
+        self.posting_offsets = posting_offsets
+        self.position_offsets = position_offsets
+        self.postings = postings
+        self.positions = positions
+        self.lookup = {term: i for i, term in enumerate(terms.tolist())}
+
+    @classmethod
+    def build(
+        cls,
+        vocabulary: np.ndarray,
+        term_codes: np.ndarray,
+        docs: np.ndarray,
+        positions: np.ndarray,
+    ) -> "Segment":
+        """
+        Postings of every word occurrence.
+
+        Args:
+            vocabulary (np.ndarray): Sorted lemmas.
+            term_codes (np.ndarray): Lemma of each occurrence in vocabulary.
+            docs (np.ndarray): Listing number of each occurrence.
+            positions (np.ndarray): Position of each occurrence in its listing.
+        """
+        order = np.lexsort((positions, docs, term_codes))
+        terms, docs, positions = term_codes[order], docs[order], positions[order]
+
+        new_posting = np.ones(len(terms), bool)
+        new_posting[1:] = (terms[1:] != terms[:-1]) | (docs[1:] != docs[:-1])
+        posting_starts = np.flatnonzero(new_posting)
+        tf = np.diff(np.append(posting_starts, len(terms)))
+        posting_terms, posting_docs = terms[posting_starts], docs[posting_starts]
+        new_term = np.ones(len(posting_terms), bool)
+        new_term[1:] = posting_terms[1:] != posting_terms[:-1]
+        term_starts = np.flatnonzero(new_term)
+
+        doc_deltas = np.where(new_term, posting_docs, np.diff(posting_docs, prepend=0))
+        pairs = np.column_stack([doc_deltas, tf]).ravel()
+        posting_bytes = varint_lengths(pairs).reshape(-1, 2).sum(axis=1)
+        position_deltas = np.where(
+            new_posting, positions, np.diff(positions, prepend=0)
+        )
+        position_bytes = varint_lengths(position_deltas)
+
+        def offsets(sizes: np.ndarray, starts: np.ndarray) -> np.ndarray:
+            if not len(starts):
+                return np.zeros(1, np.int64)
+            return np.concatenate([[0], np.cumsum(np.add.reduceat(sizes, starts))])
+
+        return cls(
+            np.asarray(vocabulary, dtype=object)[posting_terms[term_starts]],
+            np.diff(np.append(term_starts, len(posting_terms))).astype(np.int64),
+            offsets(posting_bytes, term_starts),
+            offsets(position_bytes, posting_starts[term_starts]),
+            encode_varints(pairs),
+            encode_varints(position_deltas),
+        )
+
+    def term_postings(self, term: str) -> tuple:
+        """Listing numbers using a lemma and its count in each."""
+        i = self.lookup.get(term)
+        if i is None:
+            return np.empty(0, np.int64), np.empty(0, np.int64)
+        pairs = decode_varints(
+            self.postings[self.posting_offsets[i] : self.posting_offsets[i + 1]]
+        )
+        return np.cumsum(pairs[0::2]), pairs[1::2]
+
+    def term_positions(
+        self, term: str, tf: np.ndarray, kept: np.ndarray = None
+    ) -> np.ndarray:
+        """
+        Positions of a lemma, listing by listing, given its counts; only in
+        the kept postings if a mask of them is given.
+        """
+        i = self.lookup[term]
+        deltas = decode_varints(
+            self.positions[self.position_offsets[i] : self.position_offsets[i + 1]]
+        )
+        if kept is not None:
+            deltas, tf = deltas[np.repeat(kept, tf)], tf[kept]
+        return grouped_cumsum(deltas, group_starts(tf))
+
+    def occurrences(self, start: int = 0, stop: int = None) -> tuple:
+        """
+        Every (lemma, listing number, position) of the lemmas start to stop,
+        for merging segments.
+        """
+        stop = len(self.terms) if stop is None else stop
+        pairs = decode_varints(
+            self.postings[self.posting_offsets[start] : self.posting_offsets[stop]]
+        )
+        tf = pairs[1::2]
+        df = self.df[start:stop]
+        posting_terms = np.repeat(np.arange(start, stop), df)
+        docs = grouped_cumsum(pairs[0::2], group_starts(df))
+        deltas = decode_varints(
+            self.positions[self.position_offsets[start] : self.position_offsets[stop]]
+        )
+        positions = grouped_cumsum(deltas, group_starts(tf))
+        return np.repeat(posting_terms, tf), np.repeat(docs, tf), positions
+
+    @classmethod
+    def concatenate(cls, segments: list) -> "Segment":
+        """One segment from segments holding successive ranges of lemmas."""
+        segments = [segment for segment in segments if len(segment.terms)]
+        if not segments:
+            return cls.build(np.empty(0, object), *[np.empty(0, np.int64)] * 3)
+
+        def offsets(name: str, data: str) -> np.ndarray:
+            shifts = np.cumsum([0] + [len(getattr(s, data)) for s in segments])
+            return np.concatenate(
+                [[0]]
+                + [getattr(s, name)[1:] + shift for s, shift in zip(segments, shifts)]
+            )
+
+        return cls(
+            np.concatenate([segment.terms for segment in segments]),
+            np.concatenate([segment.df for segment in segments]),
+            offsets("posting_offsets", "postings"),
+            offsets("position_offsets", "positions"),
+            np.concatenate([segment.postings for segment in segments]),
+            np.concatenate([segment.positions for segment in segments]),
+        )
+
+    def save(self, path: pathlib.Path) -> None:
+        # postings are compressed already, and load faster uncompressed; the
+        # lemmas take less as one UTF-8 string than as fixed-width unicode
+        np.savez(
+            path,
+            terms=np.frombuffer("\n".join(self.terms.tolist()).encode(), np.uint8),
+            df=self.df,
+            posting_offsets=self.posting_offsets,
+            position_offsets=self.position_offsets,
+            postings=self.postings,
+            positions=self.positions,
+        )
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> "Segment":
+        with np.load(path) as data:
+            terms = data["terms"].tobytes().decode()
+            return cls(
+                np.asarray(terms.split("\n") if terms else [], dtype=object),
+                data["df"],
+                data["posting_offsets"],
+                data["position_offsets"],
+                data["postings"],
+                data["positions"],
+            )
+
+
+class Analyzer:
+    """
+    Turns text into the lemmas that are indexed and searched.
+
+    Args:
+        lemma_table (pd.Series): Lemmas indexed by lowercase word, from
+            fast_nlp.build_lemma_table. Other words are their own lemma.
+    """
+
+    def __init__(self, lemma_table: pd.Series = None):
+        self.lemmas = lemma_table
+        self.lookup = {} if lemma_table is None else lemma_table.to_dict()
+
+    def words(self, text: str) -> list:
+        """Lemmas of a short text such as a query, as analyze would give them."""
+        words = WORD.findall(text.lower().strip(nlp_analysis.STRIP_CHARS))
+        return [str(self.lookup.get(word, word)).lower() for word in words]
+
+    def analyze(self, texts: list) -> tuple:
+        """
+        Lemmas of every text, in order.
+
+        Returns:
+            tuple: The lemmas of all texts one after the other, and the number
+                of lemmas of each text.
+        """
+        cleaned = nlp_analysis.normalize_descriptions(pd.Series(texts, dtype=object))
+        words = [
+            WORD.findall(text) if isinstance(text, str) else [] for text in cleaned
+        ]
+        lengths = np.array([len(text) for text in words], np.int64)
+        codes, uniques = pd.factorize(
+            pd.Series([word for text in words for word in text], dtype=object)
+        )
+        uniques = pd.Series(uniques, dtype=object)
+        if self.lemmas is not None:
+            uniques = uniques.map(self.lemmas).fillna(uniques).str.lower()
+        return uniques.to_numpy(dtype=object)[codes], lengths
+
+
+def token_terms(tokens: pd.DataFrame) -> pd.DataFrame:
+    """
+    Lemmas of the tagging output, one row per word.
+
+    Args:
+        tokens (pd.DataFrame): id, text and lemma of every token, in order,
+            from nlp_analysis.tag_data or token_store.TokenStore.tokens().
+
+    Returns:
+        pd.DataFrame: id and term, punctuation and spaces left out.
+    """
+    words = tokens[tokens["text"].astype(str).str.contains(r"\w", regex=True)]
+    return pd.DataFrame(
+        {"id": words["id"].to_numpy(), "term": words["lemma"].str.lower().to_numpy()}
+    )
+
+
+def description_digest(text: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(text.encode(), digest_size=8).digest(), "little"
+    )
+
+
+def parse_query(query: str):
+    """
+    Parse a query into nested ("and" | "or", [nodes]), ("not", node) and
+    ("words", text) tuples.
+    """
+    tokens = QUERY_TOKEN.findall(query)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        if position == len(tokens):
+            raise ValueError(f"Unexpected end of query {query!r}")
+        position += 1
+        return tokens[position - 1]
+
+    def any_of():
+        nodes = [all_of()]
+        while peek() == "OR":
+            take()
+            nodes.append(all_of())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def all_of():
+        nodes = []
+        while peek() not in (None, ")", "OR"):
+            if peek() == "AND":
+                take()
+                continue
+            nodes.append(unary())
+        if not nodes:
+            raise ValueError(f"Empty expression in query {query!r}")
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def unary():
+        token = take()
+        if token in ("NOT", "-"):
+            return ("not", unary())
+        if token.startswith("-"):
+            return ("not", ("words", token[1:].strip('"')))
+        if token == "(":
+            node = any_of()
+            if take() != ")":
+                raise ValueError(f"Unbalanced parentheses in query {query!r}")
+            return node
+        return ("words", token.strip('"'))
+
+    node = any_of()
+    if peek() is not None:
+        raise ValueError(f"Unexpected {peek()!r} in query {query!r}")
+    return node
+
+
+class SearchIndex:
+    """
+    Full-text index of listing descriptions, kept up to date between runs.
+
+    Args:
+        path (pathlib.Path): Directory of the index, created on first sync.
+        lemma_table (pd.Series): See Analyzer; fast_nlp's saved table if None.
+    """
+
+    def __init__(self, path: pathlib.Path = INDEX_PATH, lemma_table=None):
+        self.path = pathlib.Path(path)
+        if lemma_table is None:
+            import fast_nlp
+
+            lemma_table = fast_nlp.load_lemma_table()
+        self.analyzer = Analyzer(lemma_table)
+        self.segments = {}
+        self._columns = None
+        self.docs = pd.DataFrame(
+            {
+                "id": pd.Series(dtype=np.int64),
+                **{name: pd.Categorical([]) for name in FILTERS},
+                "length": pd.Series(dtype=np.int64),
+                "live": pd.Series(dtype=bool),
+                "digest": pd.Series(dtype=np.uint64),
+            }
+        )
+        if (self.path / MANIFEST).exists():
+            self.load()
+
+    def load(self) -> None:
+        self._columns = None
+        manifest = json.loads((self.path / MANIFEST).read_text())
+        self.segments = {
+            name: Segment.load(self.path / name) for name in manifest["segments"]
+        }
+        with np.load(self.path / DOCS_FILE) as data:
+            self.docs = pd.DataFrame(
+                {
+                    "id": data["id"],
+                    **{
+                        name: pd.Categorical.from_codes(
+                            data[f"{name}_codes"], data[f"{name}_labels"]
+                        )
+                        for name in FILTERS
+                    },
+                    "length": data["length"],
+                    "live": data["live"],
+                    "digest": data["digest"],
+                }
+            )
+
+    def save(self) -> None:
+        """Write the document table and the manifest; segments are written once."""
+        self._columns = None
+        arrays = {
+            "id": self.docs["id"].to_numpy(np.int64),
+            "length": self.docs["length"].to_numpy(np.int64),
+            "live": self.docs["live"].to_numpy(bool),
+            "digest": self.docs["digest"].to_numpy(np.uint64),
+        }
+        for name in FILTERS:
+            values = self.docs[name].cat
+            arrays[f"{name}_codes"] = values.codes.to_numpy()
+            arrays[f"{name}_labels"] = np.asarray(values.categories, dtype=str)
+        tmp_path = self.path / f"{DOCS_FILE}.tmp.npz"
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, self.path / DOCS_FILE)
+        tmp_path = self.path / f"{MANIFEST}.tmp"
+        tmp_path.write_text(json.dumps({"segments": list(self.segments)}))
+        os.replace(tmp_path, self.path / MANIFEST)
+
+    def _write_segment(self, segment: Segment) -> None:
+        name = f"segment-{len(self.docs):012d}-{time.time_ns()}.npz"
+        segment.save(self.path / name)
+        self.segments[name] = segment
+
+    def _add(self, listings: pd.DataFrame, terms: np.ndarray, lengths: np.ndarray):
+        """Write a segment for the listings and append them to the documents."""
+        first = len(self.docs)
+        docs = np.repeat(np.arange(first, first + len(listings)), lengths)
+        positions = np.arange(len(docs)) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths
+        )
+        codes, vocabulary = pd.factorize(pd.Series(terms, dtype=object), sort=True)
+        if len(docs):
+            self._write_segment(
+                Segment.build(
+                    np.asarray(vocabulary, dtype=object), codes, docs, positions
+                )
+            )
+        added = pd.DataFrame(
+            {
+                "id": listings["id"].to_numpy(np.int64),
+                **{name: listings[name].to_numpy() for name in FILTERS},
+                "length": lengths,
+                "live": True,
+                "digest": listings["digest"].to_numpy(np.uint64),
+            }
+        )
+        docs_table = pd.concat(
+            [self.docs.astype({name: object for name in FILTERS}), added],
+            ignore_index=True,
+        )
+        self.docs = docs_table.astype({name: "category" for name in FILTERS})
+
+    def sync(self, listings: pd.DataFrame, tokens: pd.DataFrame = None) -> dict:
+        """
+        Bring the index up to date with listings.
+
+        Args:
+            listings (pd.DataFrame): id, the FILTERS columns (contract is
+                "sale" and the others empty when missing) and description,
+                every listing that should be searchable.
+            tokens (pd.DataFrame): Tagging output to take the lemmas from
+                instead of analyzing the descriptions, see token_terms.
+
+        Returns:
+            dict: How many listings were indexed, removed and kept.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        listings = listings.drop_duplicates("id", keep="last").copy()
+        for name in FILTERS:
+            default = "sale" if name == "contract" else ""
+            if name not in listings:
+                listings[name] = default
+            listings[name] = listings[name].fillna(default).astype(str)
+
+        words = None
+        if tokens is not None:
+            words = token_terms(tokens)
+            words = words[words["id"].isin(listings["id"])]
+            text = words.groupby("id")["term"].agg(" ".join)
+            text = text.reindex(listings["id"]).fillna("")
+        else:
+            text = listings["description"].fillna("").astype(str)
+        values = zip(text, *[listings[name] for name in FILTERS])
+        listings["digest"] = np.array(
+            [description_digest("\x1f".join(row)) for row in values], np.uint64
+        )
+
+        live = self.docs[self.docs["live"]]
+        known = pd.Index(live["id"]).get_indexer(listings["id"])
+        # a new id (-1) picks the appended 0, and is changed anyway
+        digests = np.append(live["digest"].to_numpy(np.uint64), np.uint64(0))[known]
+        changed = listings[(known < 0) | (digests != listings["digest"].to_numpy())]
+        removed = ~live["id"].isin(listings["id"])
+        replaced = live["id"].isin(changed["id"]) | removed
+        self.docs.loc[live.index[replaced.to_numpy()], "live"] = False
+
+        for start in range(0, len(changed), SEGMENT_DOCS):
+            batch = changed.iloc[start : start + SEGMENT_DOCS]
+            if words is not None:
+                doc = pd.Series(np.arange(len(batch)), index=batch["id"].to_numpy())
+                batch_words = words[words["id"].isin(batch["id"])]
+                # stable, so each listing's words stay in order
+                batch_words = batch_words.assign(
+                    doc=batch_words["id"].map(doc).to_numpy()
+                ).sort_values("doc", kind="stable")
+                terms = batch_words["term"].to_numpy(dtype=object)
+                lengths = np.bincount(batch_words["doc"], minlength=len(batch))
+            else:
+                terms, lengths = self.analyzer.analyze(batch["description"].tolist())
+            self._add(batch, terms, lengths)
+
+        deleted = 1 - self.docs["live"].mean() if len(self.docs) else 0
+        if len(self.segments) > MAX_SEGMENTS or deleted > MAX_DELETED:
+            self.merge()
+        self.save()
+        report = {
+            "indexed": len(changed),
+            "removed": int(removed.sum()),
+            "unchanged": len(listings) - len(changed),
+            "segments": len(self.segments),
+        }
+        logging.info(f"Search index sync: {report}")
+        return report
+
+    def merge(self) -> None:
+        """
+        Merge every segment into one, leaving the deleted listings out.
+
+        The lemmas are merged a range at a time, each range holding about
+        MERGE_OCCURRENCES words, which bounds the memory used.
+        """
+        live = self.docs["live"].to_numpy()
+        renumber = np.cumsum(live) - 1
+        segments = list(self.segments.values())
+        vocabulary = np.unique(
+            np.concatenate([segment.terms for segment in segments] or [[]])
+        ).astype(object)
+        occurrences = np.zeros(len(vocabulary), np.int64)
+        for segment in segments:
+            np.add.at(
+                occurrences,
+                np.searchsorted(vocabulary, segment.terms),
+                np.diff(segment.position_offsets),
+            )
+        chunk = np.cumsum(occurrences) // MERGE_OCCURRENCES
+        bounds = np.concatenate(
+            [[0], np.flatnonzero(np.diff(chunk)) + 1, [len(vocabulary)]]
+        )
+
+        parts = []
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            if first == last:
+                continue
+            codes, docs, positions = [], [], []
+            for segment in segments:
+                start = np.searchsorted(segment.terms, vocabulary[first])
+                stop = np.searchsorted(segment.terms, vocabulary[last - 1], "right")
+                terms, segment_docs, segment_positions = segment.occurrences(
+                    start, stop
+                )
+                kept = live[segment_docs]
+                codes.append(
+                    np.searchsorted(vocabulary, segment.terms[start:stop])[
+                        terms[kept] - start
+                    ]
+                )
+                docs.append(renumber[segment_docs[kept]])
+                positions.append(segment_positions[kept])
+            parts.append(
+                Segment.build(
+                    vocabulary,
+                    np.concatenate(codes),
+                    np.concatenate(docs),
+                    np.concatenate(positions),
+                )
+            )
+        old_names = list(self.segments)
+        self.segments = {}
+        self.docs = self.docs[live].reset_index(drop=True)
+        self._write_segment(Segment.concatenate(parts))
+        # the old segments go once the manifest no longer lists them
+        self.save()
+        for name in old_names:
+            (self.path / name).unlink(missing_ok=True)
+
+    def columns(self) -> dict:
+        """The document table as numpy arrays, kept until the table changes."""
+        if self._columns is None:
+            live = self.docs["live"].to_numpy(bool)
+            lengths = self.docs["length"].to_numpy(np.int64)
+            self._columns = {
+                "id": self.docs["id"].to_numpy(np.int64),
+                "live": live,
+                "length": lengths,
+                "average_length": lengths[live].mean() if live.any() else 0.0,
+                **{name: self.docs[name].cat for name in FILTERS},
+            }
+        return self._columns
+
+    def _segment_postings(self, term: str, cache: dict) -> list:
+        """(segment, listing numbers, counts) of a lemma in every segment."""
+        key = ("segments", term)
+        if key not in cache:
+            cache[key] = [
+                (segment, *segment.term_postings(term))
+                for segment in self.segments.values()
+                if term in segment.lookup
+            ]
+        return cache[key]
+
+    def _postings(self, term: str, cache: dict) -> tuple:
+        """Live listing numbers using a lemma, sorted, and its count in each."""
+        if term not in cache:
+            # later segments hold later listing numbers, so they stay sorted
+            postings = self._segment_postings(term, cache)
+            docs = np.concatenate([docs for _, docs, _ in postings] or [[]])
+            tf = np.concatenate([tf for _, _, tf in postings] or [[]])
+            docs = docs.astype(np.int64, copy=False)
+            live = self.columns()["live"][docs]
+            cache[term] = (docs[live], tf[live].astype(np.int64, copy=False))
+        return cache[term]
+
+    def _positions(self, term: str, candidates: np.ndarray, cache: dict) -> tuple:
+        """(listing number, position) of a lemma in the candidate listings."""
+        docs, positions = [], []
+        for segment, segment_docs, tf in self._segment_postings(term, cache):
+            kept = candidates[segment_docs]
+            if not kept.any():
+                continue
+            docs.append(np.repeat(segment_docs[kept], tf[kept]))
+            positions.append(segment.term_positions(term, tf, kept))
+        if not docs:
+            return np.empty(0, np.int64), np.empty(0, np.int64)
+        return np.concatenate(docs), np.concatenate(positions)
+
+    def _match(self, node, mask: np.ndarray, cache: dict, terms: list) -> np.ndarray:
+        """Sorted listing numbers matching a parsed query within mask."""
+        kind, value = node
+        if kind == "words":
+            words = self.analyzer.words(value)
+            terms.extend(words)
+            if not words:
+                return np.empty(0, np.int64)
+            matched = None
+            for word in words:
+                docs = self._postings(word, cache)[0]
+                docs = docs[mask[docs]]
+                matched = (
+                    docs
+                    if matched is None
+                    else intersect_sorted(matched, docs, len(mask))
+                )
+            if len(words) == 1 or not len(matched):
+                return matched
+            # a phrase: the words follow each other in the listing; the keys
+            # of (listing, position) come sorted like the postings
+            candidates = np.zeros(len(mask), bool)
+            candidates[matched] = True
+            keys = None
+            for offset, word in enumerate(words):
+                docs, positions = self._positions(word, candidates, cache)
+                word_keys = (docs << 32) + positions - offset + len(words)
+                if keys is None:
+                    keys = word_keys
+                    continue
+                at = np.searchsorted(word_keys, keys).clip(0, len(word_keys) - 1)
+                keys = keys[word_keys[at] == keys]
+            docs = keys >> 32
+            return docs[np.diff(docs, prepend=-1) != 0]
+        if kind == "not":
+            excluded = self._match(value, mask, cache, [])
+            kept = mask.copy()
+            kept[excluded] = False
+            return np.flatnonzero(kept)
+        if kind == "or":
+            union = np.zeros(len(mask), bool)
+            for child in value:
+                union[self._match(child, mask, cache, terms)] = True
+            return np.flatnonzero(union)
+        positive = [child for child in value if child[0] != "not"]
+        negative = [child[1] for child in value if child[0] == "not"]
+        matched = None
+        for child in positive:
+            docs = self._match(child, mask, cache, terms)
+            matched = (
+                docs if matched is None else intersect_sorted(matched, docs, len(mask))
+            )
+        if matched is None:
+            matched = np.flatnonzero(mask)
+        for child in negative:
+            excluded = np.zeros(len(mask), bool)
+            excluded[self._match(child, mask, cache, [])] = True
+            matched = matched[~excluded[matched]]
+        return matched
+
+    def mask(self, **filters) -> np.ndarray:
+        """Live listings matching {filter: value or list of values}."""
+        columns = self.columns()
+        mask = columns["live"].copy()
+        for name, values in filters.items():
+            if name not in FILTERS:
+                raise ValueError(f"Unknown filter {name!r}, use one of {FILTERS}")
+            if values is None:
+                continue
+            values = [values] if isinstance(values, str) else list(values)
+            codes = columns[name].categories.get_indexer(values)
+            mask &= np.isin(columns[name].codes.to_numpy(), codes[codes >= 0])
+        return mask
+
+    def search(
+        self, query: str, limit: int = 20, rank: bool = True, **filters
+    ) -> pd.DataFrame:
+        """
+        Listings matching a query, best first.
+
+        Args:
+            query (str): See the top of the module.
+            limit (int): Listings returned, None for all of them.
+            rank (bool): Score with BM25; otherwise listings come by number
+                and score is 0.
+            **filters: contract, city, macrozone or neighbourhood values.
+
+        Returns:
+            pd.DataFrame: id, score and the FILTERS of the matches, with the
+                number of matches in attrs["matches"].
+        """
+        columns = self.columns()
+        mask = self.mask(**filters)
+        cache, terms = {}, []
+        matched = self._match(parse_query(query), mask, cache, terms)
+        scores = np.zeros(len(matched))
+        if rank and len(matched):
+            n = columns["live"].sum()
+            norm = K1 * (
+                1 - B + B * columns["length"][matched] / columns["average_length"]
+            )
+            for term in set(terms):
+                docs, tf = self._postings(term, cache)
+                if not len(docs):
+                    continue
+                idf = np.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+                if 16 * len(matched) < len(columns["live"]):
+                    at = np.searchsorted(docs, matched).clip(0, len(docs) - 1)
+                    term_tf = np.where(docs[at] == matched, tf[at], 0)
+                else:
+                    counts = np.zeros(len(columns["live"]), np.int32)
+                    counts[docs] = tf
+                    term_tf = counts[matched]
+                scores += idf * term_tf * (K1 + 1) / (term_tf + norm)
+            order = np.arange(len(matched))
+            if limit is not None and limit < len(matched):
+                # everything tied with the last one kept, so ids break ties
+                kth = np.partition(scores, len(scores) - limit)[len(scores) - limit]
+                order = np.flatnonzero(scores >= kth)
+            order = order[np.lexsort((columns["id"][matched[order]], -scores[order]))]
+            order = order[:limit]
+        else:
+            order = np.arange(len(matched))[:limit]
+        docs = matched[order]
+        results = pd.DataFrame(
+            {
+                "id": columns["id"][docs],
+                "score": scores[order].round(4),
+                **{
+                    name: np.asarray(columns[name].categories, dtype=object)[
+                        columns[name].codes.to_numpy()[docs]
+                    ]
+                    for name in FILTERS
+                },
+            }
+        )
+        results.attrs["matches"] = len(matched)
+        return results
+
+
+def snapshot_listings(
+    root: pathlib.Path = LISTINGS_ROOT, date: str = None, contracts: list = ("sale",)
+) -> pd.DataFrame:
+    """Listings of a snapshot's JSON pages with their descriptions."""
+    import data_processor
+    import near_duplicates
+
+    listings = []
+    for contract in contracts:
+        json_path = data_processor.partition(root, date, "json", contract)
+        for path in sorted(json_path.glob("*.json")):
+            page = near_duplicates.page_listings(path)
+            if not page.empty:
+                listings.append(page.assign(contract=contract))
+    if not listings:
+        return pd.DataFrame(columns=["id", "description"] + FILTERS)
+    return pd.concat(listings, ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search listing descriptions")
+    actions = parser.add_subparsers(dest="action", required=True)
+    action = actions.add_parser("sync", help="index new listings, drop the old")
+    action.add_argument("--path", type=pathlib.Path, default=INDEX_PATH)
+    source = action.add_mutually_exclusive_group()
+    source.add_argument("--root", type=pathlib.Path, default=LISTINGS_ROOT)
+    source.add_argument("--csv", type=pathlib.Path, help="table from data_converter")
+    source.add_argument("--tokens", type=pathlib.Path, help="token store directory")
+    action.add_argument("--date", default=None, help="yymmdd (default: today)")
+    action.add_argument("--contract", nargs="+", default=["sale"])
+    action = actions.add_parser("search", help="query the index")
+    action.add_argument("query")
+    action.add_argument("--path", type=pathlib.Path, default=INDEX_PATH)
+    action.add_argument("--limit", type=int, default=20)
+    for name in FILTERS:
+        action.add_argument(f"--{name}", nargs="+", default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    start = time.perf_counter()
+    index = SearchIndex(args.path)
+    loaded = time.perf_counter()
+    if args.action == "sync":
+        if args.tokens:
+            import token_store
+
+            store = token_store.TokenStore(args.tokens)
+            index.sync(store.listings(), tokens=store.tokens())
+        elif args.csv:
+            index.sync(nlp_analysis.clean_data(args.csv))
+        else:
+            index.sync(snapshot_listings(args.root, args.date, args.contract))
+    else:
+        filters = {name: getattr(args, name) for name in FILTERS}
+        results = index.search(args.query, args.limit, **filters)
+        logging.info(
+            f"Loaded in {1000 * (loaded - start):.0f} ms, "
+            f"{results.attrs['matches']} matches in "
+            f"{1000 * (time.perf_counter() - loaded):.1f} ms"
+        )
+        print(results.to_string(index=False))
@@ -0,0 +1,200 @@
+# Spatial index over listing coordinates. Points are projected onto the unit
+# sphere so that a plain KD-tree on 3D chord distance gives exact great-circle
+# (haversine) neighbours, which keeps radius and nearest-neighbour queries
+# vectorized and fast for a national corpus.
+
+import pathlib
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS_M = 6_371_008.8
+
+
+def to_unit_vectors(latitudes, longitudes) -> np.ndarray:
+    """Project latitude/longitude degrees onto 3D unit vectors."""
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def chord_to_metres(chord):
+    """Convert a chord length on the unit sphere to a great-circle distance."""
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))
+
+
+def metres_to_chord(metres):
+    """Convert a great-circle distance to a chord length on the unit sphere."""
+    return 2 * np.sin(
+        np.minimum(np.asarray(metres, dtype=np.float64), np.pi * EARTH_RADIUS_M)
+        / (2 * EARTH_RADIUS_M)
+    )
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Vectorized haversine distance in metres."""
+    lat1, lon1, lat2, lon2 = (
+        np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2)
+    )
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+class SpatialIndex:
+    """
+    KD-tree over listing coordinates.
+
+    Rows of the source DataFrame without coordinates are dropped; every
+    query returns positions into `SpatialIndex.listings`.
+    """
+
+    def __init__(
+        self,
+        listings: pd.DataFrame,
+        lat_col: str = "latitude",
+        lon_col: str = "longitude",
+    ):
+        listings = listings.dropna(subset=[lat_col, lon_col]).reset_index(drop=True)
+        self.listings = listings
+        self.lat_col = lat_col
+        self.lon_col = lon_col
+        self.latitudes = listings[lat_col].to_numpy(dtype=np.float64)
+        self.longitudes = listings[lon_col].to_numpy(dtype=np.float64)
+        self.tree = cKDTree(
+            to_unit_vectors(self.latitudes, self.longitudes),
+            balanced_tree=False,
+            compact_nodes=True,
+        )
+
+    def __len__(self) -> int:
+        return len(self.listings)
+
+    @classmethod
+    def from_csv(cls, paths, **kwargs) -> "SpatialIndex":
+        """Build an index from one or more parsed listing tables."""
+        if isinstance(paths, (str, pathlib.Path)):
+            paths = [paths]
+        return cls(
+            pd.concat([pd.read_csv(path) for path in paths], ignore_index=True),
+            **kwargs,
+        )
+
+    @classmethod
+    def from_snapshot(
+        cls, snapshot_dir: pathlib.Path, contract: str = "sale", **kwargs
+    ) -> "SpatialIndex":
+        """Build an index from one contract's city tables of a ./listings/<yymmdd>/ snapshot."""
+        csv_path = pathlib.Path(snapshot_dir) / "csv"
+        paths = sorted((csv_path / contract).glob("*.csv"))
+        if contract == "sale":
+            # tables compiled before the contract partitioning hold sales
+            paths += sorted(csv_path.glob("*.csv"))
+        return cls.from_csv(paths, **kwargs)
+
+    def query_radius(self, latitudes, longitudes, radius_m, workers: int = -1) -> list:
+        """
+        Find all listings within radius_m metres of each query point.
+
+        Args:
+            latitudes (array-like): Query latitudes in degrees.
+            longitudes (array-like): Query longitudes in degrees.
+            radius_m (float): Search radius in metres.
+            workers (int): Threads used by the KD-tree, -1 for all cores.
+
+        Returns:
+            list: One array of listing positions per query point.
+        """
+        points = to_unit_vectors(latitudes, longitudes)
+        matches = self.tree.query_ball_point(
+            points, r=float(metres_to_chord(radius_m)), workers=workers
+        )
+        return [np.asarray(match, dtype=np.int64) for match in matches]
+
+    def count_radius(
+        self, latitudes, longitudes, radius_m, workers: int = -1
+    ) -> np.ndarray:
+        """Count the listings within radius_m metres of each query point."""
+        points = to_unit_vectors(latitudes, longitudes)
+        return self.tree.query_ball_point(
+            points,
+            r=float(metres_to_chord(radius_m)),
+            workers=workers,
+            return_length=True,
+        )
+
+    def query_knn(
+        self,
+        latitudes,
+        longitudes,
+        k: int,
+        max_distance_m: float = np.inf,
+        workers: int = -1,
+    ) -> tuple:
+        """
+        Find the k nearest listings to each query point.
+
+        Missing neighbours (fewer than k listings within max_distance_m) are
+        reported with an infinite distance and position len(self).
+
+        Returns:
+            tuple: (distances in metres, listing positions), both shaped (n, k).
+        """
+        points = to_unit_vectors(latitudes, longitudes)
+        chord, positions = self.tree.query(
+            points,
+            k=k,
+            distance_upper_bound=(
+                float(metres_to_chord(max_distance_m))
+                if np.isfinite(max_distance_m)
+                else np.inf
+            ),
+            workers=workers,
+        )
+        chord = np.asarray(chord).reshape(len(points), k)
+        positions = np.asarray(positions).reshape(len(points), k)
+        found = np.isfinite(chord)
+        distances = np.where(found, chord_to_metres(np.where(found, chord, 0)), np.inf)
+        return distances, positions
+
+    def knn_comparables(self, k: int, workers: int = -1) -> tuple:
+        """
+        Find the k nearest other listings for every indexed listing.
+
+        Returns:
+            tuple: (distances in metres, listing positions), both shaped (len(self), k).
+        """
+        distances, positions = self.query_knn(
+            self.latitudes, self.longitudes, k + 1, workers=workers
+        )
+        # drop each listing from its own neighbour list; with exact duplicate
+        # coordinates it is not necessarily the first column
+        own = positions == np.arange(len(self))[:, None]
+        own[own.sum(axis=1) == 0, -1] = True
+        keep = ~own
+        shape = (len(self), k)
+        return distances[keep].reshape(shape), positions[keep].reshape(shape)
+
+
+if __name__ == "__main__":
+    import time
+
+    listings_root = pathlib.Path("./listings/")
+    snapshot = sorted(
+        p for p in listings_root.iterdir() if p.is_dir() and p.name.isdigit()
+    )[-1]
+    index = SpatialIndex.from_snapshot(snapshot)
+
+    rng = np.random.default_rng(0)
+    sample = rng.integers(0, len(index), size=100_000)
+    start = time.perf_counter()
+    counts = index.count_radius(index.latitudes[sample], index.longitudes[sample], 500)
+    elapsed = time.perf_counter() - start
+    print(f"100k radius queries (500 m) over {len(index)} listings: {elapsed:.2f}s")
+    start = time.perf_counter()
+    index.query_knn(index.latitudes[sample], index.longitudes[sample], 10)
+    print(f"100k 10-NN queries: {time.perf_counter() - start:.2f}s")
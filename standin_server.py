@@ -0,0 +1,422 @@
+# Local stand-in for the immobiliare.it endpoints used by the pipeline. It
+# serves the recorded responses in json_data_sales/ and json_data_rentals/ and
+# the Milano_city_info.json hierarchy, so every stage can be exercised and
+# benchmarked without touching the live site.
+#
+# Endpoints:
+#   /api-next/search-list/real-estates/   listings pages (idMZona[0], idQuartiere[0], pag)
+#   /search/autocomplete                  [city info]
+#   /search/macrozones                    city info
+#   /v4/time-filter                       TravelTime mock (POST), travel times
+#                                         from straight-line distances
+#
+# H2StandInServer (--http2) serves the same endpoints over cleartext HTTP/2
+# with prior knowledge, for the http2 transport.
+#
+# The recordings predate the city/macrozone/microzone labels in
+# properties[0].location, so they are filled in from the hierarchy to match
+# what the current API returns. The corpus can be scaled: with scale=N every
+# neighbourhood exposes N times its recorded pages, the copies carrying
+# shifted listing ids.
+
+import argparse
+import collections
+import json
+import math
+import pathlib
+import random
+import socketserver
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = pathlib.Path(__file__).parent
+CITY_INFO_PATH = ROOT / "Milano_city_info.json"
+CONTRACT_DIRS = {1: ROOT / "json_data_sales", 2: ROOT / "json_data_rentals"}
+
+LISTINGS_PATH = "/api-next/search-list/real-estates/"
+AUTOCOMPLETE_PATH = "/search/autocomplete"
+MACROZONES_PATH = "/search/macrozones"
+
+ID_OFFSET = 1_000_000_000  # listing id shift between scaled copies of a page
+RENDER_CACHE_SIZE = 1024  # rendered pages kept per corpus
+
+TIME_FILTER_PATH = "/v4/time-filter"
+TIME_FILTER_MAX_LOCATIONS = 2000
+TIME_FILTER_MAX_SEARCHES = 10
+TRANSIT_SPEED_M_S = 5.5  # door to door by public transport, walks included
+TRANSIT_WAIT_S = 300.0
+EARTH_RADIUS_M = 6_371_000.0
+
+
+class RecordedCorpus:
+    """Index of the recorded listings pages by contract and neighbourhood."""
+
+    def __init__(self, contract_dirs: dict = CONTRACT_DIRS, scale: int = 1):
+        self.scale = scale
+        self.pages = collections.defaultdict(dict)
+        for contract_id, directory in contract_dirs.items():
+            for path in pathlib.Path(directory).glob("json_data_*.json"):
+                macrozone_id, neighbourhood_id, page = path.stem.split("_")[-3:]
+                key = (contract_id, macrozone_id, neighbourhood_id)
+                self.pages[key][int(page)] = path
+        with open(CITY_INFO_PATH) as f:
+            self.city_info = json.load(f)
+        self.labels = {
+            (macrozone["id"], child["id"]): (macrozone["label"], child["label"])
+            for macrozone in self.city_info["macrozones"]
+            for child in macrozone["children"]
+        }
+        self.rendered = {}
+        self.rendered_lock = threading.Lock()
+
+    def max_pages(self, key: tuple) -> int:
+        return len(self.pages.get(key, {})) * self.scale
+
+    def page(
+        self, contract_id: int, macrozone_id: str, neighbourhood_id: str, page: int
+    ) -> bytes:
+        key = (contract_id, str(macrozone_id), str(neighbourhood_id))
+        recorded = len(self.pages.get(key, {}))
+        if not recorded:
+            return json.dumps(
+                {"count": 0, "results": [], "currentPage": page, "maxPages": 0}
+            ).encode()
+        # the API answers page 0 like page 1
+        page = max(page, 1)
+        if page > recorded * self.scale:
+            return json.dumps(
+                {
+                    "count": 0,
+                    "results": [],
+                    "currentPage": page,
+                    "maxPages": recorded * self.scale,
+                }
+            ).encode()
+        copy, recorded_page = divmod(page - 1, recorded)
+        args = (key, sorted(self.pages[key])[recorded_page], copy, page)
+        with self.rendered_lock:
+            body = self.rendered.get(args)
+        if body is None:
+            body = self._render(*args)
+            with self.rendered_lock:
+                self.rendered[args] = body
+                # the oldest pages go first
+                while len(self.rendered) > RENDER_CACHE_SIZE:
+                    del self.rendered[next(iter(self.rendered))]
+        return body
+
+    def _render(self, key: tuple, recorded_page: int, copy: int, page: int) -> bytes:
+        with open(self.pages[key][recorded_page]) as f:
+            data = json.load(f)
+        macrozone, neighbourhood = self.labels.get(key[1:], (None, None))
+        for result in data.get("results", []):
+            real_estate = result.get("realEstate") or {}
+            if real_estate.get("id") is not None:
+                real_estate["id"] = int(real_estate["id"]) + copy * ID_OFFSET
+            for properties in real_estate.get("properties") or []:
+                location = properties.get("location") or {}
+                location.setdefault("city", self.city_info["label"])
+                location.setdefault("macrozone", macrozone)
+                location.setdefault("microzone", neighbourhood)
+                properties["location"] = location
+        data["currentPage"] = page
+        data["maxPages"] = self.max_pages(key)
+        return json.dumps(data).encode()
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server over a RecordedCorpus.
+
+    Args:
+        address (tuple): (host, port), port 0 picks a free port.
+        corpus (RecordedCorpus): The recorded responses to serve.
+        latency_ms (float): Mean added latency per request.
+        jitter_ms (float): Standard deviation of the added latency.
+        error_rate (float): Probability of answering with an HTTP 500.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+    handler = None  # StandInHandler, set below
+
+    def __init__(
+        self,
+        address: tuple = ("127.0.0.1", 0),
+        corpus: RecordedCorpus = None,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = None,
+    ):
+        super().__init__(address, self.handler)
+        self.corpus = corpus or RecordedCorpus()
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests_served = collections.Counter()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> threading.Thread:
+        """Serve from a daemon thread and return it."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def draw(self) -> tuple:
+        with self.lock:
+            delay = max(0.0, self.random.gauss(self.latency_ms, self.jitter_ms))
+            fail = self.random.random() < self.error_rate
+        return delay / 1000, fail
+
+    def respond(self, path: str) -> tuple:
+        """Status and body of the response to a GET of path."""
+        url = urllib.parse.urlsplit(path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        delay, fail = self.draw()
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            self.requests_served[url.path] += 1
+
+        if fail:
+            return 500, b'{"error": "stand-in injected failure"}'
+
+        corpus = self.corpus
+        if url.path.rstrip("/") == LISTINGS_PATH.rstrip("/"):
+            body = corpus.page(
+                int(params.get("idContratto", 1)),
+                params.get("idMZona[0]", "0"),
+                params.get("idQuartiere[0]", "0"),
+                int(params.get("pag", 0)),
+            )
+        elif url.path == AUTOCOMPLETE_PATH:
+            body = json.dumps([corpus.city_info]).encode()
+        elif url.path == MACROZONES_PATH:
+            body = json.dumps(corpus.city_info).encode()
+        else:
+            return 404, b'{"error": "not found"}'
+        return 200, body
+
+    def respond_post(self, path: str, body: bytes) -> tuple:
+        """Status and body of the response to a POST of body to path."""
+        url = urllib.parse.urlsplit(path)
+        delay, fail = self.draw()
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            self.requests_served[url.path] += 1
+
+        if fail:
+            return 500, b'{"error": "stand-in injected failure"}'
+        if url.path != TIME_FILTER_PATH:
+            return 404, b'{"error": "not found"}'
+        try:
+            request = json.loads(body)
+        except ValueError:
+            return 400, b'{"error": "invalid json"}'
+        return time_filter(request)
+
+
+def time_filter(request: dict) -> tuple:
+    """
+    Status and body of a TravelTime time-filter answer to the arrival searches
+    of request, timing every departure at TRANSIT_SPEED_M_S along the straight
+    line plus TRANSIT_WAIT_S.
+    """
+    locations = {
+        location["id"]: (location["coords"]["lat"], location["coords"]["lng"])
+        for location in request.get("locations", [])
+    }
+    searches = request.get("arrival_searches", [])
+    if len(request.get("locations", [])) > TIME_FILTER_MAX_LOCATIONS:
+        return 422, b'{"error": "too many locations"}'
+    if len(searches) > TIME_FILTER_MAX_SEARCHES:
+        return 422, b'{"error": "too many searches"}'
+    results = []
+    for search in searches:
+        ids = search["departure_location_ids"]
+        if search["arrival_location_id"] not in locations or any(
+            location_id not in locations for location_id in ids
+        ):
+            return 422, b'{"error": "unknown location id"}'
+        arrival_lat, arrival_lng = map(
+            math.radians, locations[search["arrival_location_id"]]
+        )
+        seconds = []
+        for location_id in ids:
+            lat, lng = map(math.radians, locations[location_id])
+            haversine = (
+                math.sin((lat - arrival_lat) / 2) ** 2
+                + math.cos(lat)
+                * math.cos(arrival_lat)
+                * math.sin((lng - arrival_lng) / 2) ** 2
+            )
+            distance = 2 * EARTH_RADIUS_M * math.asin(math.sqrt(haversine))
+            seconds.append(round(TRANSIT_WAIT_S + distance / TRANSIT_SPEED_M_S))
+        reachable = [time <= search.get("travel_time", 7200) for time in seconds]
+        results.append(
+            {
+                "search_id": search["id"],
+                "locations": [
+                    {"id": location_id, "properties": [{"travel_time": seconds}]}
+                    for location_id, seconds, ok in zip(ids, seconds, reachable)
+                    if ok
+                ],
+                "unreachable": [
+                    location_id for location_id, ok in zip(ids, reachable) if not ok
+                ],
+            }
+        )
+    return 200, json.dumps({"results": results}).encode()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._send(*self.server.respond(self.path))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._send(*self.server.respond_post(self.path, body))
+
+    def _send(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+StandInServer.handler = StandInHandler
+
+
+class H2StandInHandler(socketserver.BaseRequestHandler):
+    """
+    One cleartext HTTP/2 connection (h2c, prior knowledge). Every stream is
+    answered from its own thread, so concurrent requests overlap their
+    latency as they would on the live site.
+    """
+
+    def handle(self):
+        import h2.config
+        import h2.connection
+        import h2.events
+
+        self.conn = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+        )
+        # guards the connection state and the socket, and is signalled when
+        # the client opens its flow control windows
+        self.lock = threading.Condition()
+        self.closed = False
+        with self.lock:
+            self.conn.initiate_connection()
+            self._flush()
+        while not self.closed:
+            try:
+                data = self.request.recv(65536)
+            except OSError:
+                data = b""
+            with self.lock:
+                if not data:
+                    self.closed = True
+                    self.lock.notify_all()
+                    break
+                for event in self.conn.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        threading.Thread(
+                            target=self._respond,
+                            args=(event.stream_id, dict(event.headers)),
+                            daemon=True,
+                        ).start()
+                    elif isinstance(event, h2.events.WindowUpdated):
+                        self.lock.notify_all()
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        self.closed = True
+                        self.lock.notify_all()
+                self._flush()
+
+    def _respond(self, stream_id: int, headers: dict) -> None:
+        import h2.exceptions
+
+        status, body = self.server.respond(headers[":path"])
+        try:
+            with self.lock:
+                self.conn.send_headers(
+                    stream_id,
+                    [
+                        (":status", str(status)),
+                        ("content-type", "application/json"),
+                        ("content-length", str(len(body))),
+                    ],
+                    end_stream=not body,
+                )
+                self._flush()
+            sent = 0
+            while sent < len(body):
+                with self.lock:
+                    window = min(
+                        self.conn.local_flow_control_window(stream_id),
+                        self.conn.max_outbound_frame_size,
+                    )
+                    if window <= 0:
+                        if not self.closed:
+                            self.lock.wait()
+                        if self.closed:
+                            return
+                        continue
+                    chunk = body[sent : sent + window]
+                    sent += len(chunk)
+                    self.conn.send_data(stream_id, chunk, end_stream=sent == len(body))
+                    self._flush()
+        except (h2.exceptions.StreamClosedError, h2.exceptions.ProtocolError, OSError):
+            # the client reset the stream or went away
+            return
+
+    def _flush(self) -> None:
+        data = self.conn.data_to_send()
+        if data:
+            self.request.sendall(data)
+
+
+class H2StandInServer(StandInServer):
+    """StandInServer speaking cleartext HTTP/2 instead of HTTP/1.1."""
+
+    handler = H2StandInHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="immobiliare.it stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8042)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument(
+        "--http2", action="store_true", help="speak cleartext HTTP/2 (h2c)"
+    )
+    args = parser.parse_args()
+
+    server = (H2StandInServer if args.http2 else StandInServer)(
+        (args.host, args.port),
+        RecordedCorpus(scale=args.scale),
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+    )
+    print(f"Serving recorded immobiliare.it responses on {server.base_url}")
+    server.serve_forever()
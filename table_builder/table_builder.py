@@ -7,9 +7,13 @@ import tqdm
 import sys
 import logging
 
+import hierarchy
+import http_cache
+
 logging.basicConfig(level=logging.INFO)
 
 CITY_LIST = "./table_builder/italy_citylist.txt"
+INDEX_TABLE = "./table_builder/index_table.csv"
 AUTOCOMPLETE_ENDPOINT = "https://www.immobiliare.it/search/autocomplete"
 
 
@@ -35,38 +39,7 @@ def call_autocomplete_API(query: str, s: requests.Session) -> dict:
 
 
 def parse_macrozone_data(city_info: dict) -> pd.DataFrame:
-    city_name = city_info["label"]
-    city_id = city_info["id"]
-    province_name = city_info["parents"][0]["label"]
-    province_id = city_info["parents"][0]["id"]
-    region_name = city_info["parents"][1]["label"]
-    region_id = city_info["parents"][1]["id"]
-
-    def create_row(macrozone=None, child=None):
-        row = {
-            "region_name": region_name,
-            "region_id": region_id,
-            "province_name": province_name,
-            "province_id": province_id,
-            "city_name": city_name,
-            "city_id": city_id,
-            "macrozone_name": "" if macrozone is None else macrozone["label"],
-            "macrozone_keyurl": "" if macrozone is None else macrozone["keyurl"],
-            "macrozone_id": 0 if macrozone is None else macrozone["id"],
-            "neighbourhood_name": "" if child is None else child["label"],
-            "neighbourhood_id": 0 if child is None else child["id"],
-        }
-        return row
-
-    if not city_info.get("macrozones"):
-        return pd.DataFrame([create_row()])
-
-    rows = []
-    for macrozone in city_info["macrozones"]:
-        for child in macrozone["children"]:
-            rows.append(create_row(macrozone, child))
-
-    return pd.DataFrame(rows)
+    return hierarchy.Hierarchy.from_city_info(city_info).to_frame()
 
 
 def log_missing(missing_cities):
@@ -78,27 +51,15 @@ def log_missing(missing_cities):
         logging.info("All cities found!")
 
 
-def build_index_table():
-    with open(CITY_LIST, "r") as f:
-        cities = f.readlines()
-        cities = [x.strip() for x in cities]
-
-    s = requests.Session()
-
-    df = pd.DataFrame(
-        columns=[
-            "region_name",
-            "region_id",
-            "province_name",
-            "province_id",
-            "city_name",
-            "city_id",
-            "macrozone_name",
-            "macrozone_id",
-            "neighbourhood_name",
-            "neighbourhood_id",
-        ]
-    )
+def build_index_table(cities: list = None, save_path: str = INDEX_TABLE) -> pd.DataFrame:
+    if cities is None:
+        with open(CITY_LIST, "r") as f:
+            cities = f.readlines()
+            cities = [x.strip() for x in cities]
+
+    s = http_cache.CachedSession()
+
+    tree = hierarchy.Hierarchy()
 
     missing_cities = []
 
@@ -108,12 +69,12 @@ def build_index_table():
             (item for item in response if item.get("admin_centre") == True), None
         )
         if data:
-            df = df._append(parse_macrozone_data(data), ignore_index=True)
+            hierarchy.Hierarchy.from_city_info(data, tree)
         else:
             missing_cities.append(city)
 
-    df = df.astype({"city_id": int, "macrozone_id": int, "neighbourhood_id": int})
-    df.to_csv("./table_builder/index_table.csv", index=False)
+    df = tree.to_frame()
+    df.to_csv(save_path, index=False)
 
     logging.info(
         f"Saved data for {len(cities) - len(missing_cities)}/{len(cities)} cities"
@@ -121,6 +82,8 @@ def build_index_table():
 
     log_missing(missing_cities)
 
+    return df
+
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,351 @@
+# Incremental token store for nlp_analysis. Listings are keyed by id and by a
+# hash of their cleaned description, so each sync only runs spaCy over the
+# listings that are new or whose description changed, drops the tokens of
+# delisted ids, and updates the word statistics by neighbourhood from the
+# difference between the old and new word counts of those listings, instead of
+# recounting every token.
+#
+#   store = TokenStore("./nlp_store/")
+#   store.sync(nlp_analysis.clean_data("data_sales.csv"))
+#   store.most_used_words_by_neighbourhood()
+#
+#   python token_store.py data_sales.csv --words-output words.csv
+#
+# Token rows live in PARTITIONS pickle files picked by id, so a sync only
+# rewrites the partitions holding changed listings. Listing metadata and word
+# counts live in store.sqlite next to them.
+
+import argparse
+import hashlib
+import logging
+import os
+import pathlib
+import sqlite3
+import zlib
+
+import numpy as np
+import pandas as pd
+
+import nlp_analysis
+
+STORE_PATH = pathlib.Path("./nlp_store/")
+PARTITIONS = 64
+
+# the words counted by the reports are alphabetic and not stop words; the
+# keyword table further keeps those written in lowercase with at least four
+# letters (spaCy shape "xxxx")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    id INTEGER PRIMARY KEY,
+    digest TEXT NOT NULL,
+    macrozone TEXT,
+    neighbourhood TEXT,
+    price REAL
+);
+CREATE TABLE IF NOT EXISTS listing_lemmas (
+    id INTEGER NOT NULL,
+    lemma TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (id, lemma)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS listing_keywords (
+    id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (id, text)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS neighbourhood_lemmas (
+    neighbourhood TEXT NOT NULL,
+    lemma TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (neighbourhood, lemma)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS neighbourhood_keywords (
+    neighbourhood TEXT NOT NULL,
+    text TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (neighbourhood, text)
+) WITHOUT ROWID;
+"""
+
+# per-listing table, per-neighbourhood table and word column of each statistic
+COUNTS = {
+    "lemma": ("listing_lemmas", "neighbourhood_lemmas"),
+    "text": ("listing_keywords", "neighbourhood_keywords"),
+}
+
+
+def description_digest(description: str) -> str:
+    return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+
+def partition_of(listing_id) -> int:
+    return zlib.crc32(str(listing_id).encode()) % PARTITIONS
+
+
+def listing_counts(tokens: pd.DataFrame) -> dict:
+    """
+    Word counts of each listing, as counted by the reports.
+
+    Returns:
+        dict: "lemma" and "text" DataFrames of (id, word, count).
+    """
+    words = tokens[tokens["is_alpha"].astype(bool) & ~tokens["is_stop"].astype(bool)]
+    keywords = words[words["shape"] == "xxxx"]
+    return {
+        "lemma": words.groupby(["id", "lemma"]).size().rename("count").reset_index(),
+        "text": keywords.groupby(["id", "text"]).size().rename("count").reset_index(),
+    }
+
+
+class TokenStore:
+    """
+    spaCy tokens of every listing, kept up to date between runs.
+
+    Args:
+        path (pathlib.Path): Directory of the store, created if needed.
+    """
+
+    def __init__(self, path: pathlib.Path = STORE_PATH):
+        self.path = pathlib.Path(path)
+        (self.path / "tokens").mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path / "store.sqlite")
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def partition_path(self, partition: int) -> pathlib.Path:
+        return self.path / "tokens" / f"part-{partition:02d}.pkl"
+
+    def read_partition(self, partition: int) -> pd.DataFrame:
+        path = self.partition_path(partition)
+        if not path.exists():
+            return pd.DataFrame(columns=["id"] + nlp_analysis.TOKEN_COLUMNS)
+        return pd.read_pickle(path)
+
+    def write_partition(self, partition: int, tokens: pd.DataFrame) -> None:
+        path = self.partition_path(partition)
+        tmp_path = path.with_suffix(".tmp")
+        tokens.reset_index(drop=True).to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+
+    def tag(self, descriptions: pd.Series, nlp=None, batch_size: int = 256):
+        """Token rows of the descriptions, which are indexed by listing id."""
+        nlp = nlp or nlp_analysis.get_nlp()
+        rows = []
+        docs = nlp.pipe(descriptions.tolist(), batch_size=batch_size)
+        for listing_id, doc in zip(descriptions.index, docs):
+            for record in nlp_analysis.token_records(doc):
+                rows.append({"id": listing_id, **record})
+        return pd.DataFrame(rows, columns=["id"] + nlp_analysis.TOKEN_COLUMNS)
+
+    def _stored_counts(self, table: str, word: str, ids) -> pd.DataFrame:
+        self.conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS touched (id INTEGER PRIMARY KEY)"
+        )
+        self.conn.execute("DELETE FROM touched")
+        self.conn.executemany(
+            "INSERT INTO touched VALUES (?)", ((int(i),) for i in ids)
+        )
+        return pd.read_sql_query(
+            f"SELECT id, {word}, count FROM {table} JOIN touched USING (id)", self.conn
+        )
+
+    def sync(self, df: pd.DataFrame, nlp=None, batch_size: int = 256) -> dict:
+        """
+        Bring the store up to date with the listings of df.
+
+        Args:
+            df (pd.DataFrame): Cleaned listings, as returned by
+                nlp_analysis.clean_data. Listings missing from it are dropped.
+            nlp: spaCy pipeline, nlp_analysis.get_nlp() if None.
+            batch_size (int): Descriptions per nlp.pipe batch.
+
+        Returns:
+            dict: How many listings were tagged, moved, dropped and kept.
+        """
+        listings = (
+            df.rename(columns={"price.value": "price"})
+            .drop_duplicates("id", keep="last")
+            .set_index("id")[["macrozone", "neighbourhood", "price", "description"]]
+        )
+        listings["digest"] = listings["description"].map(description_digest)
+        known = pd.read_sql_query(
+            "SELECT id, digest, neighbourhood FROM listings", self.conn, index_col="id"
+        )
+
+        previous_digest = known["digest"].reindex(listings.index)
+        previous_neighbourhood = known["neighbourhood"].reindex(listings.index)
+        changed = listings.index[listings["digest"] != previous_digest]
+        # same description under another neighbourhood: counts move, no tagging
+        moved = listings.index[
+            (listings["digest"] == previous_digest)
+            & (listings["neighbourhood"] != previous_neighbourhood)
+        ]
+        delisted = known.index.difference(listings.index)
+
+        tokens = self.tag(listings.loc[changed, "description"], nlp, batch_size)
+        new_counts = listing_counts(tokens)
+
+        # token partitions first: if the process dies before the database is
+        # committed, the next sync sees the old digests and tags them again
+        replaced = changed.union(delisted)
+        token_partitions = tokens["id"].map(partition_of)
+        for partition in sorted({partition_of(i) for i in replaced}):
+            stored = self.read_partition(partition)
+            self.write_partition(
+                partition,
+                pd.concat(
+                    [
+                        stored[~stored["id"].isin(replaced)],
+                        tokens[token_partitions == partition],
+                    ]
+                ),
+            )
+
+        neighbourhood = listings["neighbourhood"]
+        with self.conn:
+            for word, (listing_table, neighbourhood_table) in COUNTS.items():
+                old = self._stored_counts(listing_table, word, replaced.union(moved))
+                old["neighbourhood"] = old["id"].map(known["neighbourhood"])
+                old["count"] = -old["count"]
+                carried = old[old["id"].isin(moved)].assign(
+                    count=lambda counts: -counts["count"]
+                )
+                carried["neighbourhood"] = carried["id"].map(neighbourhood)
+                added = new_counts[word].assign(
+                    neighbourhood=new_counts[word]["id"].map(neighbourhood)
+                )
+                delta = (
+                    pd.concat([old, carried, added])
+                    .groupby(["neighbourhood", word])["count"]
+                    .sum()
+                )
+                delta = delta[delta != 0]
+
+                self.conn.executemany(
+                    f"DELETE FROM {listing_table} WHERE id = ?",
+                    ((int(i),) for i in replaced),
+                )
+                self.conn.executemany(
+                    f"INSERT INTO {listing_table} VALUES (?, ?, ?)",
+                    new_counts[word].astype(object).itertuples(index=False, name=None),
+                )
+                self.conn.executemany(
+                    f"INSERT INTO {neighbourhood_table} VALUES (?, ?, ?) "
+                    f"ON CONFLICT (neighbourhood, {word}) "
+                    f"DO UPDATE SET count = count + excluded.count",
+                    delta.reset_index()
+                    .astype(object)
+                    .itertuples(index=False, name=None),
+                )
+                self.conn.execute(f"DELETE FROM {neighbourhood_table} WHERE count <= 0")
+
+            self.conn.executemany(
+                "DELETE FROM listings WHERE id = ?", ((int(i),) for i in delisted)
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)",
+                listings.reset_index()[
+                    ["id", "digest", "macrozone", "neighbourhood", "price"]
+                ]
+                .astype(object)
+                .itertuples(index=False, name=None),
+            )
+
+        report = {
+            "tagged": len(changed),
+            "moved": len(moved),
+            "delisted": len(delisted),
+            "unchanged": len(listings) - len(changed) - len(moved),
+        }
+        logging.info(f"Token store sync: {report}")
+        return report
+
+    def listings(self) -> pd.DataFrame:
+        return pd.read_sql_query(
+            "SELECT id, macrozone, neighbourhood, price FROM listings", self.conn
+        )
+
+    def tokens(self) -> pd.DataFrame:
+        """Every token, in the layout of nlp_analysis.tag_data."""
+        partitions = [self.read_partition(partition) for partition in range(PARTITIONS)]
+        tokens = pd.concat(partitions, ignore_index=True)
+        return self.listings().merge(tokens, on="id")
+
+    def most_used_words_by_neighbourhood(self) -> pd.DataFrame:
+        """Lemmas of each neighbourhood from the most to the least used."""
+        counts = pd.read_sql_query(
+            "SELECT neighbourhood, lemma FROM neighbourhood_lemmas "
+            "ORDER BY neighbourhood, count DESC, lemma",
+            self.conn,
+        )
+        return pd.DataFrame(
+            {
+                neighbourhood: group["lemma"].reset_index(drop=True)
+                for neighbourhood, group in counts.groupby("neighbourhood")
+            }
+        )
+
+    def keyword_percentage_by_neighbourhood(self) -> pd.DataFrame:
+        """Share of each keyword in the keywords of every neighbourhood."""
+        counts = pd.read_sql_query(
+            "SELECT neighbourhood, text, count FROM neighbourhood_keywords", self.conn
+        )
+        table = counts.pivot_table(
+            index="neighbourhood", columns="text", values="count", fill_value=0
+        )
+        return table.div(table.sum(axis=1), axis=0)
+
+    def most_used_words_by_price(self) -> pd.DataFrame:
+        """
+        Lemma frequencies in listings above and below the mean price.
+
+        As in nlp_analysis.most_used_words_by_price, the mean and standard
+        deviation are taken over words rather than listings, and listings more
+        than 1.5 standard deviations from the mean are left out.
+        """
+        counts = pd.read_sql_query(
+            "SELECT price, lemma, count FROM listing_lemmas JOIN listings USING (id)",
+            self.conn,
+        )
+        weights = counts["count"]
+        mean = np.average(counts["price"], weights=weights)
+        std = np.sqrt(
+            (weights * (counts["price"] - mean) ** 2).sum() / (weights.sum() - 1)
+        )
+        counts = counts[
+            (counts["price"] > mean - 1.5 * std) & (counts["price"] < mean + 1.5 * std)
+        ]
+        mean = np.average(counts["price"], weights=counts["count"])
+        above = counts[counts["price"] > mean].groupby("lemma")["count"].sum()
+        below = counts[counts["price"] < mean].groupby("lemma")["count"].sum()
+        words_df = pd.DataFrame(
+            {
+                "frequency_above_mean": above / above.sum(),
+                "frequency_below_mean": below / below.sum(),
+            }
+        )
+        words_df.insert(0, "word", words_df.index)
+        return words_df.sort_values("frequency_above_mean", ascending=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Tag the listings that changed since the last run"
+    )
+    parser.add_argument("input", type=pathlib.Path, help="CSV from data_converter")
+    parser.add_argument("--store", type=pathlib.Path, default=STORE_PATH)
+    parser.add_argument("--words-output", type=pathlib.Path, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    store = TokenStore(args.store)
+    store.sync(nlp_analysis.clean_data(args.input))
+    if args.words_output:
+        store.most_used_words_by_neighbourhood().to_csv(
+            args.words_output, index=False, encoding="utf-8"
+        )
+    store.close()
@@ -0,0 +1,457 @@
+# Pluggable HTTP transport under every requests session of the pipeline.
+# Sessions keep their requests API (and with it the HTTP cache, the rate
+# limiter and the instrumentation hooks); only the adapter that actually talks
+# to the server changes:
+#
+#   requests   urllib3, HTTP/1.1, one request per connection at a time (default)
+#   http2      httpx with h2: many concurrent requests multiplexed over a few
+#              connections, negotiated with ALPN on https:// and spoken with
+#              prior knowledge (h2c) on http://
+#   httpx      httpx over HTTP/1.1, to tell the client apart from the protocol
+#
+# The transport can be set with configure() or the CERCOCASE_TRANSPORT
+# environment variable, e.g. `CERCOCASE_TRANSPORT=http2 python cercocase.py crawl`.
+#
+#   python transport.py bench --pages 2000 --concurrency 32   # against the stand-ins
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import ssl
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+TRANSPORTS = ("requests", "http2", "httpx")
+DEFAULT_POOL_SIZE = 10
+# HTTP/2 needs few connections: each carries up to ~100 concurrent streams
+DEFAULT_HTTP2_CONNECTIONS = 4
+DEFAULT_KEEPALIVE_S = 30.0
+
+
+def ssl_context(verify, cert):
+    """
+    httpx's verify argument for the verify and cert arguments of requests.
+
+    Args:
+        verify (bool | str): Check the server certificate, or the CA bundle
+            file or directory to check it against.
+        cert (str | tuple): Client certificate file, or (certificate, key).
+    """
+    if cert is None and isinstance(verify, bool):
+        return verify
+    context = ssl.create_default_context(
+        cafile=requests.certs.where() if verify is True else None
+    )
+    if verify is False:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif isinstance(verify, str):
+        if os.path.isdir(verify):
+            context.load_verify_locations(capath=verify)
+        else:
+            context.load_verify_locations(cafile=verify)
+    if cert is not None:
+        context.load_cert_chain(*((cert,) if isinstance(cert, str) else cert))
+    return context
+
+
+class StreamedBody:
+    """
+    The raw body of a response sent with stream=True, read from the httpx
+    response on the adapter's event loop as requests iterates over it.
+    """
+
+    def __init__(self, reply, loop: asyncio.AbstractEventLoop, httpx):
+        self.reply = reply
+        self.loop = loop
+        self.httpx = httpx
+        self.chunks = None
+        self.buffer = b""
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def _next_chunk(self, chunk_size: int = None) -> bytes:
+        if self.chunks is None:
+            self.chunks = self.reply.aiter_bytes(chunk_size)
+        try:
+            return self._run(self.chunks.__anext__())
+        except StopAsyncIteration:
+            self.close()
+            return b""
+        except self.httpx.TimeoutException as e:
+            raise requests.exceptions.ConnectionError(e)
+        except self.httpx.TransportError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+
+    def stream(self, chunk_size: int = None, decode_content: bool = True):
+        if self.buffer:
+            yield self.buffer
+            self.buffer = b""
+        while chunk := self._next_chunk(chunk_size):
+            yield chunk
+
+    def read(self, amt: int = None) -> bytes:
+        while amt is None or len(self.buffer) < amt:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            self.buffer += chunk
+        data = self.buffer if amt is None else self.buffer[:amt]
+        self.buffer = self.buffer[len(data) :]
+        return data
+
+    def close(self) -> None:
+        if not self.reply.is_closed and not self.loop.is_closed():
+            self._run(self.reply.aclose())
+
+
+class HTTPXAdapter(requests.adapters.BaseAdapter):
+    """
+    requests adapter sending through an httpx client.
+
+    The client is an AsyncClient running on its own event loop thread, and
+    the session's threads hand their requests to it: httpcore's synchronous
+    HTTP/2 connection can send the headers of concurrent streams out of
+    stream id order, which servers reject, while on a single event loop each
+    stream id is taken and sent in one step. httpx fixes TLS verification,
+    client certificates and proxies per client, so there is a client for
+    every combination the session sends with.
+
+    Args:
+        http2 (bool): Use HTTP/2, with prior knowledge on plain http://.
+        max_connections (int): Connections open at once, per pool.
+        max_keepalive_connections (int): Idle connections kept open.
+        keepalive_expiry (float): Seconds an idle connection is kept.
+    """
+
+    def __init__(
+        self,
+        http2: bool = True,
+        max_connections: int = DEFAULT_HTTP2_CONNECTIONS,
+        max_keepalive_connections: int = None,
+        keepalive_expiry: float = DEFAULT_KEEPALIVE_S,
+    ):
+        import httpx
+
+        super().__init__()
+        self.httpx = httpx
+        # httpx logs every request at INFO
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections or max_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="httpx-transport", daemon=True
+        )
+        self.thread.start()
+        # httpx only speaks HTTP/2 on http:// when HTTP/1.1 is disabled; the
+        # proxies and CA bundle of the environment come from requests
+        self.options = {
+            "https": {"http2": http2, "limits": limits, "trust_env": False},
+            "http": {
+                "http1": not http2,
+                "http2": http2,
+                "limits": limits,
+                "trust_env": False,
+            },
+        }
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def _client(self, scheme: str, verify, cert, proxy: str):
+        """The client of a scheme, TLS settings and proxy, created on first use."""
+        key = (scheme, verify, cert, proxy)
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = self.httpx.AsyncClient(
+                    verify=ssl_context(verify, cert),
+                    proxy=proxy,
+                    **self.options[scheme],
+                )
+            return self.clients[key]
+
+    async def _request(
+        self, client, request: requests.PreparedRequest, timeout, stream: bool
+    ):
+        return await client.send(
+            client.build_request(
+                request.method,
+                request.url,
+                headers=dict(request.headers),
+                content=request.body,
+                timeout=timeout,
+            ),
+            stream=stream,
+        )
+
+    def send(
+        self,
+        request: requests.PreparedRequest,
+        stream=False,
+        timeout=None,
+        verify=True,
+        cert=None,
+        proxies=None,
+    ) -> requests.Response:
+        httpx = self.httpx
+        scheme = "https" if request.url.startswith("https") else "http"
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        if isinstance(cert, list):
+            cert = tuple(cert)
+        proxy = requests.utils.select_proxy(request.url, proxies or {})
+        client = self._client(scheme, verify, cert, proxy)
+        start = time.perf_counter()
+        try:
+            reply = asyncio.run_coroutine_threadsafe(
+                self._request(client, request, timeout, stream), self.loop
+            ).result()
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e, request=request)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+
+        response = requests.Response()
+        response.status_code = reply.status_code
+        response.reason = reply.reason_phrase
+        # the body is already decoded
+        response.headers = CaseInsensitiveDict(
+            (name, value)
+            for name, value in reply.headers.items()
+            if name.lower() not in ("content-encoding", "transfer-encoding")
+        )
+        if stream:
+            response.raw = StreamedBody(reply, self.loop, httpx)
+        else:
+            response._content = reply.content
+        response.url = request.url
+        response.request = request
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.elapsed = datetime.timedelta(seconds=time.perf_counter() - start)
+        response.http_version = reply.http_version
+        return response
+
+    def close(self) -> None:
+        if self.loop.is_closed():
+            return
+        with self.lock:
+            clients = list(self.clients.values())
+        for client in clients:
+            asyncio.run_coroutine_threadsafe(client.aclose(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+_default = {
+    "transport": os.environ.get("CERCOCASE_TRANSPORT", "requests"),
+    "max_connections": None,
+    "keepalive_expiry": DEFAULT_KEEPALIVE_S,
+}
+
+
+def configure(
+    transport: str = None, max_connections: int = None, keepalive_expiry: float = None
+) -> dict:
+    """Set the transport mounted by sessions that are not given one."""
+    if transport is not None and transport not in TRANSPORTS:
+        raise ValueError(f"Unknown transport {transport!r}, use one of {TRANSPORTS}")
+    for key, value in (
+        ("transport", transport),
+        ("max_connections", max_connections),
+        ("keepalive_expiry", keepalive_expiry),
+    ):
+        if value is not None:
+            _default[key] = value
+    return dict(_default)
+
+
+def adapter(
+    transport: str = None,
+    pool_size: int = DEFAULT_POOL_SIZE,
+    max_connections: int = None,
+    keepalive_expiry: float = None,
+) -> requests.adapters.BaseAdapter:
+    """
+    A transport adapter for a session.
+
+    Args:
+        transport (str): One of TRANSPORTS, the configured default if None.
+        pool_size (int): Concurrent requests the session is used for, e.g.
+            the number of worker threads.
+        max_connections (int): Connections per host. Defaults to pool_size
+            for HTTP/1.1 and DEFAULT_HTTP2_CONNECTIONS for HTTP/2.
+        keepalive_expiry (float): Seconds an idle httpx connection is kept;
+            urllib3 keeps idle connections until the server closes them.
+    """
+    transport = transport or _default["transport"]
+    max_connections = max_connections or _default["max_connections"]
+    keepalive_expiry = keepalive_expiry or _default["keepalive_expiry"]
+    if transport == "requests":
+        return requests.adapters.HTTPAdapter(pool_maxsize=max_connections or pool_size)
+    if transport == "http2":
+        return HTTPXAdapter(
+            True, max_connections or DEFAULT_HTTP2_CONNECTIONS, None, keepalive_expiry
+        )
+    if transport == "httpx":
+        return HTTPXAdapter(False, max_connections or pool_size, None, keepalive_expiry)
+    raise ValueError(f"Unknown transport {transport!r}, use one of {TRANSPORTS}")
+
+
+def mount(session: requests.Session, transport: str = None, **kwargs) -> None:
+    """Mount a transport adapter on the http:// and https:// URLs of a session."""
+    transport_adapter = adapter(transport, **kwargs)
+    session.mount("https://", transport_adapter)
+    session.mount("http://", transport_adapter)
+
+
+def bench_transport(
+    transport: str, url: str, pages: list, concurrency: int, **kwargs
+) -> dict:
+    """
+    Fetch listing pages from url with one transport and report latency and
+    client CPU time per page.
+
+    Args:
+        transport (str): One of TRANSPORTS.
+        url (str): The listings endpoint.
+        pages (list): Query parameters of each page.
+        concurrency (int): Threads sharing the session.
+    """
+    import concurrent.futures
+
+    import benchmark
+
+    recorder = benchmark.LatencyRecorder()
+    session = requests.Session()
+    mount(session, transport, pool_size=concurrency, **kwargs)
+
+    def fetch(params: dict) -> int:
+        start = time.perf_counter()
+        response = session.get(url, params=params)
+        response.raise_for_status()
+        response.json()
+        recorder.add(time.perf_counter() - start)
+        return len(response.content)
+
+    # a warm-up request opens the first connection outside the measurement
+    fetch(pages[0])
+    recorder.samples.clear()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        received = sum(executor.map(fetch, pages))
+    seconds = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    session.close()
+    latency = recorder.summary()
+    latency.pop("histogram_ms", None)
+    return {
+        "transport": transport,
+        "pages": len(pages),
+        "concurrency": concurrency,
+        "pages_per_second": round(len(pages) / seconds, 1),
+        "cpu_ms_per_page": round(1000 * cpu / len(pages), 3),
+        "megabytes": round(received / 2**20, 1),
+        **latency,
+    }
+
+
+def _serve(server_class: str, latency_ms: float, scale: int, urls) -> None:
+    import standin_server
+
+    server = getattr(standin_server, server_class)(
+        corpus=standin_server.RecordedCorpus(scale=scale), latency_ms=latency_ms
+    )
+    urls.put(server.base_url)
+    server.serve_forever()
+
+
+def bench(
+    pages: int = 2000,
+    concurrency: int = 32,
+    latency_ms: float = 20.0,
+    transports: tuple = TRANSPORTS,
+    max_connections: int = None,
+) -> list:
+    """
+    Compare the transports on the same listing pages.
+
+    The HTTP/1.1 stand-in serves requests and httpx, the h2c stand-in serves
+    http2; both run in their own process so only the client's CPU time is
+    measured.
+    """
+    import multiprocessing
+
+    import standin_server
+
+    # the pages of every neighbourhood, scaled until there are enough
+    corpus = standin_server.RecordedCorpus()
+    scale = -(-pages // sum(len(recorded) for recorded in corpus.pages.values()))
+    params = [
+        {
+            "idContratto": contract_id,
+            "idMZona[0]": macrozone_id,
+            "idQuartiere[0]": neighbourhood_id,
+            "pag": page,
+        }
+        for (contract_id, macrozone_id, neighbourhood_id), recorded in sorted(
+            corpus.pages.items()
+        )
+        for page in range(1, len(recorded) * scale + 1)
+    ][:pages]
+
+    context = multiprocessing.get_context("spawn")
+    servers = {}
+    for server_class in ("StandInServer", "H2StandInServer"):
+        urls = context.Queue()
+        process = context.Process(
+            target=_serve, args=(server_class, latency_ms, scale, urls), daemon=True
+        )
+        process.start()
+        servers[server_class] = (process, urls.get(timeout=60))
+
+    results = []
+    for transport in transports:
+        server_class = "H2StandInServer" if transport == "http2" else "StandInServer"
+        url = servers[server_class][1] + standin_server.LISTINGS_PATH
+        result = bench_transport(
+            transport, url, params, concurrency, max_connections=max_connections
+        )
+        results.append(result)
+        logging.info(json.dumps(result))
+    for process, _ in servers.values():
+        process.terminate()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the HTTP transports")
+    actions = parser.add_subparsers(dest="action", required=True)
+    action = actions.add_parser("bench", help="fetch pages from the local stand-ins")
+    action.add_argument("--pages", type=int, default=2000)
+    action.add_argument("--concurrency", type=int, default=32)
+    action.add_argument("--latency-ms", type=float, default=20.0)
+    action.add_argument("--max-connections", type=int, default=None)
+    action.add_argument("--transport", nargs="+", default=list(TRANSPORTS))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    results = bench(
+        args.pages,
+        args.concurrency,
+        args.latency_ms,
+        args.transport,
+        args.max_connections,
+    )
+    print(json.dumps(results, indent=2))
@@ -1,19 +1,202 @@
-import pandas as pd
-import traveltimepy as ttpy
+# TravelTime API calls. call_traveltime_api sends one arrival search through
+# traveltimepy. travel_time_matrix times many listings to many landmarks: each
+# POST to the time-filter endpoint packs up to MAX_SEARCHES arrival searches,
+# one per landmark, over a chunk of departures within MAX_LOCATIONS, every
+# distinct departure coordinate is sent once, and the requests run on a few
+# threads under a rate limit:
+#
+#   times = travel_time_matrix(listing_coords, landmark_coords, rate=5)
+#   times.shape  # (landmarks, listings), seconds, NaN when unreachable
+#
+# TRAVELTIME_URL points it at another endpoint, such as the mock of
+# standin_server.py:
+#
+#   python standin_server.py --port 8042 &
+#   TRAVELTIME_URL=http://127.0.0.1:8042/v4/time-filter python data_manipulator.py
+#
+# Credentials come from TRAVELTIME_ID and TRAVELTIME_KEY, or a .env file.
+
+import concurrent.futures
+import contextlib
+import logging
 import os
-from dotenv import load_dotenv
-load_dotenv()
+
+import numpy as np
+
+TIME_FILTER_URL = os.environ.get(
+    "TRAVELTIME_URL", "https://api.traveltimeapp.com/v4/time-filter"
+)
+MAX_LOCATIONS = 2000  # locations per request, departures and arrivals together
+MAX_SEARCHES = 10  # arrival searches per request
+ARRIVAL_SEARCH = {
+    "transportation": {"type": "public_transport"},
+    "arrival_time": "2022-04-13T07:00:00.000Z",
+    "travel_time": 7200,
+    "properties": ["travel_time"],
+}
+ARRIVAL_PREFIX = "arrival"
+
 
 def call_traveltime_api(_locations):
-    _departures = [location for location in _locations if location["id"] != 'arrival']
-    _arrival = [location for location in _locations if location["id"] == 'arrival']
+    import traveltimepy as ttpy
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    _departures = [location for location in _locations if location["id"] != "arrival"]
+    _arrival = [location for location in _locations if location["id"] == "arrival"]
     arrival_search = {
         "id": "backward search example",
         "departure_location_ids": [departure["id"] for departure in _departures],
         "arrival_location_id": _arrival[0]["id"],
-        "transportation": {"type": "public_transport"},
-        "arrival_time": '2022-04-13T07:00:00.000Z',
-        "travel_time": 7200,
-        "properties": ["travel_time"]
+        **ARRIVAL_SEARCH,
     }
     return ttpy.time_filter(locations=_locations, arrival_searches=arrival_search)
+
+
+def api_headers() -> dict:
+    """Authentication headers of the TravelTime API."""
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        pass  # the environment has to hold them
+    else:
+        load_dotenv()
+    return {
+        "X-Application-Id": os.environ.get("TRAVELTIME_ID", ""),
+        "X-Api-Key": os.environ.get("TRAVELTIME_KEY", ""),
+    }
+
+
+def plan_requests(departures: int, arrivals: int) -> list:
+    """
+    Split departures x arrivals into requests within the API limits.
+
+    Returns:
+        list: (departure start, departure stop, arrival start, arrival stop)
+            of every request.
+    """
+    plan = []
+    for arrival_start in range(0, arrivals, MAX_SEARCHES):
+        arrival_stop = min(arrival_start + MAX_SEARCHES, arrivals)
+        size = MAX_LOCATIONS - (arrival_stop - arrival_start)
+        # evenly sized chunks, so no request is left with a few departures
+        bounds = np.linspace(0, departures, -(-departures // size) + 1).astype(int)
+        plan.extend(
+            (int(start), int(stop), arrival_start, arrival_stop)
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        )
+    return plan
+
+
+def request_body(
+    departures: np.ndarray,
+    arrivals: np.ndarray,
+    request: tuple,
+    search: dict = ARRIVAL_SEARCH,
+) -> dict:
+    """time-filter request of one entry of plan_requests."""
+    departure_start, departure_stop, arrival_start, arrival_stop = request
+    departure_ids = [str(i) for i in range(departure_start, departure_stop)]
+    arrival_ids = [f"{ARRIVAL_PREFIX}{j}" for j in range(arrival_start, arrival_stop)]
+    locations = [
+        {"id": location_id, "coords": {"lat": lat, "lng": lng}}
+        for location_id, (lat, lng) in zip(
+            departure_ids + arrival_ids,
+            np.concatenate(
+                [
+                    departures[departure_start:departure_stop],
+                    arrivals[arrival_start:arrival_stop],
+                ]
+            ).tolist(),
+        )
+    ]
+    return {
+        "locations": locations,
+        "arrival_searches": [
+            {
+                "id": arrival_id,
+                "departure_location_ids": departure_ids,
+                "arrival_location_id": arrival_id,
+                **search,
+            }
+            for arrival_id in arrival_ids
+        ],
+    }
+
+
+def response_times(data: dict) -> tuple:
+    """(arrival, departure, seconds) arrays of a time-filter response."""
+    arrivals, departures, times = [], [], []
+    for result in data["results"]:
+        arrival = int(result["search_id"][len(ARRIVAL_PREFIX) :])
+        for location in result["locations"]:
+            arrivals.append(arrival)
+            departures.append(int(location["id"]))
+            times.append(location["properties"][0]["travel_time"])
+    return (
+        np.array(arrivals, np.int64),
+        np.array(departures, np.int64),
+        np.array(times, np.float64),
+    )
+
+
+def travel_time_matrix(
+    departures: np.ndarray,
+    arrivals: np.ndarray,
+    url: str = None,
+    workers: int = 4,
+    rate: float = None,
+    search: dict = ARRIVAL_SEARCH,
+    session=None,
+) -> np.ndarray:
+    """
+    Travel times from every departure to every arrival.
+
+    Args:
+        departures (np.ndarray): (latitude, longitude) rows, e.g. listings.
+        arrivals (np.ndarray): (latitude, longitude) rows, e.g. landmarks.
+        url (str): time-filter endpoint, TIME_FILTER_URL if None.
+        workers (int): Requests in flight at once.
+        rate (float): Maximum requests per second, None for no limit.
+        search (dict): Transportation, arrival time, maximum travel time and
+            properties of every arrival search.
+        session (requests.Session): Session to post with, a CrawlSession for
+            the workers and rate if None.
+
+    Returns:
+        np.ndarray: Seconds, one row per arrival and one column per
+            departure, NaN where the API found no route.
+    """
+    import data_downloader
+
+    departures = np.asarray(departures, np.float64).reshape(-1, 2)
+    arrivals = np.asarray(arrivals, np.float64).reshape(-1, 2)
+    unique, inverse = np.unique(departures, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    plan = plan_requests(len(unique), len(arrivals))
+    logging.info(
+        f"Timing {len(unique)} distinct departures ({len(departures)} listings) "
+        f"to {len(arrivals)} arrivals in {len(plan)} requests"
+    )
+    headers = api_headers()
+
+    def post(request: tuple) -> tuple:
+        response = session.post(
+            url or TIME_FILTER_URL,
+            json=request_body(unique, arrivals, request, search),
+            headers=headers,
+        )
+        response.raise_for_status()
+        return response_times(response.json())
+
+    # a session made here is closed here; the caller's is left open
+    with contextlib.ExitStack() as stack:
+        if session is None:
+            session = stack.enter_context(data_downloader.CrawlSession(workers, rate))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(post, plan))
+    times = np.full((len(arrivals), len(unique)), np.nan)
+    if results:
+        arrival, departure, seconds = (np.concatenate(parts) for parts in zip(*results))
+        times[arrival, departure] = seconds
+    return times[:, inverse]
@@ -0,0 +1,333 @@
+# Comparable-based valuation. A property is valued from the price_per_sqm of
+# the k most similar listings nearby (same or neighbouring macrozone, closest
+# surface, rooms and floor). The comparables table and the spatial index are
+# precomputed once into a compact .npz model and loaded lazily on first use.
+# Neighbouring macrozones are found from the cached centroids of hierarchy.py
+# where there are some, and from the mean of the listings otherwise.
+
+import argparse
+import logging
+import pathlib
+import time
+
+import numpy as np
+import pandas as pd
+
+import data_processor
+import hierarchy
+import warehouse
+from spatial_index import SpatialIndex
+
+MODEL_PATH = pathlib.Path("./listings/valuation_model.npz")
+
+K_COMPARABLES = 10
+CANDIDATE_FACTOR = 5  # spatial candidates screened per comparable kept
+NEIGHBOUR_MACROZONES = 6  # nearest macrozone centroids treated as neighbours
+
+# Scales of the comparable distance: one unit is ~500 m, a 25% surface
+# difference, one room or three floors.
+GEO_SCALE_M = 500.0
+LOG_SURFACE_SCALE = 0.25
+ROOMS_SCALE = 1.0
+FLOOR_SCALE = 3.0
+
+
+def log_surface(surface: pd.Series) -> np.ndarray:
+    """log of the surfaces, NaN (a missing surface) where it is not positive."""
+    surface = surface.to_numpy(np.float64)
+    return np.log(np.where(surface > 0, surface, np.nan))
+
+
+def macrozone_centroids(
+    listings: pd.DataFrame, macrozone_codes: np.ndarray, tree: hierarchy.Hierarchy
+) -> pd.DataFrame:
+    """
+    (latitude, longitude) of each macrozone code: the cached centroid of the
+    macrozone when the hierarchy has one, the mean of its listings otherwise.
+    """
+    centroids = (
+        listings.groupby(macrozone_codes)[["latitude", "longitude"]].mean().sort_index()
+    )
+    if tree is None:
+        return centroids
+    first = listings.groupby(macrozone_codes)[["city", "macrozone"]].first()
+    for code, (city, macrozone) in first.sort_index().iterrows():
+        try:
+            city_id = tree.find("city", city)
+            centroid = tree.centroid(
+                "macrozone", tree.find("macrozone", macrozone, parent=city_id)
+            )
+        except KeyError:
+            continue
+        if centroid is not None:
+            centroids.loc[code] = centroid
+    return centroids
+
+
+def build_model(
+    listings: pd.DataFrame,
+    path: pathlib.Path = MODEL_PATH,
+    tree: hierarchy.Hierarchy = None,
+) -> pathlib.Path:
+    """
+    Precompute the comparables table used by ValuationEngine.
+
+    Args:
+        listings (pd.DataFrame): Parsed listings with coordinates.
+        path (pathlib.Path): Destination of the .npz model.
+        tree (hierarchy.Hierarchy): Hierarchy with cached macrozone
+            centroids, e.g. hierarchy.load(); None to use the listings' means.
+
+    Returns:
+        pathlib.Path: The path of the saved model.
+    """
+    listings = listings.dropna(
+        subset=["latitude", "longitude", "price_per_sqm", "surface"]
+    )
+    listings = listings[(listings["surface"] > 0) & (listings["price_per_sqm"] > 0)]
+    listings = listings.reset_index(drop=True)
+
+    macrozone_keys = (
+        listings["city"].fillna("").astype(str)
+        + "|"
+        + listings["macrozone"].fillna("").astype(str)
+    )
+    macrozone_codes, macrozones = pd.factorize(macrozone_keys)
+
+    centroids = macrozone_centroids(listings, macrozone_codes, tree)
+    centroid_index = SpatialIndex(centroids)
+    _, nearest = centroid_index.query_knn(
+        centroids["latitude"],
+        centroids["longitude"],
+        min(NEIGHBOUR_MACROZONES + 1, len(centroids)),
+    )
+    neighbours = np.zeros((len(macrozones), len(macrozones)), dtype=bool)
+    rows = np.repeat(np.arange(len(macrozones)), nearest.shape[1])
+    neighbours[rows, nearest.ravel()] = True
+    neighbours |= neighbours.T
+
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(
+        path,
+        latitude=listings["latitude"].to_numpy(np.float64),
+        longitude=listings["longitude"].to_numpy(np.float64),
+        price_per_sqm=listings["price_per_sqm"].to_numpy(np.float64),
+        log_surface=log_surface(listings["surface"]),
+        rooms=listings["rooms"].to_numpy(np.float64),
+        floor=data_processor.floor_levels(listings["floor"]).to_numpy(np.float64),
+        macrozone=macrozone_codes.astype(np.int32),
+        macrozones=np.asarray(macrozones, dtype=str),
+        neighbours=neighbours,
+    )
+    logging.info(f"Saved valuation model with {len(listings)} comparables to {path}")
+    return path
+
+
+class ValuationEngine:
+    """
+    Batched price_per_sqm estimator over a precomputed comparables model.
+
+    The model file is only read, and the spatial index only built, the first
+    time an estimate is requested.
+    """
+
+    def __init__(self, model_path: pathlib.Path = MODEL_PATH, k: int = K_COMPARABLES):
+        self.model_path = pathlib.Path(model_path)
+        self.k = k
+        self._model = None
+        self._index = None
+
+    def _load(self) -> None:
+        with np.load(self.model_path) as data:
+            self._model = {key: data[key] for key in data.files}
+        self._macrozone_codes = {
+            name: code for code, name in enumerate(self._model["macrozones"])
+        }
+        self._index = SpatialIndex(
+            pd.DataFrame(
+                {
+                    "latitude": self._model["latitude"],
+                    "longitude": self._model["longitude"],
+                }
+            )
+        )
+
+    @property
+    def model(self) -> dict:
+        if self._model is None:
+            self._load()
+        return self._model
+
+    def estimate(
+        self, properties: pd.DataFrame, batch_size: int = 50_000
+    ) -> np.ndarray:
+        """
+        Estimate price_per_sqm for a batch of properties.
+
+        Args:
+            properties (pd.DataFrame): latitude, longitude, surface, rooms and
+                floor columns; optional city and macrozone restrict the
+                comparables to that macrozone and its neighbours. A surface
+                that is missing or not positive counts as unknown: its log is
+                NaN and the surface term of the distance takes its missing
+                value penalty, like missing rooms or floor.
+            batch_size (int): Properties valued per vectorized pass.
+
+        Returns:
+            np.ndarray: The estimates, NaN where no comparable was found.
+        """
+        if self._model is None:
+            self._load()
+        properties = properties.reset_index(drop=True)
+        floors = properties["floor"]
+        if not pd.api.types.is_numeric_dtype(floors):
+            floors = data_processor.floor_levels(floors)
+
+        if "macrozone" in properties:
+            keys = (
+                properties.get("city", pd.Series("", index=properties.index))
+                .fillna("")
+                .astype(str)
+                + "|"
+                + properties["macrozone"].fillna("").astype(str)
+            )
+            macrozones = keys.map(self._macrozone_codes).fillna(-1).to_numpy(np.int64)
+        else:
+            macrozones = np.full(len(properties), -1, dtype=np.int64)
+
+        features = np.column_stack(
+            (
+                properties["latitude"].to_numpy(np.float64),
+                properties["longitude"].to_numpy(np.float64),
+                log_surface(properties["surface"]),
+                properties["rooms"].to_numpy(np.float64),
+                floors.to_numpy(np.float64),
+            )
+        )
+        estimates = np.empty(len(properties), dtype=np.float64)
+        for start in range(0, len(properties), batch_size):
+            stop = start + batch_size
+            estimates[start:stop] = self._estimate_batch(
+                features[start:stop], macrozones[start:stop]
+            )
+        return estimates
+
+    def _estimate_batch(
+        self, features: np.ndarray, macrozones: np.ndarray
+    ) -> np.ndarray:
+        model = self._model
+        n_candidates = min(self.k * CANDIDATE_FACTOR, len(self._index))
+        geo_m, candidates = self._index.query_knn(
+            features[:, 0], features[:, 1], n_candidates
+        )
+        candidates = np.minimum(candidates, len(self._index) - 1)
+
+        # properties with no known macrozone take the one of their closest listing
+        candidate_zones = model["macrozone"][candidates]
+        macrozones = np.where(macrozones >= 0, macrozones, candidate_zones[:, 0])
+        allowed = model["neighbours"][macrozones[:, None], candidate_zones]
+
+        distance = (
+            (geo_m / GEO_SCALE_M) ** 2
+            + np.nan_to_num(
+                (model["log_surface"][candidates] - features[:, [2]])
+                / LOG_SURFACE_SCALE,
+                nan=2.0,
+            )
+            ** 2
+            + np.nan_to_num(
+                (model["rooms"][candidates] - features[:, [3]]) / ROOMS_SCALE, nan=1.0
+            )
+            ** 2
+            + np.nan_to_num(
+                (model["floor"][candidates] - features[:, [4]]) / FLOOR_SCALE, nan=1.0
+            )
+            ** 2
+        )
+        distance = np.where(allowed & np.isfinite(geo_m), distance, np.inf)
+
+        k = min(self.k, n_candidates)
+        nearest = np.argpartition(distance, k - 1, axis=1)[:, :k]
+        distance = np.take_along_axis(distance, nearest, axis=1)
+        values = model["price_per_sqm"][np.take_along_axis(candidates, nearest, axis=1)]
+        weights = np.where(np.isfinite(distance), 1 / (1 + distance), 0.0)
+        return weighted_median(values, weights)
+
+
+def weighted_median(values: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Row-wise weighted median, NaN for rows without any weight."""
+    order = np.argsort(values, axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+    cumulative = np.cumsum(np.take_along_axis(weights, order, axis=1), axis=1)
+    total = cumulative[:, -1]
+    position = (cumulative < (total / 2)[:, None]).sum(axis=1)
+    position = np.minimum(position, values.shape[1] - 1)
+    medians = values[np.arange(len(values)), position]
+    return np.where(total > 0, medians, np.nan)
+
+
+def benchmark(
+    engine: ValuationEngine,
+    properties: pd.DataFrame,
+    batch_size: int = 10_000,
+    repeats: int = 5,
+) -> dict:
+    """
+    Time batched estimates and report latency percentiles and throughput.
+
+    Args:
+        engine (ValuationEngine): The engine to benchmark.
+        properties (pd.DataFrame): Properties to value.
+        batch_size (int): Properties per estimate call.
+        repeats (int): Passes over the properties.
+
+    Returns:
+        dict: Cold load time, per-batch latency percentiles (ms) and
+            properties valued per second.
+    """
+    start = time.perf_counter()
+    engine.estimate(properties.iloc[:1])
+    cold_start = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(repeats):
+        for start in range(0, len(properties), batch_size):
+            batch = properties.iloc[start : start + batch_size]
+            tic = time.perf_counter()
+            engine.estimate(batch, batch_size=batch_size)
+            latencies.append(time.perf_counter() - tic)
+
+    latencies = np.asarray(latencies)
+    return {
+        "properties": len(properties),
+        "batch_size": batch_size,
+        "cold_start_s": round(cold_start, 4),
+        "latency_ms_p50": round(float(np.percentile(latencies, 50)) * 1000, 3),
+        "latency_ms_p90": round(float(np.percentile(latencies, 90)) * 1000, 3),
+        "latency_ms_p99": round(float(np.percentile(latencies, 99)) * 1000, 3),
+        "properties_per_s": round(len(properties) * repeats / latencies.sum()),
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Comparable-based valuation")
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("--snapshot", type=pathlib.Path, default=None)
+    parser.add_argument("--contract", default="sale", choices=["sale", "rent"])
+    parser.add_argument("--model", type=pathlib.Path, default=MODEL_PATH)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    args = parser.parse_args()
+
+    snapshot = args.snapshot or warehouse.list_snapshots()[-1]
+    listings = warehouse.read_snapshot(snapshot)
+    listings = listings[listings["contract"] == args.contract]
+    if args.command == "build":
+        tree = hierarchy.load() if hierarchy.INDEX_TABLE.exists() else None
+        build_model(listings, args.model, tree)
+    else:
+        listings = listings.dropna(
+            subset=["latitude", "longitude", "surface", "rooms", "floor"]
+        )
+        print(benchmark(ValuationEngine(args.model), listings, args.batch_size))
@@ -0,0 +1,454 @@
+# Embedded listing warehouse. Every daily snapshot under ./listings/<yymmdd>/csv/
+# is loaded into a single SQLite database keyed by (listing id, snapshot date),
+# so that questions spanning several days can be answered with SQL instead of
+# re-parsing the archived JSON pages. City tables are partitioned by contract
+# (csv/sale/, csv/rent/, csv/auction/); tables directly under csv/ predate the
+# partitioning and hold sales.
+
+import math
+import pathlib
+import sqlite3
+import datetime
+import logging
+
+import pandas as pd
+import tqdm
+
+LISTINGS_ROOT = pathlib.Path("./listings/")
+WAREHOUSE_PATH = LISTINGS_ROOT / "warehouse.sqlite"
+
+LISTING_COLUMNS = [
+    "id",
+    "city",
+    "macrozone",
+    "neighbourhood",
+    "latitude",
+    "longitude",
+    "price",
+    "price_per_sqm",
+    "surface",
+    "rooms",
+    "floor",
+    "type",
+]
+
+SUMMARY_METRICS = ["price", "price_per_sqm", "surface"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    id INTEGER NOT NULL,
+    snapshot_date TEXT NOT NULL,
+    contract TEXT NOT NULL DEFAULT 'sale',
+    region_id TEXT,
+    province_id TEXT,
+    city TEXT,
+    macrozone TEXT,
+    neighbourhood TEXT,
+    latitude REAL,
+    longitude REAL,
+    price REAL,
+    price_per_sqm REAL,
+    surface REAL,
+    rooms REAL,
+    floor TEXT,
+    type TEXT,
+    PRIMARY KEY (id, snapshot_date)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_listings_city ON listings (city, snapshot_date);
+CREATE INDEX IF NOT EXISTS idx_listings_macrozone
+    ON listings (city, macrozone, snapshot_date);
+CREATE INDEX IF NOT EXISTS idx_listings_neighbourhood
+    ON listings (neighbourhood, snapshot_date);
+CREATE INDEX IF NOT EXISTS idx_listings_snapshot ON listings (snapshot_date);
+
+CREATE TABLE IF NOT EXISTS snapshots (
+    snapshot_date TEXT PRIMARY KEY,
+    ingested_at TEXT NOT NULL,
+    listings INTEGER NOT NULL
+);
+"""
+
+# warehouses created before the contract partitioning only held sales, and
+# those created before coordinates were parsed have no latitude/longitude
+MIGRATIONS = {
+    "contract": "ALTER TABLE listings ADD COLUMN contract TEXT NOT NULL DEFAULT 'sale'",
+    "latitude": "ALTER TABLE listings ADD COLUMN latitude REAL",
+    "longitude": "ALTER TABLE listings ADD COLUMN longitude REAL",
+}
+CONTRACT_INDEX = (
+    "CREATE INDEX IF NOT EXISTS idx_listings_contract "
+    "ON listings (contract, snapshot_date)"
+)
+
+
+def connect(db_path: pathlib.Path = WAREHOUSE_PATH) -> sqlite3.Connection:
+    """
+    Open the warehouse database, creating the schema if needed.
+
+    Args:
+        db_path (pathlib.Path): Location of the SQLite file.
+
+    Returns:
+        sqlite3.Connection: An open connection to the warehouse.
+    """
+    db_path = pathlib.Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    # std is computed from sums of squares; not every SQLite build ships SQRT
+    conn.create_function("sqrt", 1, lambda x: math.sqrt(x) if x is not None else None)
+    conn.executescript(SCHEMA)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(listings)")}
+    for column, statement in MIGRATIONS.items():
+        if column not in columns:
+            conn.execute(statement)
+    conn.execute(CONTRACT_INDEX)
+    return conn
+
+
+def snapshot_date(snapshot_dir: pathlib.Path) -> str:
+    """Turn a ./listings/<yymmdd>/ directory name into an ISO date."""
+    return (
+        datetime.datetime.strptime(pathlib.Path(snapshot_dir).name, "%y%m%d")
+        .date()
+        .isoformat()
+    )
+
+
+def list_snapshots(root: pathlib.Path = LISTINGS_ROOT) -> list:
+    """Return the dated snapshot directories under root, oldest first."""
+    snapshots = []
+    for path in pathlib.Path(root).iterdir():
+        if path.is_dir() and path.name.isdigit() and len(path.name) == 6:
+            snapshots.append(path)
+    return sorted(snapshots)
+
+
+def read_snapshot(snapshot_dir: pathlib.Path) -> pd.DataFrame:
+    """
+    Load every city table of a snapshot into a single DataFrame.
+
+    City tables are named after the region and province ids they were compiled
+    from (e.g. csv/rent/lom_MI.csv), which are kept as columns together with
+    the contract partition.
+    """
+    csv_path = pathlib.Path(snapshot_dir) / "csv"
+    csv_files = [(csv_file, "sale") for csv_file in csv_path.glob("*.csv")]
+    csv_files += [
+        (csv_file, csv_file.parent.name) for csv_file in csv_path.glob("*/*.csv")
+    ]
+    dfs = []
+    for csv_file, contract in sorted(csv_files):
+        df = pd.read_csv(csv_file, usecols=lambda column: column in LISTING_COLUMNS)
+        # tables compiled before coordinates were parsed lack latitude/longitude
+        df = df.reindex(columns=LISTING_COLUMNS)
+        region_id, _, province_id = csv_file.stem.partition("_")
+        df["contract"] = contract
+        df["region_id"] = region_id
+        df["province_id"] = province_id
+        dfs.append(df)
+    if not dfs:
+        return pd.DataFrame(
+            columns=LISTING_COLUMNS + ["contract", "region_id", "province_id"]
+        )
+    df = pd.concat(dfs, ignore_index=True)
+    df = df.dropna(subset=["id"]).drop_duplicates("id")
+    df["id"] = df["id"].astype("int64")
+    df["floor"] = df["floor"].astype("string")
+    return df
+
+
+def ingest_snapshot(
+    conn: sqlite3.Connection, snapshot_dir: pathlib.Path, replace: bool = False
+) -> int:
+    """
+    Load one dated snapshot into the warehouse.
+
+    Args:
+        conn (sqlite3.Connection): An open warehouse connection.
+        snapshot_dir (pathlib.Path): A ./listings/<yymmdd>/ directory.
+        replace (bool): Re-ingest the snapshot even if it was already loaded.
+
+    Returns:
+        int: The number of listings written.
+    """
+    date = snapshot_date(snapshot_dir)
+    already_loaded = conn.execute(
+        "SELECT 1 FROM snapshots WHERE snapshot_date = ?", (date,)
+    ).fetchone()
+    if already_loaded and not replace:
+        logging.info(f"Snapshot {date} already in warehouse, skipping")
+        return 0
+
+    df = read_snapshot(snapshot_dir)
+    columns = ["id", "contract", "region_id", "province_id"] + LISTING_COLUMNS[1:]
+    values = df[columns].astype(object).where(df[columns].notna(), None)
+    rows = ((row[0], date, *row[1:]) for row in values.itertuples(index=False))
+
+    with conn:
+        conn.execute("DELETE FROM listings WHERE snapshot_date = ?", (date,))
+        conn.executemany(
+            "INSERT OR REPLACE INTO listings "
+            f"(id, snapshot_date, {', '.join(columns[1:])}) "
+            f"VALUES (?, ?, {', '.join('?' for _ in columns[1:])})",
+            rows,
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)",
+            (date, datetime.datetime.now().isoformat(timespec="seconds"), len(df)),
+        )
+    return len(df)
+
+
+def ingest_all(conn: sqlite3.Connection, root: pathlib.Path = LISTINGS_ROOT) -> int:
+    """Ingest every snapshot under root that is not in the warehouse yet."""
+    total = 0
+    for snapshot_dir in tqdm.tqdm(list_snapshots(root), desc="Loading snapshots"):
+        total += ingest_snapshot(conn, snapshot_dir)
+    return total
+
+
+def latest_snapshot(conn: sqlite3.Connection) -> str:
+    return conn.execute("SELECT MAX(snapshot_date) FROM snapshots").fetchone()[0]
+
+
+def price_history(conn: sqlite3.Connection, listing_id: int) -> pd.DataFrame:
+    """Return every recorded price of a listing, one row per snapshot."""
+    return pd.read_sql_query(
+        "SELECT snapshot_date, price, price_per_sqm, surface "
+        "FROM listings WHERE id = ? ORDER BY snapshot_date",
+        conn,
+        params=(int(listing_id),),
+    )
+
+
+def time_on_market(
+    conn: sqlite3.Connection, city: str = None, macrozone: str = None
+) -> pd.DataFrame:
+    """
+    Compute first/last sighting and days on market for each listing.
+
+    A listing still present in the latest snapshot is flagged as active.
+    """
+    where, params = _location_filter(city=city, macrozone=macrozone)
+    return pd.read_sql_query(
+        f"""
+        SELECT id,
+               MAX(city) AS city,
+               MAX(macrozone) AS macrozone,
+               MIN(snapshot_date) AS first_seen,
+               MAX(snapshot_date) AS last_seen,
+               CAST(
+                   julianday(MAX(snapshot_date)) - julianday(MIN(snapshot_date))
+                   AS INTEGER
+               ) AS days_on_market,
+               COUNT(*) AS snapshots_seen,
+               MAX(snapshot_date) = (SELECT MAX(snapshot_date) FROM snapshots) AS active
+        FROM listings
+        {where}
+        GROUP BY id
+        """,
+        conn,
+        params=params,
+    )
+
+
+def macrozone_trends(
+    conn: sqlite3.Connection, city: str, macrozone: str = None, contract: str = "sale"
+) -> pd.DataFrame:
+    """Return listing counts and price_per_sqm statistics per macrozone and day."""
+    where, params = _location_filter(city=city, macrozone=macrozone, contract=contract)
+    where += " AND price_per_sqm IS NOT NULL"
+    trends = pd.read_sql_query(
+        f"""
+        SELECT snapshot_date, city, macrozone,
+               COUNT(*) AS listings,
+               AVG(price_per_sqm) AS price_per_sqm_mean,
+               MIN(price_per_sqm) AS price_per_sqm_min,
+               MAX(price_per_sqm) AS price_per_sqm_max
+        FROM listings
+        {where}
+        GROUP BY snapshot_date, city, macrozone
+        """,
+        conn,
+        params=params,
+    )
+    medians = _quantile(
+        conn,
+        "price_per_sqm",
+        0.5,
+        ["snapshot_date", "city", "macrozone"],
+        where,
+        params,
+    ).rename(columns={"value": "price_per_sqm_median"})
+    trends = trends.merge(
+        medians, on=["snapshot_date", "city", "macrozone"], how="left"
+    )
+    return trends.sort_values(["macrozone", "snapshot_date"]).reset_index(drop=True)
+
+
+def compile_macrozone_summary_table(
+    conn: sqlite3.Connection,
+    date: str = None,
+    save_path: pathlib.Path = None,
+    outlier_quantile: float = 0.99,
+    contract: str = "sale",
+) -> pd.DataFrame:
+    """
+    Rebuild the macrozone summary table of a snapshot with SQL aggregates.
+
+    The columns match data_processor.compile_macrozone_summary_table.
+
+    Args:
+        conn (sqlite3.Connection): An open warehouse connection.
+        date (str): ISO snapshot date, defaults to the latest snapshot.
+        save_path (pathlib.Path): Optional CSV destination.
+        outlier_quantile (float): Drop listings at or above this per-city
+            price_per_sqm quantile, None to keep every listing.
+        contract (str): Contract to summarise (sale, rent, auction).
+
+    Returns:
+        pd.DataFrame: The summary table.
+    """
+    date = date or latest_snapshot(conn)
+    group_by = ["city", "macrozone"]
+    where = (
+        "WHERE snapshot_date = ? AND contract = ? "
+        "AND price IS NOT NULL AND surface IS NOT NULL"
+    )
+    params = (date, contract)
+
+    if outlier_quantile is not None:
+        # same cutoff as outliers.filter_outliers(..., by="city", method="quantile")
+        cutoffs = _quantile(
+            conn, "price_per_sqm", outlier_quantile, ["city"], where, params
+        )
+        conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS outlier_cutoffs "
+            "(city TEXT PRIMARY KEY, value REAL)"
+        )
+        conn.execute("DELETE FROM outlier_cutoffs")
+        conn.executemany(
+            "INSERT INTO outlier_cutoffs VALUES (?, ?)",
+            cutoffs.itertuples(index=False, name=None),
+        )
+        where += (
+            " AND (price_per_sqm IS NULL OR price_per_sqm < "
+            "(SELECT value FROM outlier_cutoffs "
+            "WHERE outlier_cutoffs.city = listings.city))"
+        )
+
+    aggregates = ", ".join(
+        f"AVG({metric}) AS {metric}_mean, "
+        f"sqrt((SUM({metric} * {metric}) "
+        f"- SUM({metric}) * SUM({metric}) / COUNT({metric})) "
+        f"/ NULLIF(COUNT({metric}) - 1, 0)) AS {metric}_std, "
+        f"MIN({metric}) AS {metric}_min, MAX({metric}) AS {metric}_max"
+        for metric in SUMMARY_METRICS
+    )
+    summary = pd.read_sql_query(
+        f"SELECT city, macrozone, {aggregates} FROM listings {where} "
+        "GROUP BY city, macrozone",
+        conn,
+        params=params,
+    )
+    for metric in SUMMARY_METRICS:
+        for name, q in (("median", 0.5), ("q90", 0.9)):
+            quantiles = _quantile(conn, metric, q, group_by, where, params)
+            summary = summary.merge(
+                quantiles.rename(columns={"value": f"{metric}_{name}"}),
+                on=group_by,
+                how="left",
+            )
+        summary[f"{metric}_q50"] = summary[f"{metric}_median"]
+
+    summary = summary.rename(
+        columns={"city": "city_name", "macrozone": "macrozone_name"}
+    )
+    summary = summary[
+        ["city_name", "macrozone_name"]
+        + [
+            f"{metric}_{stat}"
+            for metric in SUMMARY_METRICS
+            for stat in ("mean", "median", "std", "min", "max", "q50", "q90")
+        ]
+    ].round(2)
+
+    if save_path is not None:
+        save_path = pathlib.Path(save_path)
+        save_path.parent.mkdir(parents=True, exist_ok=True)
+        summary.to_csv(save_path, index=False)
+
+    return summary
+
+
+def _location_filter(**filters) -> tuple:
+    clauses, params = [], []
+    for column, value in filters.items():
+        if value is not None:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    where = "WHERE " + " AND ".join(clauses) if clauses else "WHERE 1 = 1"
+    return where, tuple(params)
+
+
+def _quantile(
+    conn: sqlite3.Connection,
+    column: str,
+    q: float,
+    group_by: list,
+    where: str,
+    params: tuple,
+) -> pd.DataFrame:
+    # Linear interpolation between the two closest ranks, like pandas' quantile
+    groups = ", ".join(group_by)
+    return pd.read_sql_query(
+        f"""
+        SELECT {groups},
+               SUM(CASE WHEN rn = lo THEN value * (1 - frac)
+                        WHEN rn = lo + 1 THEN value * frac
+                        ELSE 0 END) AS value
+        FROM (
+            SELECT {groups}, value, rn,
+                   CAST(pos AS INTEGER) AS lo,
+                   pos - CAST(pos AS INTEGER) AS frac
+            FROM (
+                SELECT {groups}, {column} AS value,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY {groups} ORDER BY {column}
+                       ) - 1 AS rn,
+                       (COUNT(*) OVER (PARTITION BY {groups}) - 1) * {q} AS pos
+                FROM listings
+                {where} AND {column} IS NOT NULL
+            )
+        )
+        GROUP BY {groups}
+        """,
+        conn,
+        params=params,
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    conn = connect()
+    logging.info(f"Loaded {ingest_all(conn)} listings")
+    date = latest_snapshot(conn)
+    if date:
+        contracts = conn.execute(
+            "SELECT DISTINCT contract FROM listings WHERE snapshot_date = ?", (date,)
+        ).fetchall()
+        for (contract,) in contracts:
+            compile_macrozone_summary_table(
+                conn,
+                date,
+                LISTINGS_ROOT
+                / datetime.date.fromisoformat(date).strftime("%y%m%d")
+                / "out"
+                / contract
+                / "summary_table_sql.csv",
+                contract=contract,
+            )
+    conn.close()
@@ -0,0 +1,635 @@
+# Shared queue of page downloads, so a crawl can be spread over several
+# worker processes or machines. The pages listed by build_indexes are
+# published once; workers claim batches of them under a time-limited lease,
+# renew the lease while they download, and mark them done. Tasks whose lease
+# expires (a worker died or hung) go back to the queue, and tasks that keep
+# failing are parked after MAX_ATTEMPTS.
+#
+# Backends:
+#   ./listings/<yymmdd>/queue.sqlite
+#                              SQLite file, for the workers of a single host
+#   http://host:8765           the same queue served over HTTP to other hosts
+#                              by `python work_queue.py serve`
+# More can be added with register_backend().
+#
+# Every worker writes to its own shard of the snapshot,
+# ./listings/<yymmdd>/shards/<worker>/json/<contract>/, so workers never
+# write the same directory, and merge_shards() moves the pages into the
+# snapshot once the queue is drained. Each snapshot has its own queue, and task
+# ids carry the snapshot date, so a queue served for several days keeps the
+# pages of each day apart:
+#
+#   python cercocase.py publish --contract sale rent   # probe and publish
+#   python cercocase.py work --threads 8               # on every worker
+#   python cercocase.py merge
+#
+#   python work_queue.py demo --processes 1 2 4        # scaling on the stand-in
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import instrumentation
+
+LISTINGS_ROOT = pathlib.Path("./listings/")
+QUEUE_FILE = "queue.sqlite"
+SHARDS_DIR = "shards"
+
+LEASE_S = 60.0
+MAX_ATTEMPTS = 3
+POLL_INTERVAL_S = 0.5
+QUEUE_PORT = 8765
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_state ON tasks (state, lease_expires);
+"""
+
+STATES = ("pending", "leased", "done", "failed")
+
+
+def task_id(index: dict, date: str) -> str:
+    """
+    Id of a page task: the snapshot date and the page's path in the snapshot,
+    e.g. 261019/sale/lom_MI_8042_...
+    """
+    import data_downloader
+
+    return f"{date}/{data_downloader.page_path(index, pathlib.Path()).as_posix()}"
+
+
+def queue_path(root: pathlib.Path = LISTINGS_ROOT, date: str = None) -> pathlib.Path:
+    """The SQLite queue of a snapshot, today's when no date is given."""
+    date = date or time.strftime("%y%m%d")
+    return pathlib.Path(root) / date / QUEUE_FILE
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class SQLiteQueue:
+    """
+    Lease-based task queue in a SQLite file.
+
+    SQLite's own file locking serializes the claims of every process on the
+    host, and each claim is a single IMMEDIATE transaction, so a task is
+    never leased to two workers at once.
+
+    Args:
+        path (pathlib.Path): The queue database.
+        max_attempts (int): Claims after which a failing task is parked.
+    """
+
+    def __init__(self, path: pathlib.Path = None, max_attempts: int = MAX_ATTEMPTS):
+        self.path = pathlib.Path(path or queue_path())
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def _transaction(self, func, *args):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return result
+
+    def publish(self, tasks: list) -> int:
+        """
+        Add tasks that are not queued yet.
+
+        Args:
+            tasks (list): (id, payload dict) pairs.
+
+        Returns:
+            int: The number of tasks added.
+        """
+
+        def insert():
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO tasks (id, payload) VALUES (?, ?)",
+                ((id, json.dumps(payload, default=int)) for id, payload in tasks),
+            )
+            return self.conn.total_changes - before
+
+        return self._transaction(insert)
+
+    def claim(self, worker: str, limit: int, lease_s: float = LEASE_S) -> list:
+        """
+        Lease up to limit tasks, pending ones or ones whose lease expired.
+
+        Returns:
+            list: (id, payload dict) pairs.
+        """
+
+        def lease():
+            now = time.time()
+            # a task whose worker died max_attempts times is parked, not retried
+            self.conn.execute(
+                "UPDATE tasks SET state = 'failed', error = 'lease expired' "
+                "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            rows = self.conn.execute(
+                "SELECT id, payload FROM tasks WHERE state = 'pending' "
+                "OR (state = 'leased' AND lease_expires < ?) ORDER BY rowid LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE tasks SET state = 'leased', worker = ?, lease_expires = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                ((worker, now + lease_s, id) for id, _ in rows),
+            )
+            return rows
+
+        rows = self._transaction(lease)
+        return [(id, json.loads(payload)) for id, payload in rows]
+
+    def heartbeat(self, worker: str, ids: list, lease_s: float = LEASE_S) -> int:
+        """Extend the leases a worker still holds, returning how many."""
+
+        def extend():
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "UPDATE tasks SET lease_expires = ? "
+                "WHERE id = ? AND worker = ? AND state = 'leased'",
+                ((time.time() + lease_s, id, worker) for id in ids),
+            )
+            return self.conn.total_changes - before
+
+        return self._transaction(extend)
+
+    def complete(self, worker: str, ids: list) -> None:
+        # a task whose lease expired and was claimed again is left to its new
+        # worker, which will write the same page
+        self._transaction(
+            self.conn.executemany,
+            "UPDATE tasks SET state = 'done', lease_expires = NULL "
+            "WHERE id = ? AND worker = ? AND state = 'leased'",
+            ((id, worker) for id in ids),
+        )
+
+    def fail(self, worker: str, id: str, error: str) -> None:
+        """Give a task back, or park it once it has used MAX_ATTEMPTS claims."""
+        self._transaction(
+            self.conn.execute,
+            "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' "
+            "ELSE 'pending' END, lease_expires = NULL, error = ? "
+            "WHERE id = ? AND worker = ? AND state = 'leased'",
+            (self.max_attempts, error, id, worker),
+        )
+
+    def requeue_expired(self) -> int:
+        """Put the tasks of expired leases back to pending, returning how many."""
+        return self._transaction(
+            lambda: self.conn.execute(
+                "UPDATE tasks SET state = 'pending', lease_expires = NULL "
+                "WHERE state = 'leased' AND lease_expires < ?",
+                (time.time(),),
+            ).rowcount
+        )
+
+    def stats(self) -> dict:
+        with self.lock:
+            counts = dict(
+                self.conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state")
+            )
+        return {state: counts.get(state, 0) for state in STATES}
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class HTTPQueue:
+    """Client of a queue served by QueueServer, with the SQLiteQueue methods."""
+
+    def __init__(self, url: str):
+        import requests
+
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+
+    def _call(self, method: str, **kwargs):
+        response = self.session.post(f"{self.url}/{method}", json=kwargs, timeout=60)
+        response.raise_for_status()
+        return response.json()
+
+    def publish(self, tasks: list) -> int:
+        return self._call("publish", tasks=[list(task) for task in tasks])
+
+    def claim(self, worker: str, limit: int, lease_s: float = LEASE_S) -> list:
+        rows = self._call("claim", worker=worker, limit=limit, lease_s=lease_s)
+        return [tuple(row) for row in rows]
+
+    def heartbeat(self, worker: str, ids: list, lease_s: float = LEASE_S) -> int:
+        return self._call("heartbeat", worker=worker, ids=ids, lease_s=lease_s)
+
+    def complete(self, worker: str, ids: list) -> None:
+        self._call("complete", worker=worker, ids=ids)
+
+    def fail(self, worker: str, id: str, error: str) -> None:
+        self._call("fail", worker=worker, id=id, error=error)
+
+    def requeue_expired(self) -> int:
+        return self._call("requeue_expired")
+
+    def stats(self) -> dict:
+        return self._call("stats")
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class QueueServer(ThreadingHTTPServer):
+    """Serves a SQLiteQueue to workers on other hosts, one POST per method."""
+
+    daemon_threads = True
+    methods = (
+        "publish",
+        "claim",
+        "heartbeat",
+        "complete",
+        "fail",
+        "requeue_expired",
+        "stats",
+    )
+
+    def __init__(self, queue: SQLiteQueue, address: tuple = ("0.0.0.0", QUEUE_PORT)):
+        super().__init__(address, QueueHandler)
+        self.queue = queue
+
+
+class QueueHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        method = self.path.strip("/")
+        length = int(self.headers.get("Content-Length", 0))
+        kwargs = json.loads(self.rfile.read(length) or b"{}")
+        if method not in self.server.methods:
+            return self._send(404, {"error": f"unknown method {method}"})
+        try:
+            result = getattr(self.server.queue, method)(**kwargs)
+        except (TypeError, ValueError, sqlite3.Error) as e:
+            return self._send(400, {"error": str(e)})
+        self._send(200, result)
+
+    def _send(self, status: int, result) -> None:
+        body = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+BACKENDS = {
+    "": SQLiteQueue,
+    "sqlite": SQLiteQueue,
+    "http": HTTPQueue,
+    "https": HTTPQueue,
+}
+
+
+def register_backend(scheme: str, factory) -> None:
+    """Make open_queue() build queues for URLs with this scheme."""
+    BACKENDS[scheme] = factory
+
+
+def open_queue(url) -> object:
+    """A queue from a file path, sqlite:///path, or http://host:port URL."""
+    url = str(url)
+    scheme = urllib.parse.urlsplit(url).scheme
+    # a Windows drive letter is not a scheme
+    scheme = "" if len(scheme) == 1 else scheme
+    if scheme not in BACKENDS:
+        raise ValueError(f"No queue backend for {scheme!r} URLs")
+    if scheme == "sqlite":
+        url = url[len("sqlite:///") :]
+    return BACKENDS[scheme](url)
+
+
+def publish_indexes(queue, indexes: list, date: str = None) -> int:
+    """
+    Publish the pages listed by build_indexes for the snapshot of a date
+    (today by default), returning how many are new.
+    """
+    date = date or time.strftime("%y%m%d")
+    return queue.publish([(task_id(index, date), index) for index in indexes])
+
+
+def shard_path(root: pathlib.Path, worker: str, date: str = None) -> pathlib.Path:
+    date = date or time.strftime("%y%m%d")
+    return pathlib.Path(root) / date / SHARDS_DIR / worker / "json"
+
+
+class Heartbeat(threading.Thread):
+    """Renews the leases of the tasks in flight every third of the lease."""
+
+    def __init__(self, queue, worker: str, lease_s: float):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.worker = worker
+        self.lease_s = lease_s
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.lease_s / 3):
+            with self.lock:
+                ids = list(self.in_flight)
+            if ids:
+                try:
+                    self.queue.heartbeat(self.worker, ids, self.lease_s)
+                except Exception as e:
+                    logging.warning(f"Heartbeat failed: {e}")
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+def run_worker(
+    queue,
+    worker: str = None,
+    root: pathlib.Path = LISTINGS_ROOT,
+    threads: int = 10,
+    rate: float = None,
+    lease_s: float = LEASE_S,
+    batch: int = None,
+    wait: bool = True,
+    date: str = None,
+) -> int:
+    """
+    Download claimed pages into this worker's shard until the queue is empty.
+
+    Args:
+        queue: An open queue, see open_queue().
+        worker (str): Worker id, host and pid when not given.
+        root (pathlib.Path): Directory holding the daily snapshots.
+        threads (int): Download threads.
+        rate (float): Maximum requests per second of this worker.
+        lease_s (float): Lease of a claimed task, renewed while it runs.
+        batch (int): Tasks claimed at once, 2 * threads when not given.
+        wait (bool): Once nothing is pending, keep polling until the tasks
+            leased by other workers are done, to take over expired ones.
+        date (str): Snapshot the pages go to, yymmdd, today when not given.
+
+    Returns:
+        int: The number of pages downloaded.
+    """
+    import data_downloader
+
+    worker = worker or default_worker_id()
+    batch = batch or 2 * threads
+    save_path = shard_path(root, worker, date)
+    for contract in data_downloader.CONTRACT_NAMES.values():
+        (save_path / contract).mkdir(parents=True, exist_ok=True)
+    heartbeat = Heartbeat(queue, worker, lease_s)
+    heartbeat.start()
+    downloaded = 0
+    with instrumentation.span("work"), data_downloader.CrawlSession(
+        threads, rate
+    ) as session, concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        instrumentation.instrument_session(session, "work")
+        pending = {}
+        while True:
+            # keep the executor fed, claiming again once half a batch is done
+            if len(pending) <= batch // 2:
+                tasks = queue.claim(worker, batch - len(pending), lease_s)
+                with heartbeat.lock:
+                    heartbeat.in_flight.update(id for id, _ in tasks)
+                for id, index in tasks:
+                    future = instrumentation.submit(
+                        executor,
+                        data_downloader.download_listings_page,
+                        index,
+                        session,
+                        save_path,
+                    )
+                    pending[future] = id
+            if not pending:
+                stats = queue.stats()
+                if stats["pending"] or (wait and stats["leased"]):
+                    time.sleep(POLL_INTERVAL_S)
+                    continue
+                break
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            completed = []
+            for future in done:
+                id = pending.pop(future)
+                try:
+                    future.result()
+                    completed.append(id)
+                except Exception as e:
+                    instrumentation.count("errors_total", stage="work")
+                    queue.fail(worker, id, repr(e))
+                with heartbeat.lock:
+                    heartbeat.in_flight.discard(id)
+            if completed:
+                queue.complete(worker, completed)
+                downloaded += len(completed)
+    heartbeat.stop()
+    logging.info(f"Worker {worker} downloaded {downloaded} pages")
+    return downloaded
+
+
+def merge_shards(root: pathlib.Path = LISTINGS_ROOT, date: str = None) -> int:
+    """
+    Move the pages of every worker shard into the snapshot.
+
+    A page downloaded by two workers (after a lease expired) keeps the copy
+    merged last. Emptied shards are removed.
+
+    Returns:
+        int: The number of pages merged.
+    """
+    date = date or time.strftime("%y%m%d")
+    shards = pathlib.Path(root) / date / SHARDS_DIR
+    json_path = pathlib.Path(root) / date / "json"
+    merged = 0
+    for page in shards.glob("*/json/*/*.json"):
+        target = json_path / page.parent.name / page.name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(page, target)
+        merged += 1
+    # only the directories emptied by the merge are removed
+    for directory in sorted(shards.glob("**/"), key=lambda path: -len(path.parts)):
+        try:
+            directory.rmdir()
+        except OSError:
+            pass
+    logging.info(f"Merged {merged} pages into {json_path}")
+    return merged
+
+
+def _serve_stand_in(scale: int, latency_ms: float, urls) -> None:
+    import standin_server
+
+    server = standin_server.StandInServer(
+        corpus=standin_server.RecordedCorpus(scale=scale), latency_ms=latency_ms
+    )
+    urls.put(server.base_url)
+    server.serve_forever()
+
+
+def _demo_worker(queue_path, root, threads, base_url, worker) -> None:
+    import benchmark
+
+    benchmark.point_modules_at(base_url)
+    queue = SQLiteQueue(queue_path)
+    run_worker(queue, worker, root, threads)
+    queue.close()
+
+
+def demo(
+    processes: list,
+    threads: int = 2,
+    latency_ms: float = 250.0,
+    scale: int = 1,
+    workdir: pathlib.Path = None,
+) -> list:
+    """
+    Crawl the stand-in server with several worker processes and report the
+    throughput against the number of processes.
+
+    The stand-in runs in its own process with added latency, as a remote
+    site would, and every run drains a fresh queue of the same pages. On a
+    machine with few cores the latency must be high enough for the crawl to
+    be waiting on the network rather than on the CPU, or adding processes
+    only adds contention.
+
+    Returns:
+        list: One dict per process count with pages/s, speedup and efficiency.
+    """
+    import tempfile
+
+    import benchmark
+    import data_downloader
+    import downloader
+
+    context = multiprocessing.get_context("spawn")
+    urls = context.Queue()
+    server = context.Process(
+        target=_serve_stand_in, args=(scale, latency_ms, urls), daemon=True
+    )
+    server.start()
+    base_url = urls.get(timeout=60)
+    benchmark.point_modules_at(base_url)
+    workdir = pathlib.Path(workdir or tempfile.mkdtemp(prefix="cercocase-queue-"))
+    indexes = data_downloader.build_indexes(
+        downloader.get_neighbourhoods_df(downloader.CITY_ID), workers=16
+    )
+
+    results = []
+    for count in processes:
+        root = workdir / f"{count}_processes"
+        queue = SQLiteQueue(queue_path(root))
+        publish_indexes(queue, indexes)
+        start = time.perf_counter()
+        workers = [
+            context.Process(
+                target=_demo_worker,
+                args=(queue.path, root, threads, base_url, f"worker{number}"),
+            )
+            for number in range(count)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - start
+        stats = queue.stats()
+        queue.close()
+        pages = merge_shards(root)
+        results.append(
+            {
+                "processes": count,
+                "threads_per_process": threads,
+                "pages": pages,
+                "failed": stats["failed"],
+                "seconds": round(seconds, 2),
+                "pages_per_second": round(pages / seconds, 1),
+            }
+        )
+        logging.info(json.dumps(results[-1]))
+    server.terminate()
+
+    base = results[0]["pages_per_second"] / results[0]["processes"]
+    for result in results:
+        result["speedup"] = round(
+            result["pages_per_second"] / results[0]["pages_per_second"], 2
+        )
+        result["efficiency"] = round(
+            result["pages_per_second"] / (base * result["processes"]), 2
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared crawl task queue")
+    actions = parser.add_subparsers(dest="action", required=True)
+    action = actions.add_parser("serve", help="serve a SQLite queue to other hosts")
+    action.add_argument(
+        "--queue", type=pathlib.Path, default=None, help="default: today's queue"
+    )
+    action.add_argument("--host", default="0.0.0.0")
+    action.add_argument("--port", type=int, default=QUEUE_PORT)
+    action = actions.add_parser("stats", help="count the tasks in each state")
+    action.add_argument("--queue", default=None, help="default: today's queue")
+    action.add_argument("--requeue", action="store_true", help="requeue expired leases")
+    action = actions.add_parser("demo", help="throughput against worker processes")
+    action.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    action.add_argument("--threads", type=int, default=2)
+    action.add_argument("--latency-ms", type=float, default=250.0)
+    action.add_argument("--scale", type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.action == "serve":
+        queue = SQLiteQueue(args.queue)
+        server = QueueServer(queue, (args.host, args.port))
+        logging.info(f"Serving {queue.path} on port {args.port}")
+        server.serve_forever()
+    elif args.action == "stats":
+        queue = open_queue(args.queue or queue_path())
+        if args.requeue:
+            logging.info(f"Requeued {queue.requeue_expired()} expired leases")
+        print(json.dumps(queue.stats()))
+    else:
+        results = demo(args.processes, args.threads, args.latency_ms, args.scale)
+        print(json.dumps(results, indent=2))